@@ -4,6 +4,61 @@ const Test = require('../models/test.model');
 const FlaggedResult = require('../models/flaggedResult.model');
 const User = require('../models/user.model');
 const axios = require('axios'); // Added axios for HTTP requests
+const zlib = require('zlib');
+
+// Set to the prediction service's /jobs URL (e.g. http://localhost:5001/jobs) to score tests as background jobs
+const PYTHON_PREDICTION_JOBS_URL = process.env.PYTHON_PREDICTION_JOBS_URL;
+const PREDICTION_JOB_POLL_INTERVAL_MS = parseInt(process.env.PREDICTION_JOB_POLL_INTERVAL_MS || '2000', 10);
+const PREDICTION_JOB_TIMEOUT_MS = parseInt(process.env.PREDICTION_JOB_TIMEOUT_MS || '3600000', 10);
+// Set to 0 to send batches to the prediction service as plain JSON instead of gzip-compressed JSON
+const PREDICTION_REQUEST_GZIP = process.env.PREDICTION_REQUEST_GZIP !== '0';
+// Share of a center's submissions that must be flagged for the center to be flagged
+const CENTER_FLAG_RATIO_THRESHOLD = 0.1;
+
+// Center id of a log document, or null when it has none
+const centerIdOf = (logDoc) => {
+    const center = logDoc.center_id;
+    return center && center._id ? center._id.toString() : null;
+};
+
+// POSTs a JSON payload to the prediction service, gzip-compressed unless PREDICTION_REQUEST_GZIP=0.
+// Responses are compressed by the service as well; axios decompresses them.
+const postToPredictionService = (url, payload) => {
+    if (!PREDICTION_REQUEST_GZIP) {
+        return axios.post(url, payload);
+    }
+    const body = zlib.gzipSync(JSON.stringify(payload), { level: 5 });
+    return axios.post(url, body, {
+        headers: { 'Content-Type': 'application/json', 'Content-Encoding': 'gzip' },
+        maxBodyLength: Infinity,
+    });
+};
+
+// Submits a batch to the prediction service's job API, waits for it and collects the paged results.
+// Resubmitting an identical batch returns the stored results of the earlier job.
+const getPredictionsFromJob = async (jobsUrl, payload) => {
+    let job = (await postToPredictionService(jobsUrl, payload)).data;
+    const deadline = Date.now() + PREDICTION_JOB_TIMEOUT_MS;
+
+    while (job.status === 'queued' || job.status === 'running') {
+        if (Date.now() > deadline) {
+            throw new Error(`Prediction job ${job.job_id} did not finish in time`);
+        }
+        await new Promise(resolve => setTimeout(resolve, PREDICTION_JOB_POLL_INTERVAL_MS));
+        job = (await axios.get(`${jobsUrl}/${job.job_id}`)).data;
+    }
+    if (job.status !== 'done') {
+        throw new Error(`Prediction job ${job.job_id} failed: ${job.error}`);
+    }
+
+    const predictions = [];
+    while (predictions.length < job.num_results) {
+        const page = (await axios.get(`${jobsUrl}/${job.job_id}/results`, { params: { offset: predictions.length } })).data;
+        if (page.results.length === 0) break;
+        predictions.push(...page.results);
+    }
+    return predictions;
+};
 
 exports.evaluateTest = async (req, res) => {
   try {
@@ -90,12 +145,23 @@ exports.evaluateTest = async (req, res) => {
     // 3. Call Python Service
     const PYTHON_SERVICE_URL = process.env.PYTHON_PREDICTION_SERVICE_URL || 'http://localhost:5001/predict_batch';
     let pythonServiceResponseData;
+    const predictionPayload = {
+        test_id: testId,
+        all_user_logs: all_user_logs_for_python,
+        questions_data: questions_data_for_python
+    };
     try {
-        const response = await axios.post(PYTHON_SERVICE_URL, {
-            all_user_logs: all_user_logs_for_python,
-            questions_data: questions_data_for_python
-        });
-        pythonServiceResponseData = response.data;
+        if (PYTHON_PREDICTION_JOBS_URL) {
+            pythonServiceResponseData = await getPredictionsFromJob(PYTHON_PREDICTION_JOBS_URL, predictionPayload);
+        } else {
+            // Ask for the flagged users and per-center flag ratios only, instead of one prediction per student
+            predictionPayload.summary = {
+                group_keys: logsForTest.map(centerIdOf),
+                flag_ratio_threshold: CENTER_FLAG_RATIO_THRESHOLD,
+            };
+            const response = await postToPredictionService(PYTHON_SERVICE_URL, predictionPayload);
+            pythonServiceResponseData = response.data;
+        }
     } catch (axiosError) {
         console.error('Error calling Python prediction service:', axiosError.message);
         return res.status(500).json({ error: 'Failed to get predictions from Python service. ' + (axiosError.response ? axiosError.response.data.error : axiosError.message) });
@@ -103,41 +169,44 @@ exports.evaluateTest = async (req, res) => {
 
     // 4. Process Python Service Response to get flaggedUserIds
     const flaggedUserIdsFromPython = new Set();
-    if (Array.isArray(pythonServiceResponseData)) {
+    let flaggedCenters;
+    if (pythonServiceResponseData && Array.isArray(pythonServiceResponseData.flagged)) {
+        // Summary response: flagged users and flagged centers are computed by the service
+        pythonServiceResponseData.flagged.forEach(pred => flaggedUserIdsFromPython.add(pred.userId));
+        flaggedCenters = pythonServiceResponseData.flagged_groups || [];
+    } else if (Array.isArray(pythonServiceResponseData)) {
         pythonServiceResponseData.forEach(pred => {
             if (pred.prediction_label === 1) { // cheating
                 flaggedUserIdsFromPython.add(pred.userId);
             }
         });
-    } else {
-        console.error('Unexpected response format from Python service:', pythonServiceResponseData);
-        return res.status(500).json({ error: 'Invalid response format from Python service.' });
-    }
 
-    // 5. Calculate Flagged Centers based on Python's output
-    const centerStats = {};
+        // 5. Calculate Flagged Centers based on Python's output
+        const centerStats = {};
 
-    logsForTest.forEach(logDoc => {
-        const userId = logDoc.user_id.toString();
-        const center = logDoc.center_id; 
-        if (!center || !center._id) return; 
-        
-        const centerId = center._id.toString();
+        logsForTest.forEach(logDoc => {
+            const userId = logDoc.user_id.toString();
+            const centerId = centerIdOf(logDoc);
+            if (!centerId) return;
 
-        if (!centerStats[centerId]) {
-            centerStats[centerId] = { total_submitted_by_center: 0, flagged_by_center: 0 };
-        }
-        centerStats[centerId].total_submitted_by_center++;
+            if (!centerStats[centerId]) {
+                centerStats[centerId] = { total_submitted_by_center: 0, flagged_by_center: 0 };
+            }
+            centerStats[centerId].total_submitted_by_center++;
 
-        if (flaggedUserIdsFromPython.has(userId)) {
-            centerStats[centerId].flagged_by_center++;
-        }
-    });
+            if (flaggedUserIdsFromPython.has(userId)) {
+                centerStats[centerId].flagged_by_center++;
+            }
+        });
 
-    const flaggedCenters = Object.keys(centerStats).filter(centerId => {
-        const stats = centerStats[centerId];
-        return stats.total_submitted_by_center > 0 && (stats.flagged_by_center / stats.total_submitted_by_center) >= 0.1;
-    });
+        flaggedCenters = Object.keys(centerStats).filter(centerId => {
+            const stats = centerStats[centerId];
+            return stats.total_submitted_by_center > 0 && (stats.flagged_by_center / stats.total_submitted_by_center) >= CENTER_FLAG_RATIO_THRESHOLD;
+        });
+    } else {
+        console.error('Unexpected response format from Python service:', pythonServiceResponseData);
+        return res.status(500).json({ error: 'Invalid response format from Python service.' });
+    }
 
     const flaggedUserDetails = await User.find(
       { _id: { $in: Array.from(flaggedUserIdsFromPython)}},
@@ -0,0 +1,351 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+# Batch jobs scored at the same time
+JOB_WORKERS = int(os.environ.get('PREDICTION_JOB_WORKERS', '2'))
+# Maximum queued + running jobs; further submissions are rejected until one finishes
+JOB_QUEUE_SIZE = int(os.environ.get('PREDICTION_JOB_QUEUE_SIZE', '8'))
+# Finished jobs kept in memory; older results are reloaded from disk when requested
+JOB_HISTORY = int(os.environ.get('PREDICTION_JOB_HISTORY', '16'))
+JOB_RESULTS_DIR = os.environ.get(
+    'PREDICTION_JOB_RESULTS_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_results'),
+)
+# Seconds job results are kept in JOB_RESULTS_DIR (0 = forever); expired ones are deleted as new jobs are submitted
+JOB_RESULTS_TTL = int(os.environ.get('PREDICTION_JOB_RESULTS_TTL', str(7 * 24 * 3600)))
+
+_JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueueFull(Exception):
+    """Raised by JobManager.submit when JOB_QUEUE_SIZE jobs are already queued or running."""
+
+
+def job_key(*parts):
+    """
+    Content hash identifying a job, e.g. job_key(request_body, feature_engine). Submitting the same
+    content again returns the existing job (or its stored results) instead of scoring it twice.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+
+def is_valid_job_id(job_id):
+    return bool(_JOB_ID_PATTERN.match(job_id or ''))
+
+
+class JobProgress:
+    """
+    Progress counters of one batch job, updated by the scoring pipeline as it goes.
+    stage is one of 'queued', 'parsing', 'computing_stats', 'featurizing', 'scoring', 'done';
+    on_stage_change, if set, is called whenever it changes.
+    """
+
+    def __init__(self, sessions_total=0, on_stage_change=None):
+        self._stage = 'queued'
+        self.on_stage_change = on_stage_change
+        self.sessions_total = sessions_total
+        self.sessions_parsed = 0
+        self.stats_computed = False
+        self.sessions_scored = 0
+
+    @property
+    def stage(self):
+        return self._stage
+
+    @stage.setter
+    def stage(self, stage):
+        self._stage = stage
+        if self.on_stage_change:
+            self.on_stage_change()
+
+    def add_parsed(self, count):
+        self.sessions_parsed += count
+
+    def add_scored(self, count):
+        self.sessions_scored += count
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "sessions_total": self.sessions_total,
+            "sessions_parsed": self.sessions_parsed,
+            "stats_computed": self.stats_computed,
+            "sessions_scored": self.sessions_scored,
+        }
+
+
+class Job:
+    def __init__(self, job_id, payload, sessions_total):
+        self.job_id = job_id
+        self.payload = payload # released once the job has run
+        self.status = 'queued' # 'queued', 'running', 'done' or 'failed'
+        self.progress = JobProgress(sessions_total)
+        self.results = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def is_active(self):
+        return self.status in ('queued', 'running')
+
+    @classmethod
+    def from_dict(cls, state):
+        """Read-only snapshot of a job run by another process, from its state file."""
+        job = cls(state["job_id"], None, state["progress"]["sessions_total"])
+        job.status, job.error = state["status"], state["error"]
+        job.created_at, job.started_at, job.finished_at = state["created_at"], state["started_at"], state["finished_at"]
+        for name, value in state["progress"].items():
+            setattr(job.progress, name, value)
+        job.pid = state.get("pid")
+        return job
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "progress": self.progress.to_dict(),
+            "num_results": len(self.results) if self.results is not None else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs batch-scoring jobs on a bounded thread pool and keeps their results on local disk.
+
+    run_fn(payload, progress) does the actual work and returns the list of per-user results; it
+    is expected to update the JobProgress it is given. Completed results are written to
+    {directory}/{job_id}.json, so a job id (a content hash, see job_key) that was already scored
+    is answered from disk, including after a restart. Failed jobs are not stored and can be resubmitted.
+
+    Several server processes can share one directory: while a job is queued or running, its status is
+    mirrored to {job_id}.state.json (on every stage change), so any process can report it. Submissions
+    hold an flock on {directory}/.submit.lock from the lookup until the state file is written, so two
+    processes given the same job at once never both start it. Progress counters read from another process
+    are as of the last stage change.
+
+    Stored results (and files left by processes that died) older than results_ttl seconds are deleted
+    whenever a new job is submitted.
+    """
+
+    def __init__(self, run_fn, directory=JOB_RESULTS_DIR, workers=JOB_WORKERS, queue_size=JOB_QUEUE_SIZE, history=JOB_HISTORY,
+                 results_ttl=JOB_RESULTS_TTL):
+        self.run_fn = run_fn
+        self.directory = directory
+        self.results_ttl = results_ttl
+        self.queue_size = queue_size
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-job')
+        self._jobs = OrderedDict() # job_id -> Job, oldest first
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _state_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.state.json")
+
+    def _write_json(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path) # atomic, readers never see a half-written file
+
+    def _read_json(self, path, what):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read {what}: {e}")
+            return None
+
+    def _write_state(self, job):
+        state = job.to_dict()
+        state["pid"] = os.getpid()
+        try:
+            self._write_json(self._state_path(job.job_id), state)
+        except OSError as e:
+            print(f"Warning: Could not store the state of job {job.job_id}: {e}")
+
+    def _get_from_other_process(self, job_id):
+        state = self._read_json(self._state_path(job_id), f"the state of job {job_id}")
+        if state is None:
+            return None
+        job = Job.from_dict(state)
+        if job.is_active and not _process_alive(job.pid):
+            job.status, job.error = 'failed', "The process running this job exited"
+        return job
+
+    def _get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+
+        stored = self._read_json(self._path(job_id), f"stored results of job {job_id}")
+        if stored is None:
+            return self._get_from_other_process(job_id)
+
+        job = Job(job_id, None, len(stored["results"]))
+        job.status = 'done'
+        job.results = stored["results"]
+        job.created_at, job.started_at, job.finished_at = stored["created_at"], stored["started_at"], stored["finished_at"]
+        job.progress.stage = 'done'
+        job.progress.sessions_parsed = job.progress.sessions_scored = job.progress.sessions_total
+        job.progress.stats_computed = True
+        self._jobs[job_id] = job
+        self._prune()
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.is_active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _remove_expired(self):
+        if not self.results_ttl:
+            return
+        cutoff = time.time() - self.results_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if not job.is_active and (job.finished_at or 0) < cutoff]:
+            del self._jobs[job_id]
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            job_id = name.split('.', 1)[0]
+            if not is_valid_job_id(job_id) or job_id in self._jobs:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if name.endswith('.state.json'):
+                    other = self._get_from_other_process(job_id)
+                    if other is not None and other.is_active:
+                        continue # still running elsewhere, in a very long stage
+                os.remove(path)
+            except OSError:
+                pass # already removed by another process
+
+    @contextlib.contextmanager
+    def _submit_lock(self):
+        """Serializes submissions across the processes sharing the directory (see the class docstring)."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lock_file = open(os.path.join(self.directory, '.submit.lock'), 'a')
+        except OSError as e:
+            print(f"Warning: Could not lock {self.directory}, submitting without it: {e}")
+            yield
+            return
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # released when the file is closed
+            yield
+
+    def _save(self, job):
+        self._write_json(self._path(job.job_id), {
+            "job_id": job.job_id,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "results": job.results,
+        })
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        job.progress.on_stage_change = lambda: self._write_state(job)
+        self._write_state(job)
+        try:
+            job.results = self.run_fn(job.payload, job.progress)
+            job.finished_at = time.time()
+            job.progress.on_stage_change = None
+            job.progress.stage = 'done'
+            try:
+                self._save(job)
+            except OSError as e:
+                print(f"Warning: Could not store results of job {job.job_id}: {e}")
+            job.status = 'done'
+            try:
+                os.remove(self._state_path(job.job_id))
+            except OSError:
+                pass
+        except Exception as e:
+            print(f"ERROR: Batch job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.finished_at = time.time()
+            job.status = 'failed'
+            job.progress.on_stage_change = None
+            self._write_state(job)
+        finally:
+            job.payload = None
+            with self._lock:
+                self._prune()
+
+    def get(self, job_id):
+        """Returns the Job with this id (from memory or its stored results), or None."""
+        with self._lock:
+            return self._get(job_id)
+
+    def submit(self, job_id, payload, sessions_total):
+        """
+        Queues a job, unless one with the same id is already queued, running or done.
+        Args:
+            job_id (str): Content hash of the job (see job_key).
+            payload: Passed to run_fn as is.
+            sessions_total (int): Number of sessions, for progress reporting.
+        Returns:
+            tuple: (Job, created) where created is False when an existing job was returned.
+        Raises:
+            JobQueueFull: If queue_size jobs are already queued or running.
+        """
+        with self._lock, self._submit_lock():
+            job = self._get(job_id)
+            if job is not None and job.status == 'failed' and job_id in self._jobs:
+                job = self._get_from_other_process(job_id) or job # another process may have resubmitted it since
+            if job is not None and job.status != 'failed':
+                return job, False
+
+            active_jobs = sum(1 for existing in self._jobs.values() if existing.is_active)
+            if active_jobs >= self.queue_size:
+                raise JobQueueFull(f"{active_jobs} batch jobs are already queued or running")
+
+            job = Job(job_id, payload, sessions_total)
+            self._jobs.pop(job_id, None)
+            self._jobs[job_id] = job
+            self._write_state(job)
+            self._executor.submit(self._run, job)
+            self._remove_expired()
+            return job, True
@@ -0,0 +1,313 @@
+"""
+Benchmarks for the prediction service on synthetic exam logs (see synthetic_logs.py).
+
+    python benchmark.py --students 1000 --questions 40 --events 120 --cheat-ratio 0.1 --output results.json
+
+Micro-benchmarks time each stage of the pipeline on its own (parse, batch stats, per-question metrics,
+aggregation, feature vectors, the DataFrame-based reference features, columnar features, scaling, inference
+through scikit-learn, and inference through the booster path of fast_inference); the end-to-end runs post
+the batch to /predict_batch and single sessions to /predict_single through the Flask test client. The
+startup stage times fresh processes importing the service until its model is ready; --max-startup-seconds
+makes the run fail when their median exceeds a limit.
+Results are written as JSON (to stdout unless --output is given), so runs can be compared over time.
+"""
+import argparse
+import contextlib
+import gzip
+import importlib.metadata
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_logs import generate_batch
+
+STAGES = [
+    'startup', 'parse', 'batch_stats', 'per_question_metrics', 'aggregation', 'feature_vector', 'reference_features',
+    'columnar', 'scaling', 'inference', 'booster_inference', 'predict_batch', 'predict_single',
+]
+
+
+def _summarize(durations, items):
+    """Timing summary of repeated runs that each processed `items` items."""
+    median = statistics.median(durations)
+    return {
+        "runs": len(durations),
+        "items": items,
+        "seconds": {
+            "min": min(durations),
+            "median": median,
+            "mean": statistics.fmean(durations),
+            "max": max(durations),
+        },
+        "items_per_second": items / median if median > 0 else None,
+        "us_per_item": median / items * 1e6 if items else None,
+    }
+
+
+def _latencies(durations):
+    """Percentiles, in milliseconds, of individual request latencies."""
+    ordered = sorted(durations)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+    return {"p50_ms": percentile(50), "p90_ms": percentile(90), "p99_ms": percentile(99), "max_ms": ordered[-1] * 1000}
+
+
+def _time(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+# Run in a fresh interpreter by the startup stage; prints the import and ready times as its last line
+_STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import prediction_service
+imported = time.perf_counter()
+model_version = prediction_service.model_registry.wait_loaded()
+print(json.dumps({"import_seconds": imported - started, "ready_seconds": time.perf_counter() - started,
+                  "inference_path": model_version.inference_path if model_version is not None else None}))
+"""
+
+
+def _startup_run():
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               capture_output=True, text=True, check=False)
+    wall = time.perf_counter() - start
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        raise RuntimeError(f"Service start-up failed ({completed.returncode}): {completed.stderr[-500:]}")
+    run = json.loads(lines[-1])
+    if run["inference_path"] is None:
+        raise RuntimeError("Service started without a model")
+    return wall, run
+
+
+def benchmark_startup(repeat):
+    """Wall time of fresh processes importing the service and loading its model, plus the split reported by them."""
+    runs = [_startup_run() for _ in range(repeat)]
+    return {
+        **_summarize([wall for wall, _ in runs], 1),
+        "import_seconds_median": statistics.median(run["import_seconds"] for _, run in runs),
+        "ready_seconds_median": statistics.median(run["ready_seconds"] for _, run in runs),
+        "inference_path": runs[-1][1]["inference_path"],
+    }
+
+
+def run_benchmarks(args, stages):
+    results = {}
+    if 'startup' in stages:
+        print("Benchmarking startup...", file=sys.stderr)
+        results['startup'] = benchmark_startup(args.repeat)
+    if not set(stages) - {'startup'}:
+        return results
+
+    import numpy as np
+    import pandas as pd
+    import prediction_service as service
+
+    batch = generate_batch(args.students, args.questions, args.events, args.cheat_ratio, args.seed)
+    all_user_logs = batch["all_user_logs"]
+    questions_data_map = {q["id"]: q for q in batch["questions_data"]}
+    num_sessions = len(all_user_logs)
+
+    # Shared inputs, computed once whether or not their own stage is benchmarked
+    parsed_sessions = [service.parse_session(user["session_log_events"], questions_data_map) for user in all_user_logs]
+    global_stats = service.compute_batch_global_stats(all_user_logs, questions_data_map, parsed_sessions)
+    per_question_metrics_list = [service.compute_per_question_metrics(parsed, global_stats) for parsed in parsed_sessions]
+    feature_matrix = np.nan_to_num(np.array([
+        service.extract_feature_vector(parsed, global_stats, questions_data_map) for parsed in parsed_sessions
+    ], dtype=np.float64))
+    feature_frame = pd.DataFrame(feature_matrix, columns=service.FEATURE_NAMES_IN_ORDER)
+    model_version = service.model_registry.wait_loaded()
+
+    def parse():
+        for user in all_user_logs:
+            service.parse_session(user["session_log_events"], questions_data_map)
+
+    def per_question_metrics():
+        for parsed in parsed_sessions:
+            service.compute_per_question_metrics(parsed, global_stats)
+
+    def aggregation():
+        for parsed, metrics in zip(parsed_sessions, per_question_metrics_list):
+            service.aggregate_per_question_metrics(metrics, parsed, global_stats)
+
+    def feature_vector():
+        for parsed in parsed_sessions:
+            service.extract_feature_vector(parsed, global_stats, questions_data_map)
+
+    def reference_features():
+        for user, parsed in zip(all_user_logs, parsed_sessions):
+            metrics_df = service.get_per_question_metrics(user["session_log_events"], questions_data_map, global_stats, parsed)
+            service.aggregate_features(metrics_df, user["session_log_events"], global_stats, questions_data_map, parsed)
+
+    micro_benchmarks = {
+        'parse': parse,
+        'batch_stats': lambda: service.compute_batch_global_stats(all_user_logs, questions_data_map, parsed_sessions),
+        'per_question_metrics': per_question_metrics,
+        'aggregation': aggregation,
+        'feature_vector': feature_vector,
+        'reference_features': reference_features,
+        'columnar': lambda: service.compute_columnar_features(all_user_logs, questions_data_map),
+    }
+    if model_version.model is not None: # not with compiled artifacts (PREDICTION_FAST_START)
+        micro_benchmarks['scaling'] = lambda: model_version.scaler.transform(feature_frame)
+        micro_benchmarks['inference'] = lambda: model_version.model.predict_proba(model_version.scaler.transform(feature_frame))
+    if model_version.booster_scorer is not None:
+        micro_benchmarks['booster_inference'] = lambda: model_version.booster_scorer.score(feature_matrix)
+    for stage, fn in micro_benchmarks.items():
+        if stage in stages:
+            print(f"Benchmarking {stage}...", file=sys.stderr)
+            results[stage] = _summarize(_time(fn, args.repeat), num_sessions)
+
+    client = service.app.test_client()
+
+    if 'predict_batch' in stages:
+        print("Benchmarking predict_batch...", file=sys.stderr)
+        if args.body_encoding == 'npz':
+            from wire_encoding import EncodedBatch, COLUMNAR_CONTENT_TYPE
+            body = EncodedBatch.from_user_logs(all_user_logs, batch["questions_data"], feature_engine=args.feature_engine).to_npz()
+            content_type = COLUMNAR_CONTENT_TYPE
+        else:
+            body = json.dumps({**batch, "feature_engine": args.feature_engine}).encode('utf-8')
+            content_type = 'application/json'
+        headers = {}
+        if args.gzip:
+            body = gzip.compress(body, compresslevel=5)
+            headers = {'Content-Encoding': 'gzip', 'Accept-Encoding': 'gzip'}
+
+        def post_batch():
+            response = client.post('/predict_batch', data=body, content_type=content_type, headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError(f"/predict_batch returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+        durations = _time(post_batch, args.repeat)
+        results['predict_batch'] = {**_summarize(durations, num_sessions), "request_bytes": len(body), "feature_engine": args.feature_engine,
+                                    "body_encoding": args.body_encoding, "gzip": args.gzip}
+
+    if 'predict_single' in stages:
+        print("Benchmarking predict_single...", file=sys.stderr)
+        bodies = [
+            json.dumps({"all_user_logs": user["session_log_events"], "questions_data": batch["questions_data"]})
+            for user in all_user_logs[:args.single_requests]
+        ]
+
+        def post_single(body):
+            response = client.post('/predict_single', data=body, content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f"/predict_single returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+        post_single(bodies[0]) # warm-up
+        durations = []
+        for body in bodies:
+            start = time.perf_counter()
+            post_single(body)
+            durations.append(time.perf_counter() - start)
+        total = sum(durations)
+        results['predict_single'] = {
+            "requests": len(durations),
+            "requests_per_second": len(durations) / total if total > 0 else None,
+            "latency": _latencies(durations),
+        }
+
+    return results
+
+
+def _environment():
+    versions = {"python": platform.python_version()}
+    for distribution in ('numpy', 'pandas', 'scikit-learn', 'xgboost', 'flask'):
+        try:
+            versions[distribution] = importlib.metadata.version(distribution)
+        except importlib.metadata.PackageNotFoundError:
+            versions[distribution] = None
+    return {"platform": platform.platform(), "cpu_count": os.cpu_count(), "versions": versions}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the prediction service on synthetic exam logs.")
+    parser.add_argument('--students', type=int, default=1000, help="Sessions in the batch")
+    parser.add_argument('--questions', type=int, default=40, help="Questions in the test")
+    parser.add_argument('--events', type=int, default=120, help="Approximate events per session")
+    parser.add_argument('--cheat-ratio', type=float, default=0.1, help="Fraction of simulated cheating sessions")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per benchmark (after one warm-up run)")
+    parser.add_argument('--single-requests', type=int, default=100, help="Sessions posted one by one to /predict_single")
+    parser.add_argument('--feature-engine', default='reference', help="feature_engine sent to /predict_batch")
+    parser.add_argument('--body-encoding', choices=('json', 'npz'), default='json',
+                        help="/predict_batch body: JSON, or the columnar encoding of wire_encoding")
+    parser.add_argument('--gzip', action='store_true', help="gzip the /predict_batch body and accept a gzip response")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"Comma-separated subset of: {', '.join(STAGES)}")
+    parser.add_argument('--feature-cache', action='store_true',
+                        help="Turn the feature cache on (PREDICTION_FEATURE_CACHE_SIZE, or 100000 vectors); by default it is "
+                             "disabled so repeated runs measure cold scoring")
+    parser.add_argument('--max-startup-seconds', type=float,
+                        help="Exit with status 1 if the median startup stage wall time exceeds this")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(unknown)}")
+
+    # Configure the service before it is imported: no state left behind in the real stats store,
+    # and no feature cache hits that would hide the cost of repeated runs
+    scratch_dir = tempfile.TemporaryDirectory(prefix='prediction-benchmark-')
+    os.environ.setdefault('PREDICTION_STATS_STORE_DIR', os.path.join(scratch_dir.name, 'global_stats_store'))
+    os.environ.setdefault('PREDICTION_JOB_RESULTS_DIR', os.path.join(scratch_dir.name, 'job_results'))
+    if args.feature_cache:
+        os.environ.setdefault('PREDICTION_FEATURE_CACHE_SIZE', '100000')
+    else:
+        os.environ['PREDICTION_FEATURE_CACHE_SIZE'] = '0'
+        os.environ['PREDICTION_FEATURE_CACHE_DIR'] = ''
+
+    started_at = time.time()
+    # The service and the pipeline print progress and warnings; keep stdout for the report
+    with scratch_dir, contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmarks(args, stages)
+
+    report = {
+        "config": {
+            "students": args.students,
+            "questions": args.questions,
+            "events_per_session": args.events,
+            "cheat_ratio": args.cheat_ratio,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "feature_cache": args.feature_cache,
+        },
+        "environment": _environment(),
+        "started_at": started_at,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+        print(f"Benchmark results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+    if args.max_startup_seconds is not None and 'startup' in results:
+        startup_seconds = results['startup']['seconds']['median']
+        if startup_seconds > args.max_startup_seconds:
+            print(f"ERROR: Median startup time {startup_seconds:.2f}s exceeds --max-startup-seconds {args.max_startup_seconds}.",
+                  file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
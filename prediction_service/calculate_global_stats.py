@@ -1,164 +1,150 @@
 import os
 import json
-import datetime
-import numpy as np 
-from collections import defaultdict
 import math
 
-def parse_timestamp(ts_str):
-    # Handles the 'Z' suffix for UTC
-    if ts_str is None:
-        return None
-    if ts_str.endswith('Z'):
-        ts_str = ts_str[:-1] + '+00:00'
-    try:
-        return datetime.datetime.fromisoformat(ts_str)
-    except (ValueError, TypeError):
-        print(f"Warning: Could not parse timestamp {ts_str}")
-        return None
+from session_parser import parse_session
+
 
 # --- Function to Process Single User's Logs for Batch Stats ---
-def _process_single_session_logs_for_batch_stats(session_log_events, questions_data_map):
+def _process_single_session_logs_for_batch_stats(session_log_events, questions_data_map, parsed_session=None):
     """
-    Parses a single user's session_log_events to extract per-question metrics.
-    Uses the provided questions_data_map for correct answer lookup.
+    Extracts the per-question metrics that feed the batch stats from a single user's session.
+    Uses the shared session parser, so the state machine is the same one the feature extraction uses.
+    Args:
+        session_log_events (list): The user's raw log events (ignored when parsed_session is given).
+        questions_data_map (dict): Map of question_id to question details.
+        parsed_session (ParsedSession, optional): Session already parsed by parse_session.
     """
-    if not session_log_events:
-        return {}
-
-    session_metrics = defaultdict(lambda: {
-        "time_spent": 0.0,
-        "answered_correctly": None, # None=Not answered, 0=Incorrect, 1=Correct
-        "answer_changes": 0,
-        "tab_switches": 0
-    })
-
-    last_q_selection_time = None
-    current_q_id = None
-    final_answer_for_q = {} 
-
-    parsed_logs = []
-    for log in session_log_events: 
-        ts = parse_timestamp(log.get("timestamp"))
-        if ts:
-            parsed_logs.append({**log, "timestamp_dt": ts})
-
-    if not parsed_logs:
-        return {}
-        
-    parsed_logs.sort(key=lambda x: x["timestamp_dt"])
-
-    for i, log in enumerate(parsed_logs):
-        activity = log.get("activity_text", "")
-        timestamp = log["timestamp_dt"]
-        location = log.get("location")
-
-        if activity.startswith("Selected question") or activity == "Test Started":
-            if current_q_id and last_q_selection_time:
-                time_diff = (timestamp - last_q_selection_time).total_seconds()
-                session_metrics[current_q_id]["time_spent"] += max(0, time_diff)
-            current_q_id = location
-            last_q_selection_time = timestamp
-        elif activity == "Submitted Test" or i == len(parsed_logs) - 1:
-            if current_q_id and last_q_selection_time:
-                time_diff = (timestamp - last_q_selection_time).total_seconds()
-                session_metrics[current_q_id]["time_spent"] += max(0, time_diff)
-            current_q_id = None
-            last_q_selection_time = None
-
-        if current_q_id:
-            if activity == "Tab Switched":
-                 session_metrics[current_q_id]["tab_switches"] += 1
-            elif activity.startswith("Cleared option"):
-                 session_metrics[current_q_id]["answer_changes"] += 1
-                 final_answer_for_q[current_q_id] = None
-            elif activity.startswith("Selected option"):
-                 try:
-                     option_str = activity.split(" ")[2]
-                     option_idx = int(option_str)
-                     final_answer_for_q[current_q_id] = option_idx
-                 except (IndexError, ValueError):
-                     final_answer_for_q[current_q_id] = None
-
-    for q_id, last_answer_idx in final_answer_for_q.items():
-        if q_id in questions_data_map and last_answer_idx is not None: 
-            question_info = questions_data_map.get(q_id, {}) 
-            correct_answer = question_info.get("correct_answer") 
-            if correct_answer is not None:
-                 session_metrics[q_id]["answered_correctly"] = 1 if last_answer_idx == correct_answer else 0
-            else:
-                 session_metrics[q_id]["answered_correctly"] = None 
-        elif q_id in questions_data_map: 
-            session_metrics[q_id]["answered_correctly"] = None
-
+    if parsed_session is None:
+        if not session_log_events:
+            return {}
+        parsed_session = parse_session(session_log_events, questions_data_map)
 
     return {
-        q_id: metrics for q_id, metrics in session_metrics.items()
-        if q_id in questions_data_map and metrics["time_spent"] > 0.1
+        q_id: metrics for q_id, metrics in parsed_session.question_metrics.items()
+        if metrics.time_spent > 0.1
     }
 
 
-def compute_batch_global_stats(all_user_logs_with_ids, questions_data_map):
+class QuestionStatsAccumulator:
+    """
+    Running per-question statistics behind the batch global stats, updated one session at a time.
+    Memory is O(questions) instead of O(students x questions), and accumulators built on different
+    shards, processes or requests can be merged.
+
+    Per question it keeps [time count, time mean, time M2 (Welford), correctness count,
+    correct sum, tab switch sum, answer change sum].
+    """
+
+    _TIME_COUNT, _TIME_MEAN, _TIME_M2, _CORRECT_COUNT, _CORRECT_SUM, _SWITCH_SUM, _CHANGE_SUM = range(7)
+
+    def __init__(self, state=None):
+        self.questions = {q_id: list(values) for q_id, values in (state or {}).items()}
+
+    def _slots(self, q_id):
+        slots = self.questions.get(q_id)
+        if slots is None:
+            slots = self.questions[q_id] = [0, 0.0, 0.0, 0, 0, 0, 0]
+        return slots
+
+    def add_question_metrics(self, q_id, metrics):
+        """Folds one session's QuestionMetrics for one question in (the same filters compute_batch_global_stats always applied)."""
+        slots = self._slots(q_id)
+        time_spent = metrics.time_spent
+        if time_spent > 0.1: # Only consider attempted questions for time stats
+            slots[self._TIME_COUNT] += 1
+            delta = time_spent - slots[self._TIME_MEAN]
+            slots[self._TIME_MEAN] += delta / slots[self._TIME_COUNT]
+            slots[self._TIME_M2] += delta * (time_spent - slots[self._TIME_MEAN])
+            slots[self._SWITCH_SUM] += metrics.tab_switches
+            slots[self._CHANGE_SUM] += metrics.answer_changes
+        if metrics.answered_correctly is not None:
+            slots[self._CORRECT_COUNT] += 1
+            slots[self._CORRECT_SUM] += metrics.answered_correctly
+
+    def add_session(self, session_log_events, questions_data_map, parsed_session=None):
+        """Folds one user's session in."""
+        if parsed_session is None:
+            if not session_log_events:
+                return
+            parsed_session = parse_session(session_log_events, questions_data_map)
+
+        # Same filter as _process_single_session_logs_for_batch_stats, without building its dict
+        for q_id, metrics in parsed_session.question_metrics.items():
+            if metrics.time_spent > 0.1 and q_id in questions_data_map:
+                self.add_question_metrics(q_id, metrics)
+
+    def merge(self, other):
+        """Merges another accumulator into this one (Chan et al. pairwise update for the time moments)."""
+        for q_id, theirs in other.questions.items():
+            mine = self._slots(q_id)
+            count_a, count_b = mine[self._TIME_COUNT], theirs[self._TIME_COUNT]
+            if count_b:
+                count = count_a + count_b
+                delta = theirs[self._TIME_MEAN] - mine[self._TIME_MEAN]
+                mine[self._TIME_MEAN] += delta * count_b / count
+                mine[self._TIME_M2] += theirs[self._TIME_M2] + delta * delta * count_a * count_b / count
+                mine[self._TIME_COUNT] = count
+            for index in (self._CORRECT_COUNT, self._CORRECT_SUM, self._SWITCH_SUM, self._CHANGE_SUM):
+                mine[index] += theirs[index]
+        return self
+
+    def to_dict(self):
+        """JSON-serializable state; QuestionStatsAccumulator(state) restores it."""
+        return {q_id: list(values) for q_id, values in self.questions.items()}
+
+    def to_global_stats(self, questions_data_map):
+        """
+        Builds the batch_global_stats dictionary compute_batch_global_stats returns.
+        Args:
+            questions_data_map: Dict mapping question_id to question details; every question gets an entry.
+        """
+        batch_global_stats = {}
+        for q_id in questions_data_map.keys():
+            time_count, time_mean, time_m2, correct_count, correct_sum, switch_sum, change_sum = self.questions.get(q_id, (0, 0.0, 0.0, 0, 0, 0, 0))
+
+            avg_time = float(time_mean) if time_count else 0.0
+            std_dev_time = math.sqrt(max(time_m2, 0.0) / time_count) if time_count > 1 else 0.0
+
+            accuracy = correct_sum / correct_count if correct_count else 0.0
+
+            avg_tab_switches = switch_sum / time_count if time_count else 0.0
+            avg_answer_changes = change_sum / time_count if time_count else 0.0
+
+            batch_global_stats[q_id] = {
+                "global_avg_time": round(avg_time, 3),
+                "global_std_dev_time": round(std_dev_time, 3),
+                "global_accuracy": round(accuracy, 3), 
+                "global_avg_tab_switches": round(avg_tab_switches, 3), 
+                "global_avg_answer_changes": round(avg_answer_changes, 3), 
+                "global_attempt_count": time_count, 
+            }
+        return batch_global_stats
+
+
+def compute_batch_global_stats(all_user_logs_with_ids, questions_data_map, parsed_sessions=None):
     """
     Computes global statistics for a batch of user logs.
     Args:
         all_user_logs_with_ids: List of dicts, e.g., [{'userId': 'id1', 'session_log_events': [...]}, ...]
         questions_data_map: Dict mapping question_id to question details.
+        parsed_sessions: Optional list of ParsedSession aligned with all_user_logs_with_ids
+                         (None entries are skipped), so sessions parsed once can be reused.
     Returns:
         A dictionary batch_global_stats where keys are question_ids.
     """
-    accumulated_times = defaultdict(list)
-    accumulated_correctness = defaultdict(list)
-    accumulated_tab_switches = defaultdict(list)
-    accumulated_answer_changes = defaultdict(list)
-
     if not questions_data_map:
         print("Warning: compute_batch_global_stats called with empty questions_data_map.")
         return {}
 
-    for user_log_data in all_user_logs_with_ids:
+    accumulator = QuestionStatsAccumulator()
+    for position, user_log_data in enumerate(all_user_logs_with_ids):
         session_log_events = user_log_data.get('session_log_events')
-        if not session_log_events:
+        parsed_session = parsed_sessions[position] if parsed_sessions is not None else None
+        if not session_log_events or (parsed_sessions is not None and parsed_session is None):
             # print(f"Skipping user {user_log_data.get('userId')} due to missing session_log_events.")
             continue
 
-        session_metrics = _process_single_session_logs_for_batch_stats(session_log_events, questions_data_map)
-
-        for q_id, metrics in session_metrics.items():
-            if q_id in questions_data_map:
-                if metrics.get("time_spent", 0) > 0.1 : # Only consider attempted questions for time stats
-                    accumulated_times[q_id].append(metrics["time_spent"])
-                if metrics.get("answered_correctly") is not None:
-                    accumulated_correctness[q_id].append(metrics["answered_correctly"])
-                if metrics.get("time_spent", 0) > 0.1 :
-                     accumulated_tab_switches[q_id].append(metrics.get("tab_switches", 0))
-                     accumulated_answer_changes[q_id].append(metrics.get("answer_changes", 0))
-
-
-    batch_global_stats = {}
-
-    for q_id in questions_data_map.keys():
-        times = accumulated_times.get(q_id, [])
-        correctness = accumulated_correctness.get(q_id, [])
-        switches = accumulated_tab_switches.get(q_id, [])
-        changes = accumulated_answer_changes.get(q_id, [])
-
-        attempt_count = len(times) 
-
-        avg_time = float(np.mean(times)) if times else 0.0
-        std_dev_time = float(np.std(times)) if len(times) > 1 else 0.0
-        
-        accuracy = float(np.mean(correctness)) if correctness else 0.0 
-        
-        avg_tab_switches = float(np.mean(switches)) if switches else 0.0
-        avg_answer_changes = float(np.mean(changes)) if changes else 0.0
-
-        batch_global_stats[q_id] = {
-            "global_avg_time": round(avg_time, 3),
-            "global_std_dev_time": round(std_dev_time, 3),
-            "global_accuracy": round(accuracy, 3), 
-            "global_avg_tab_switches": round(avg_tab_switches, 3), 
-            "global_avg_answer_changes": round(avg_answer_changes, 3), 
-            "global_attempt_count": attempt_count, 
-        }
-    return batch_global_stats
+        accumulator.add_session(session_log_events, questions_data_map, parsed_session)
+
+    return accumulator.to_global_stats(questions_data_map)
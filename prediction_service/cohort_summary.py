@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+
+# --- Configuration ---
+# Share of a group's users that must be flagged for the group (e.g. an exam center) to be flagged
+FLAG_RATIO_THRESHOLD = float(os.environ.get('PREDICTION_FLAG_RATIO_THRESHOLD', '0.1'))
+# Largest top_k a request may ask for
+MAX_TOP_K = int(os.environ.get('PREDICTION_SUMMARY_MAX_TOP_K', '1000'))
+
+
+def parse_summary_options(options, num_users):
+    """
+    Validates the "summary" object of a batch request:
+        {"group_keys": [...] (optional, one key or null per user, e.g. the center id),
+         "probability_threshold": float (optional; flag users whose probability_cheat exceeds it instead of label 1),
+         "flag_ratio_threshold": float (optional, default FLAG_RATIO_THRESHOLD),
+         "top_k": int (optional; the k users with the highest probability_cheat)}
+    Returns:
+        tuple: (options dict, None) or, if the options are invalid, (None, error message).
+    """
+    if not isinstance(options, dict):
+        return None, "'summary' must be an object"
+
+    group_keys = options.get('group_keys')
+    if group_keys is not None:
+        if not isinstance(group_keys, list) or len(group_keys) != num_users:
+            return None, f"'summary.group_keys' must be a list with one key (or null) per user ({num_users})"
+        group_keys = [None if key is None else str(key) for key in group_keys]
+
+    probability_threshold = options.get('probability_threshold')
+    flag_ratio_threshold = options.get('flag_ratio_threshold', FLAG_RATIO_THRESHOLD)
+    top_k = options.get('top_k')
+    for name, value in (('probability_threshold', probability_threshold), ('flag_ratio_threshold', flag_ratio_threshold)):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1):
+            return None, f"'summary.{name}' must be a number between 0 and 1"
+    if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, int) or not 0 < top_k <= MAX_TOP_K):
+        return None, f"'summary.top_k' must be an integer between 1 and {MAX_TOP_K}"
+
+    return {
+        "group_keys": group_keys,
+        "probability_threshold": probability_threshold,
+        "flag_ratio_threshold": flag_ratio_threshold,
+        "top_k": top_k,
+    }, None
+
+
+def _prediction(user_id, label, probability, model_version):
+    return {"userId": user_id, "prediction_label": int(label), "probability_cheat": float(probability), "model_version": model_version}
+
+
+def summarize_batch(user_ids, user_errors, labels, probabilities, model_version, group_keys=None,
+                    probability_threshold=None, flag_ratio_threshold=FLAG_RATIO_THRESHOLD, top_k=None):
+    """
+    Summary of a scored batch in place of one prediction per user: the flagged users, the top_k users by
+    probability_cheat, and per-group counts and flag ratios, all computed on the prediction arrays.
+    Args:
+        user_ids (list): userId per user, in input order.
+        user_errors (dict): {position: error message} for users that were not scored.
+        labels, probabilities (np.ndarray): Scores of the other users, in input order.
+        model_version (str): Version of the model that produced the scores.
+        group_keys (list, optional): Group of each user (None for no group); users with an error count towards
+                                     their group's total, as every submitted session does.
+        probability_threshold (float, optional): Flag users with probability_cheat above it rather than label 1.
+        flag_ratio_threshold (float): A group is flagged when flagged / total reaches it.
+        top_k (int, optional): Also return the top_k scored users, highest probability_cheat first.
+    Returns:
+        dict: Counts, "flagged" and "errors" (prediction / error dicts in input order), "top_k", "groups"
+              ({key: {"total", "flagged", "flag_ratio"}}) and "flagged_groups".
+    """
+    num_users = len(user_ids)
+    scored = np.ones(num_users, dtype=bool)
+    scored[list(user_errors)] = False
+    scored_positions = np.flatnonzero(scored)
+
+    labels = np.asarray(labels, dtype=np.int64)
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    flagged = labels == 1 if probability_threshold is None else probabilities > probability_threshold
+    flagged_positions = scored_positions[flagged]
+
+    summary = {
+        "num_users": num_users,
+        "num_scored": len(scored_positions),
+        "num_errors": len(user_errors),
+        "num_flagged": len(flagged_positions),
+        "model_version": model_version,
+        "flagged": [_prediction(user_ids[position], labels[row], probabilities[row], model_version)
+                    for position, row in zip(flagged_positions.tolist(), np.flatnonzero(flagged).tolist())],
+        "errors": [{"userId": user_ids[position], "error": user_errors[position]} for position in sorted(user_errors)],
+    }
+
+    if top_k:
+        rows = np.argsort(-probabilities, kind='stable')[:top_k].tolist()
+        summary["top_k"] = [_prediction(user_ids[scored_positions[row]], labels[row], probabilities[row], model_version) for row in rows]
+
+    if group_keys is not None:
+        # None (no group) is kept out of np.unique, which cannot order it against strings: its users get code -1
+        in_group = np.array([key is not None for key in group_keys], dtype=bool)
+        keys, first_positions, group_codes = np.unique(np.array([key for key in group_keys if key is not None], dtype=str),
+                                                       return_index=True, return_inverse=True)
+        order = np.argsort(first_positions, kind='stable') # groups in order of first appearance
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        keys = keys[order]
+        codes = np.full(num_users, -1, dtype=np.int64)
+        codes[in_group] = ranks[group_codes]
+        totals = np.bincount(codes[in_group], minlength=len(keys))
+        flagged_mask = np.zeros(num_users, dtype=bool)
+        flagged_mask[flagged_positions] = True
+        flagged_counts = np.bincount(codes[in_group & flagged_mask], minlength=len(keys))
+        flag_ratios = flagged_counts / np.maximum(totals, 1)
+
+        summary["groups"] = {key: {"total": int(total), "flagged": int(count), "flag_ratio": float(ratio)}
+                             for key, total, count, ratio in zip(keys.tolist(), totals.tolist(), flagged_counts.tolist(), flag_ratios.tolist())}
+        summary["flagged_groups"] = [key for key, total, ratio in zip(keys.tolist(), totals.tolist(), flag_ratios.tolist())
+                                     if total > 0 and ratio >= flag_ratio_threshold]
+    return summary
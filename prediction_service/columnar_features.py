@@ -0,0 +1,397 @@
+import warnings
+import numpy as np
+
+from event_decoding import (
+    decode_timestamps_us, decode_activity, US_PER_SECOND, EVENT_OTHER,
+    EVENT_TEST_STARTED, EVENT_SELECTED_QUESTION, EVENT_SELECTED_OPTION,
+    EVENT_CLEARED_OPTION, EVENT_TAB_SWITCHED, EVENT_SUBMITTED_TEST,
+)
+from extract_features import FEATURE_NAMES_IN_ORDER
+from calculate_global_stats import QuestionStatsAccumulator
+
+FAST_Z_SCORE_THRESHOLD = -1.5
+MIN_TIME_FOR_GLOBAL_STATS = 0.1
+
+_FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_NAMES_IN_ORDER)}
+
+
+class ColumnarBatch:
+    """
+    A whole batch of sessions flattened into parallel NumPy columns, one entry per parseable
+    event, sorted by (user, timestamp). Computes the batch global stats and the session
+    feature matrix with grouped array operations instead of a per-session Python loop.
+
+    Columns:
+        user_index (int64): Position of the event's user in the batch.
+        timestamps_us (int64): Event time in microseconds since the epoch.
+        event_codes (int8): One of the EVENT_* codes.
+        question_index (int32): Position of `location` in questions_data_map, -1 if not a question of this test.
+        option_index (int64): Option picked by a "Selected option" event; only meaningful where option_valid.
+        option_valid (bool): Whether option_index holds a parsed option.
+
+    user_errors maps the position of users whose events could not be decoded to an error message, as the reference
+    engine reports them; their events are left out, so they count as sessions without events.
+    """
+
+    def __init__(self, num_users, question_ids, correct_answers, user_index, timestamps_us,
+                 event_codes, question_index, option_index, option_valid, user_errors=None):
+        order = np.lexsort((timestamps_us, user_index)) # stable, so ties keep log order like list.sort
+        self.num_users = num_users
+        self.question_ids = list(question_ids)
+        self.correct_answers = correct_answers
+        self.user_index = np.asarray(user_index, dtype=np.int64)[order]
+        self.timestamps_us = np.asarray(timestamps_us, dtype=np.int64)[order]
+        self.event_codes = np.asarray(event_codes, dtype=np.int8)[order]
+        self.question_index = np.asarray(question_index, dtype=np.int32)[order]
+        self.option_index = np.asarray(option_index, dtype=np.int64)[order]
+        self.option_valid = np.asarray(option_valid, dtype=bool)[order]
+        self.user_errors = user_errors or {}
+        self._question_metrics = None
+
+    @classmethod
+    def from_user_logs(cls, all_user_logs_with_ids, questions_data_map):
+        """
+        Flattens request-shaped user logs into columns.
+        Args:
+            all_user_logs_with_ids: List of dicts, e.g., [{'userId': 'id1', 'session_log_events': [...]}, ...]
+            questions_data_map: Dict mapping question_id to question details.
+        Returns:
+            ColumnarBatch
+        """
+        question_ids = list(questions_data_map.keys())
+        question_position = {q_id: i for i, q_id in enumerate(question_ids)}
+        correct_answers = [questions_data_map[q_id].get("correct_answer") for q_id in question_ids]
+
+        logs, timestamps, user_index, user_errors = [], [], [], {}
+        for position, user_log_data in enumerate(all_user_logs_with_ids):
+            session_log_events = user_log_data.get('session_log_events') or ()
+            try:
+                user_timestamps = [log.get("timestamp") for log in session_log_events]
+            except Exception as e: # e.g. events that are not objects
+                user_errors[position] = f"Error during processing for this user: {str(e)}"
+                continue
+            logs.extend(session_log_events)
+            timestamps.extend(user_timestamps)
+            user_index.extend([position] * len(user_timestamps))
+
+        try:
+            timestamps_us, parseable = decode_timestamps_us(timestamps)
+        except OverflowError: # an epoch time beyond int64 microseconds: decode per user to find whose
+            timestamps_us, parseable = _decode_timestamps_per_user(timestamps, user_index, user_errors)
+
+        # Errors per user, as decode_events and parse_records raise them: only events with a parseable timestamp are
+        # decoded, and only question selections and test starts need a hashable location
+        event_codes, question_index, option_index, option_valid = [], [], [], []
+        for log, position, is_parseable in zip(logs, user_index, parseable.tolist()):
+            code, option, q_index = EVENT_OTHER, None, -1
+            if is_parseable and position not in user_errors:
+                try:
+                    code, option = decode_activity(log.get("activity_text") or "")
+                    try:
+                        q_index = question_position.get(log.get("location"), -1)
+                    except TypeError: # unhashable location: an error only where parse_records looks it up
+                        if code == EVENT_SELECTED_QUESTION or code == EVENT_TEST_STARTED:
+                            raise
+                except Exception as e:
+                    user_errors[position] = f"Error during processing for this user: {str(e)}"
+            event_codes.append(code)
+            question_index.append(q_index)
+            option_index.append(option if option is not None else 0)
+            option_valid.append(option is not None)
+
+        user_index = np.asarray(user_index, dtype=np.int64)
+        keep = parseable
+        if user_errors:
+            failed = np.zeros(len(all_user_logs_with_ids), dtype=bool)
+            failed[list(user_errors)] = True
+            keep = parseable & ~failed[user_index]
+        return cls(len(all_user_logs_with_ids), question_ids, correct_answers, user_index[keep], timestamps_us[keep],
+                   np.asarray(event_codes, dtype=np.int8)[keep], np.asarray(question_index, dtype=np.int32)[keep],
+                   np.asarray(option_index, dtype=np.int64)[keep], np.asarray(option_valid, dtype=bool)[keep], user_errors)
+
+    # --- Per-question metrics, shape (num_users, num_questions) ---
+    def question_metrics(self):
+        """
+        Runs the session state machine of session_parser.parse_session over every event at once.
+        Returns:
+            dict of (num_users, num_questions) arrays: time_spent, tab_switches, answer_changes,
+            is_attempted, is_revisit, answered_correctly (float; NaN where the reference gives None).
+        """
+        if self._question_metrics is not None:
+            return self._question_metrics
+
+        num_users, num_questions = self.num_users, len(self.question_ids)
+        n = len(self.event_codes)
+        users, codes, q_idx = self.user_index, self.event_codes, self.question_index
+        positions = np.arange(n)
+
+        first_in_user, last_in_user = _group_boundaries(users)
+
+        is_anchor = (codes == EVENT_SELECTED_QUESTION) | (codes == EVENT_TEST_STARTED)
+        is_reset = ~is_anchor & ((codes == EVENT_SUBMITTED_TEST) | last_in_user)
+
+        # Index of the anchor (question selection / test start) that is current after each event, -1 for none
+        state_change = is_anchor | is_reset | first_in_user
+        last_change = np.maximum.accumulate(np.where(state_change, positions, 0))
+        anchor_after = np.where(is_anchor, positions, -1)[last_change]
+        anchor_before = np.full(n, -1, dtype=np.int64)
+        anchor_before[1:] = anchor_after[:-1]
+        anchor_before[first_in_user] = -1
+
+        current_q = np.where(anchor_after >= 0, q_idx[np.maximum(anchor_after, 0)], -1)
+        previous_q = np.where(anchor_before >= 0, q_idx[np.maximum(anchor_before, 0)], -1)
+        cell = users * num_questions + current_q
+        size = num_users * num_questions
+
+        # Time accrues to the previous question whenever a new anchor or a reset is reached
+        accrues = (is_anchor | is_reset) & (previous_q >= 0)
+        elapsed = (self.timestamps_us[accrues] - self.timestamps_us[anchor_before[accrues]]) / US_PER_SECOND
+        time_spent = np.bincount(users[accrues] * num_questions + previous_q[accrues],
+                                 weights=np.maximum(0, elapsed), minlength=size)
+
+        counted = current_q >= 0
+        is_attempted = np.bincount(cell[counted], minlength=size) > 0
+        tab_switches = np.bincount(cell[counted & (codes == EVENT_TAB_SWITCHED)], minlength=size)
+        answer_changes = np.bincount(cell[counted & (codes == EVENT_CLEARED_OPTION)], minlength=size)
+
+        # A selection is a revisit when the question was already current before it
+        anchors_on_q = np.flatnonzero(is_anchor & counted)
+        anchor_cells = cell[anchors_on_q]
+        first_anchor = np.ones(len(anchors_on_q), dtype=bool)
+        if len(anchors_on_q):
+            by_cell = np.argsort(anchor_cells, kind="stable")
+            repeat = np.zeros(len(anchors_on_q), dtype=bool)
+            repeat[1:] = anchor_cells[by_cell][1:] == anchor_cells[by_cell][:-1]
+            first_anchor[by_cell] = ~repeat
+        revisits = anchors_on_q[~first_anchor & (codes[anchors_on_q] == EVENT_SELECTED_QUESTION)]
+        is_revisit = np.zeros(size, dtype=bool)
+        is_revisit[cell[revisits]] = True
+
+        # The last "Selected option"/"Cleared option" on a question decides its final answer
+        answer_events = np.flatnonzero(counted & ((codes == EVENT_SELECTED_OPTION) | (codes == EVENT_CLEARED_OPTION)))
+        final_event = np.full(size, -1, dtype=np.int64)
+        final_event[cell[answer_events]] = answer_events # later events overwrite earlier ones
+        has_answer = final_event >= 0
+        answer_event = final_event[has_answer]
+        answer_valid = (codes[answer_event] == EVENT_SELECTED_OPTION) & self.option_valid[answer_event]
+        answer_value = self.option_index[answer_event]
+
+        # Non-numeric references never equal an int option, so they grade as incorrect like in the reference
+        correct_known = np.array([ref is not None for ref in self.correct_answers], dtype=bool)
+        correct_value = np.array([
+            ref if isinstance(ref, (int, float, np.number)) else np.nan for ref in self.correct_answers
+        ], dtype=np.float64)
+        answer_cells = np.flatnonzero(has_answer)
+        answer_q = answer_cells % num_questions
+        answered_correctly = np.full(size, np.nan)
+        answered_correctly[answer_cells] = np.where(
+            answer_valid & correct_known[answer_q], (answer_value == correct_value[answer_q]).astype(np.float64), np.nan
+        )
+
+        shape = (num_users, num_questions)
+        self._question_metrics = {
+            "time_spent": time_spent.reshape(shape),
+            "tab_switches": tab_switches.reshape(shape),
+            "answer_changes": answer_changes.reshape(shape),
+            "is_attempted": is_attempted.reshape(shape),
+            "is_revisit": is_revisit.reshape(shape),
+            "answered_correctly": answered_correctly.reshape(shape),
+        }
+        return self._question_metrics
+
+    def stats_accumulator(self):
+        """
+        The batch's QuestionStatsAccumulator, with each question's moments computed column-wise.
+        """
+        metrics = self.question_metrics()
+        counted = metrics["time_spent"] > MIN_TIME_FOR_GLOBAL_STATS
+        times = np.where(counted, metrics["time_spent"], np.nan)
+        correctness = np.where(counted, metrics["answered_correctly"], np.nan)
+
+        attempt_counts = counted.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_times = np.where(attempt_counts > 0, np.nansum(times, axis=0) / attempt_counts, 0.0)
+        time_m2 = np.nansum((times - avg_times) ** 2, axis=0)
+        correctness_counts = (~np.isnan(correctness)).sum(axis=0)
+        correct_sums = np.nansum(correctness, axis=0)
+        switch_sums = (metrics["tab_switches"] * counted).sum(axis=0)
+        change_sums = (metrics["answer_changes"] * counted).sum(axis=0)
+
+        return QuestionStatsAccumulator({
+            q_id: [int(attempt_counts[q]), float(avg_times[q]), float(time_m2[q]), int(correctness_counts[q]),
+                   int(correct_sums[q]), int(switch_sums[q]), int(change_sums[q])]
+            for q, q_id in enumerate(self.question_ids)
+        })
+
+    def global_stats(self):
+        """
+        Same dictionary as calculate_global_stats.compute_batch_global_stats, computed column-wise.
+        """
+        return self.stats_accumulator().to_global_stats(dict.fromkeys(self.question_ids))
+
+    def feature_matrix(self, current_batch_global_stats):
+        """
+        Computes the session features of every user in the batch.
+        Args:
+            current_batch_global_stats (dict): Global stats for the current batch/test.
+        Returns:
+            np.ndarray: (num_users, len(FEATURE_NAMES_IN_ORDER)) float64 matrix matching aggregate_features.
+                        Users without any parseable event get an all-zero row. Sums run in a different
+                        order than pandas, so a value sitting on a rounding tie can differ by 1e-4.
+        """
+        metrics = self.question_metrics()
+        num_users = self.num_users
+        features = np.zeros((num_users, len(FEATURE_NAMES_IN_ORDER)))
+
+        def put(name, values):
+            features[:, _FEATURE_INDEX[name]] = values
+
+        # Overall timing, from the sorted event columns
+        users, codes, ts = self.user_index, self.event_codes, self.timestamps_us
+        has_events, start, end = _first_and_last_per_user(users, ts, num_users)
+        total_duration = (end - start) / US_PER_SECOND
+
+        answers = codes == EVENT_SELECTED_OPTION
+        has_answer, first_answer, last_answer = _first_and_last_per_user(users[answers], ts[answers], num_users)
+        submits = codes == EVENT_SUBMITTED_TEST
+        has_submit, _, submit = _first_and_last_per_user(users[submits], ts[submits], num_users)
+
+        put("total_duration", total_duration)
+        put("time_until_first_answer", np.where(has_answer, (first_answer - start) / US_PER_SECOND, total_duration))
+        answered_before_submit = has_submit & has_answer & (last_answer <= submit)
+        put("time_between_last_answer_and_submit", np.where(answered_before_submit, (submit - last_answer) / US_PER_SECOND, 0.0))
+
+        # Aggregated per-question metrics; questions the user never reached are NaN and drop out
+        attempted = metrics["is_attempted"]
+        num_attempted = attempted.sum(axis=1)
+        times = np.where(attempted, metrics["time_spent"], np.nan)
+        correctness = np.where(attempted, metrics["answered_correctly"], np.nan)
+        z_scores = np.where(attempted, self._time_z_scores(metrics["time_spent"], current_batch_global_stats), np.nan)
+        tab_switches = np.where(attempted, metrics["tab_switches"], 0)
+        answer_changes = np.where(attempted, metrics["answer_changes"], 0)
+
+        with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # all-NaN rows; those users are masked out below
+            any_attempted = num_attempted > 0
+            put("mean_time_per_question", np.where(any_attempted, np.nanmean(times, axis=1), 0.0))
+            put("median_time_per_question", np.where(any_attempted, np.nanmedian(times, axis=1), 0.0))
+            put("min_time_per_question", np.where(any_attempted, np.nanmin(times, axis=1), 0.0))
+            put("max_time_per_question", np.where(any_attempted, np.nanmax(times, axis=1), 0.0))
+            put("std_dev_time_per_question", np.where(num_attempted > 1, np.nanstd(times, axis=1, ddof=1), 0.0))
+
+            num_tab_switches = tab_switches.sum(axis=1)
+            num_answer_changes = answer_changes.sum(axis=1)
+            put("num_tab_switches", num_tab_switches)
+            put("num_answer_changes", num_answer_changes)
+            put("num_revisits", (metrics["is_revisit"] & attempted).sum(axis=1))
+            put("num_questions_attempted", num_attempted)
+
+            num_graded = (~np.isnan(correctness)).sum(axis=1)
+            accuracy = np.where(num_graded > 0, np.nanmean(correctness, axis=1), 0.0)
+            put("accuracy", accuracy)
+
+            num_z_scores = (~np.isnan(z_scores)).sum(axis=1)
+            put("mean_time_z_score", np.where(num_z_scores > 0, np.nanmean(z_scores, axis=1), 0.0))
+            put("min_time_z_score", np.where(num_z_scores > 0, np.nanmin(z_scores, axis=1), 0.0))
+            put("max_time_z_score", np.where(num_z_scores > 0, np.nanmax(z_scores, axis=1), 0.0))
+            put("std_dev_time_z_score", np.where(num_z_scores > 1, np.nanstd(z_scores, axis=1, ddof=1), 0.0))
+
+            fast = z_scores < FAST_Z_SCORE_THRESHOLD
+            put("proportion_questions_fast", np.where(any_attempted, fast.sum(axis=1) / num_attempted, 0.0))
+            put("proportion_questions_correct_and_fast", np.where(any_attempted, (fast & (correctness == 1)).sum(axis=1) / num_attempted, 0.0))
+            put("proportion_questions_with_tab_switch", np.where(any_attempted, (tab_switches > 0).sum(axis=1) / num_attempted, 0.0))
+            put("answer_change_rate", np.where(any_attempted, (answer_changes > 0).sum(axis=1) / num_attempted, 0.0))
+
+            # Deviation features using current_batch_global_stats
+            expected_accuracy = np.array([
+                current_batch_global_stats[q_id]["global_accuracy"]
+                if q_id in current_batch_global_stats and "global_accuracy" in current_batch_global_stats[q_id] else np.nan
+                for q_id in self.question_ids
+            ], dtype=np.float64)
+            expected_accuracy = np.where(attempted, expected_accuracy, np.nan)
+            num_expected = (~np.isnan(expected_accuracy)).sum(axis=1)
+            avg_expected_accuracy = np.where(num_expected > 0, np.nanmean(expected_accuracy, axis=1), 0.0)
+            put("accuracy_deviation", np.where(any_attempted, accuracy - avg_expected_accuracy, 0.0))
+
+            expected_switches = self._stat_column(current_batch_global_stats, "global_avg_tab_switches")
+            expected_changes = self._stat_column(current_batch_global_stats, "global_avg_answer_changes")
+            put("tab_switch_deviation", num_tab_switches - (attempted * expected_switches).sum(axis=1))
+            put("answer_change_deviation", num_answer_changes - (attempted * expected_changes).sum(axis=1))
+
+        features[~has_events] = 0.0
+        features[~np.isfinite(features)] = 0.0
+        return np.round(features, 4)
+
+    def _stat_column(self, current_batch_global_stats, key):
+        return np.array([current_batch_global_stats.get(q_id, {}).get(key, 0) for q_id in self.question_ids], dtype=np.float64)
+
+    def _time_z_scores(self, time_spent, current_batch_global_stats):
+        """Vectorized extract_features.calculate_time_z_score; NaN for questions without stats."""
+        in_stats = np.array([q_id in current_batch_global_stats for q_id in self.question_ids], dtype=bool)
+        means = self._stat_column(current_batch_global_stats, "global_avg_time")
+        std_devs = self._stat_column(current_batch_global_stats, "global_std_dev_time")
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            z_scores = np.where(
+                std_devs > 1e-6, (time_spent - means) / np.where(std_devs > 1e-6, std_devs, 1.0),
+                np.where(time_spent > means + 1e-6, 5.0, np.where(time_spent < means - 1e-6, -5.0, 0.0)),
+            )
+        return np.where(in_stats, z_scores, np.nan)
+
+
+def _group_boundaries(groups):
+    """Masks of the first and last element of each run in a sorted group column."""
+    first = np.ones(len(groups), dtype=bool)
+    last = np.ones(len(groups), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    last[:-1] = first[1:]
+    return first, last
+
+
+def _first_and_last_per_user(users, values, num_users):
+    """(has_any, first_value, last_value) per user for a column sorted by (user, timestamp)."""
+    first, last = _group_boundaries(users)
+    has_any = np.zeros(num_users, dtype=bool)
+    first_values = np.zeros(num_users, dtype=np.int64)
+    last_values = np.zeros(num_users, dtype=np.int64)
+    has_any[users] = True
+    first_values[users[first]] = values[first]
+    last_values[users[last]] = values[last]
+    return has_any, first_values, last_values
+
+
+def _decode_timestamps_per_user(timestamps, user_index, user_errors):
+    """decode_timestamps_us one user at a time; users whose timestamps fail are added to user_errors, their events unparseable."""
+    timestamps_us = np.zeros(len(timestamps), dtype=np.int64)
+    parseable = np.zeros(len(timestamps), dtype=bool)
+    start = 0
+    while start < len(timestamps):
+        end = start
+        while end < len(timestamps) and user_index[end] == user_index[start]:
+            end += 1
+        try:
+            timestamps_us[start:end], parseable[start:end] = decode_timestamps_us(timestamps[start:end])
+        except OverflowError as e:
+            user_errors[user_index[start]] = f"Error during processing for this user: {str(e)}"
+        start = end
+    return timestamps_us, parseable
+
+
+def compute_columnar_features(all_user_logs_with_ids, questions_data_map, current_batch_global_stats=None):
+    """
+    Columnar counterpart of compute_batch_global_stats + get_per_question_metrics + aggregate_features
+    for a whole batch.
+    Args:
+        all_user_logs_with_ids: List of dicts, e.g., [{'userId': 'id1', 'session_log_events': [...]}, ...]
+        questions_data_map: Dict mapping question_id to question details.
+        current_batch_global_stats: Stats to score against; computed from this batch when None.
+    Returns:
+        tuple: (batch_global_stats dict, QuestionStatsAccumulator of this batch,
+                feature matrix of shape (len(all_user_logs_with_ids), n_features),
+                {position: error message} for users whose events could not be decoded)
+    """
+    batch = ColumnarBatch.from_user_logs(all_user_logs_with_ids, questions_data_map)
+    stats_accumulator = batch.stats_accumulator()
+    if current_batch_global_stats is None:
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+    return current_batch_global_stats, stats_accumulator, batch.feature_matrix(current_batch_global_stats), batch.user_errors
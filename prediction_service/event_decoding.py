@@ -0,0 +1,157 @@
+import datetime
+import functools
+import numbers
+import os
+import re
+from operator import itemgetter
+
+import numpy as np
+
+# --- Event Codes ---
+EVENT_OTHER = 0
+EVENT_TEST_STARTED = 1
+EVENT_SELECTED_QUESTION = 2
+EVENT_SELECTED_OPTION = 3
+EVENT_CLEARED_OPTION = 4
+EVENT_TAB_SWITCHED = 5
+EVENT_SUBMITTED_TEST = 6
+
+US_PER_SECOND = 1_000_000
+
+# Columnar event encodings (score_offline exports, wire_encoding request bodies): option_index and location
+# are stored as int32 columns, with these values for "no option" and "no location"
+NO_OPTION = np.iinfo(np.int32).min
+NO_LOCATION = -1
+
+# Distinct activity texts remembered by decode_activity ("Selected option N for question M" varies per test)
+ACTIVITY_CACHE_SIZE = int(os.environ.get('PREDICTION_ACTIVITY_CACHE_SIZE', '65536'))
+
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_EPOCH_NAIVE = datetime.datetime(1970, 1, 1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+_NAT = np.iinfo(np.int64).min
+# What decode_timestamps_us hands to NumPy: datetime64 also takes 'now', 'today', partial dates, padding, offsets
+# and year 0, none of which fromisoformat accepts
+_PLAIN_UTC_TIMESTAMP = re.compile(r'(?!0000)[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(?:\.[0-9]{1,6})?Z')
+
+timestamp_key = itemgetter(0) # sort key of event records
+
+
+# --- Timestamps ---
+def parse_timestamp(ts_str):
+    """Parses an ISO-8601 timestamp to a datetime, or None. Kept for callers that need datetime objects."""
+    if not ts_str: return None
+    if ts_str.endswith('Z'): ts_str = ts_str[:-1] + '+00:00'
+    try: return datetime.datetime.fromisoformat(ts_str)
+    except (ValueError, TypeError):
+        return None
+
+
+def timestamp_to_epoch_us(ts):
+    """Converts a parsed datetime to integer microseconds since the epoch (naive values are taken as UTC)."""
+    epoch = _EPOCH_NAIVE if ts.tzinfo is None else _EPOCH_UTC
+    return (ts - epoch) // _ONE_MICROSECOND
+
+
+def decode_timestamp_us(value):
+    """
+    Converts one event timestamp to integer microseconds since the epoch, or None if it cannot be parsed.
+    Numbers are taken as epoch milliseconds (JavaScript Date.getTime()); strings as ISO-8601, where
+    values without an offset are taken as UTC.
+    """
+    if isinstance(value, str):
+        if value.endswith('Z'): value = value[:-1] + '+00:00' # fromisoformat only takes 'Z' from Python 3.11
+        try: ts = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        return (ts - (_EPOCH_NAIVE if ts.tzinfo is None else _EPOCH_UTC)) // _ONE_MICROSECOND
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return int(round(value * 1000)) if value == value else None # NaN is not a time
+    return None
+
+
+def decode_timestamps_us(values):
+    """
+    Bulk decode_timestamp_us. The usual input, all plain YYYY-MM-DDTHH:MM:SS[.ffffff]Z strings, is parsed by
+    NumPy's datetime64 parser in one call; anything else, or any string it rejects, goes through
+    decode_timestamp_us per value.
+    Returns:
+        tuple: (timestamps_us int64 array, valid bool array), both aligned with values.
+    """
+    num_values = len(values)
+    is_plain = _PLAIN_UTC_TIMESTAMP.fullmatch
+    if num_values and all(type(value) is str and is_plain(value) for value in values):
+        try:
+            timestamps_us = np.array([value[:-1] for value in values]).astype('datetime64[us]').view(np.int64)
+            return timestamps_us, timestamps_us != _NAT
+        except ValueError:
+            pass
+
+    timestamps_us = np.zeros(num_values, dtype=np.int64)
+    valid = np.zeros(num_values, dtype=bool)
+    for i, value in enumerate(values):
+        ts = decode_timestamp_us(value)
+        if ts is not None:
+            timestamps_us[i] = ts
+            valid[i] = True
+    return timestamps_us, valid
+
+
+# --- Activity Texts ---
+@functools.lru_cache(maxsize=ACTIVITY_CACHE_SIZE)
+def decode_activity(activity):
+    """
+    Maps an activity_text to (event_code, option_index). option_index is only set for
+    "Selected option N ..." events and is None when N is not an integer. Memoized, since
+    a test only has a few hundred distinct activity texts.
+    """
+    if activity.startswith("Selected question"): return EVENT_SELECTED_QUESTION, None
+    if activity.startswith("Selected option"):
+        try: return EVENT_SELECTED_OPTION, int(activity.split(" ")[2])
+        except (IndexError, ValueError): return EVENT_SELECTED_OPTION, None
+    if activity.startswith("Cleared option"): return EVENT_CLEARED_OPTION, None
+    if activity == "Tab Switched": return EVENT_TAB_SWITCHED, None
+    if activity == "Submitted Test": return EVENT_SUBMITTED_TEST, None
+    if activity == "Test Started": return EVENT_TEST_STARTED, None
+    return EVENT_OTHER, None
+
+
+# --- Event Records ---
+def decode_events(session_log_events):
+    """
+    Decodes one session's log events into compact records, in log order.
+    Args:
+        session_log_events (list): List of log event dictionaries.
+    Returns:
+        list: (timestamp_us, event_code, option_index, location) tuples for the events with a
+              parseable timestamp. Sort them with key=timestamp_key.
+    """
+    # Per value: for a single session's few dozen events this beats the NumPy round trip of decode_timestamps_us
+    records = []
+    for log in session_log_events:
+        ts = decode_timestamp_us(log.get("timestamp"))
+        if ts is not None:
+            code, option = decode_activity(log.get("activity_text") or "")
+            records.append((ts, code, option, log.get("location")))
+    return records
+
+
+def columns_to_records(timestamps_us, event_codes, options, locations, location_values):
+    """
+    Rebuilds decode_events records from columnar slices (lists or arrays) of one or more sessions.
+    Args:
+        options: Option indexes, NO_OPTION for None.
+        locations: Indexes into location_values, NO_LOCATION for None.
+        location_values (list): The distinct locations.
+    Returns:
+        list: (timestamp_us, event_code, option_index, location) tuples.
+    """
+    if isinstance(timestamps_us, np.ndarray):
+        timestamps_us, event_codes, options, locations = (
+            timestamps_us.tolist(), event_codes.tolist(), options.tolist(), locations.tolist())
+    return list(zip(
+        timestamps_us,
+        event_codes,
+        [None if option == NO_OPTION else option for option in options],
+        [None if index == NO_LOCATION else location_values[index] for index in locations],
+    ))
@@ -1,11 +1,11 @@
 import os
 import json
-import datetime
 import numpy as np
-import pandas as pd
-from collections import defaultdict
 import math
 
+from session_parser import parse_session
+from event_decoding import US_PER_SECOND
+
 FEATURE_NAMES_IN_ORDER = [
     # Overall Timing
     "total_duration", 
@@ -47,14 +47,6 @@ FEATURE_NAMES_IN_ORDER = [
 ]
 
 # --- Helper Functions ---
-def parse_timestamp(ts_str):
-    if not ts_str: return None
-    if ts_str.endswith('Z'): ts_str = ts_str[:-1] + '+00:00'
-    try: return datetime.datetime.fromisoformat(ts_str)
-    except (ValueError, TypeError): 
-        # print(f"Warning: Could not parse timestamp {ts_str}") # Silenced for library use
-        return None
-
 def calculate_time_z_score(user_time, q_id, batch_or_global_stats):
 
     if q_id not in batch_or_global_stats: return 0.0
@@ -73,103 +65,31 @@ def calculate_time_z_score(user_time, q_id, batch_or_global_stats):
     else:
         return 0.0
 
-def get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats):
+def get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats, parsed_session=None):
     """
     Processes logs for one session to get detailed metrics per question.
     Args:
         session_log_events (list): List of log event dictionaries for the session.
         questions_data_map (dict): Map of question_id to question details for the current test.
         current_batch_global_stats (dict): Global stats calculated for the current batch/test.
+        parsed_session (ParsedSession, optional): Session already parsed by parse_session.
     Returns:
         pd.DataFrame: DataFrame with per-question metrics.
     """
-    if not session_log_events: return pd.DataFrame()
-
-    parsed_logs = []
-    for log in session_log_events: 
-        ts = parse_timestamp(log.get("timestamp"))
-        if ts: parsed_logs.append({**log, "timestamp_dt": ts})
-    
-    if not parsed_logs: return pd.DataFrame() 
-    parsed_logs.sort(key=lambda x: x["timestamp_dt"])
-
-    q_metrics = defaultdict(lambda: {
-        "q_id": None, "time_spent": 0.0, "answered_correctly": None,
-        "answer_changes": 0, "tab_switches": 0, "is_attempted": False,
-        "global_avg_time": None, "global_std_dev_time": None,
-        "global_accuracy": None, "time_z_score": None, "is_revisit": False
-    })
-
-    last_q_selection_time = None
-    current_q_id = None
-    final_answer_for_q = {}
-    visited_q_ids = set()
-    last_selected_q_idx = -1
-
-    for i, log in enumerate(parsed_logs):
-        activity = log.get("activity_text", "")
-        timestamp = log["timestamp_dt"]
-        location = log.get("location")
-
-        is_q_selection = activity.startswith("Selected question")
-        is_test_start = activity == "Test Started"
-
-        if is_q_selection or is_test_start:
-            new_q_id = location
-            if current_q_id and last_q_selection_time and current_q_id in questions_data_map:
-                time_diff = max(0, (timestamp - last_q_selection_time).total_seconds())
-                q_metrics[current_q_id]["time_spent"] += time_diff
-            
-            last_q_selection_time = timestamp
-            current_q_id = new_q_id
-            
-            if is_q_selection and current_q_id in questions_data_map: # Process only if valid q_id
-                q_metrics[current_q_id]["q_id"] = current_q_id
-                if current_q_id in visited_q_ids:
-                     q_metrics[current_q_id]["is_revisit"] = True
-                visited_q_ids.add(current_q_id)
-                try: last_selected_q_idx = int(activity.split()[-1]) # Not used
-                except: pass
-
-        elif activity == "Submitted Test" or i == len(parsed_logs) - 1:
-             if current_q_id and last_q_selection_time and current_q_id in questions_data_map:
-                time_diff = max(0, (timestamp - last_q_selection_time).total_seconds())
-                q_metrics[current_q_id]["time_spent"] += time_diff
-             current_q_id = None
-             last_q_selection_time = None
-
-        if current_q_id and current_q_id in questions_data_map: 
-            if q_metrics[current_q_id]["q_id"] is None: 
-                 q_metrics[current_q_id]["q_id"] = current_q_id
-                 visited_q_ids.add(current_q_id)
-            
-            q_metrics[current_q_id]["is_attempted"] = True
-            if activity == "Tab Switched":
-                 q_metrics[current_q_id]["tab_switches"] += 1
-            elif activity.startswith("Cleared option"):
-                 q_metrics[current_q_id]["answer_changes"] += 1
-                 final_answer_for_q[current_q_id] = None
-            elif activity.startswith("Selected option"):
-                 try:
-                     option_idx = int(activity.split(" ")[2])
-                     final_answer_for_q[current_q_id] = option_idx
-                 except (IndexError, ValueError):
-                      final_answer_for_q[current_q_id] = None
+    import pandas as pd # only the DataFrame interface needs pandas; scoring uses compute_per_question_metrics
+    if parsed_session is None:
+        if not session_log_events: return pd.DataFrame()
+        parsed_session = parse_session(session_log_events, questions_data_map)
 
     processed_metrics = []
-    for q_id_key, metrics_val in q_metrics.items():
-        if not q_id_key or q_id_key not in questions_data_map: 
-            continue 
-
-        question_details_from_map = questions_data_map[q_id_key]
-        metrics_val["q_id"] = q_id_key 
-
-        last_answer = final_answer_for_q.get(q_id_key)
-        correct_ref = question_details_from_map.get("correct_answer")
-        if last_answer is not None and correct_ref is not None:
-            metrics_val["answered_correctly"] = 1 if last_answer == correct_ref else 0
-        else:
-            metrics_val["answered_correctly"] = None 
+    for q_id_key, metrics in parsed_session.question_metrics.items():
+        metrics_val = {
+            "q_id": q_id_key, "time_spent": metrics.time_spent, "answered_correctly": metrics.answered_correctly,
+            "answer_changes": metrics.answer_changes, "tab_switches": metrics.tab_switches,
+            "is_attempted": metrics.is_attempted,
+            "global_avg_time": None, "global_std_dev_time": None,
+            "global_accuracy": None, "time_z_score": None, "is_revisit": metrics.is_revisit
+        }
 
         if q_id_key in current_batch_global_stats: 
             gs = current_batch_global_stats[q_id_key]
@@ -184,7 +104,7 @@ def get_per_question_metrics(session_log_events, questions_data_map, current_bat
     return pd.DataFrame(processed_metrics)
 
 
-def aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map):
+def aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map, parsed_session=None):
     """
     Calculates session-level features from per-question metrics.
     Args:
@@ -192,37 +112,32 @@ def aggregate_features(per_question_metrics_df, session_log_events, current_batc
         session_log_events (list): List of log event dictionaries for the session.
         current_batch_global_stats (dict): Global stats for the current batch/test.
         questions_data_map (dict): Map of question_id to question details for the current test.
+        parsed_session (ParsedSession, optional): Session already parsed by parse_session.
     Returns:
         dict: Dictionary of aggregated session features.
     """
     features = {name: 0.0 for name in FEATURE_NAMES_IN_ORDER} # Initialize with defaults
 
-    if not session_log_events:
-        # print("Warning: aggregate_features called with no session_log_events.")
-        return features # Return default initialized features
-
-    parsed_logs = []
-    for log_event in session_log_events: 
-        ts = parse_timestamp(log_event.get("timestamp"))
-        if ts: parsed_logs.append({**log_event, "timestamp_dt": ts})
+    if parsed_session is None:
+        if not session_log_events:
+            # print("Warning: aggregate_features called with no session_log_events.")
+            return features # Return default initialized features
+        parsed_session = parse_session(session_log_events, questions_data_map)
     
-    if not parsed_logs: 
+    if parsed_session.is_empty: 
         # print("Warning: aggregate_features found no parseable logs in session_log_events.")
         return features # Return default initialized features
-        
-    parsed_logs.sort(key=lambda x: x["timestamp_dt"])
 
-    start_time = parsed_logs[0]["timestamp_dt"]
-    end_time = parsed_logs[-1]["timestamp_dt"]
-    features["total_duration"] = (end_time - start_time).total_seconds()
+    start_time = parsed_session.start_time
+    features["total_duration"] = (parsed_session.end_time - start_time) / US_PER_SECOND
 
-    first_answer_log = next((l for l in parsed_logs if l.get("activity_text", "").startswith("Selected option")), None)
-    features["time_until_first_answer"] = (first_answer_log["timestamp_dt"] - start_time).total_seconds() if first_answer_log else features.get("total_duration", 0.0)
+    first_answer_time = parsed_session.first_answer_time
+    features["time_until_first_answer"] = (first_answer_time - start_time) / US_PER_SECOND if first_answer_time is not None else features.get("total_duration", 0.0)
 
-    submit_log = next((l for l in reversed(parsed_logs) if l.get("activity_text") == "Submitted Test"), None)
-    last_answer_log = next((l for l in reversed(parsed_logs) if l.get("activity_text", "").startswith("Selected option")), None)
-    if submit_log and last_answer_log and last_answer_log["timestamp_dt"] <= submit_log["timestamp_dt"]:
-        features["time_between_last_answer_and_submit"] = (submit_log["timestamp_dt"] - last_answer_log["timestamp_dt"]).total_seconds()
+    submit_time = parsed_session.submit_time
+    last_answer_time = parsed_session.last_answer_time
+    if submit_time is not None and last_answer_time is not None and last_answer_time <= submit_time:
+        features["time_between_last_answer_and_submit"] = (submit_time - last_answer_time) / US_PER_SECOND
     else:
          features["time_between_last_answer_and_submit"] = 0.0
 
@@ -292,12 +207,176 @@ def aggregate_features(per_question_metrics_df, session_log_events, current_batc
     
 
     for key in FEATURE_NAMES_IN_ORDER:
-        value = features.get(key, 0.0) 
-        if isinstance(value, (float, np.floating)) and not math.isnan(value) and not math.isinf(value):
-            features[key] = round(value, 4)
-        elif math.isnan(value) or math.isinf(value):
-            features[key] = 0.0 
-        else: 
-            features[key] = round(float(value), 4)
+        features[key] = _finalize_feature_value(features.get(key, 0.0))
             
-    return features
\ No newline at end of file
+    return features
+
+def _finalize_feature_value(value):
+    """Rounds a feature to 4 decimals and maps NaN/inf to 0. NumPy scalars round the NumPy way, as they always have."""
+    if isinstance(value, (float, np.floating)) and not math.isnan(value) and not math.isinf(value):
+        return round(value, 4)
+    elif math.isnan(value) or math.isinf(value):
+        return 0.0 
+    else: 
+        return round(float(value), 4)
+
+# --- Compact Per-Question Metrics ---
+# get_per_question_metrics and aggregate_features above are the reference implementation. The functions
+# below compute the same features from parallel NumPy arrays, without a dict per question and a DataFrame
+# per session; a DataFrame is only built on request, for debugging (PerQuestionMetrics.to_dataframe).
+
+FAST_Z_SCORE_THRESHOLD = -1.5
+
+
+class PerQuestionMetrics:
+    """
+    The rows of get_per_question_metrics for one session (questions attempted or viewed for more than 0.1s,
+    in the order they were first visited), one array per column. Missing correctness and z-scores are NaN.
+    """
+
+    __slots__ = ('q_ids', 'time_spent', 'answered_correctly', 'answer_changes', 'tab_switches',
+                 'is_attempted', 'is_revisit', 'time_z_score', 'global_stats')
+
+    def __len__(self):
+        return len(self.q_ids)
+
+    def to_dataframe(self):
+        """The DataFrame get_per_question_metrics returns for the same session."""
+        import pandas as pd
+        rows = []
+        for i, q_id in enumerate(self.q_ids):
+            gs = self.global_stats.get(q_id)
+            correct = self.answered_correctly[i]
+            rows.append({
+                "q_id": q_id, "time_spent": float(self.time_spent[i]),
+                "answered_correctly": None if np.isnan(correct) else int(correct),
+                "answer_changes": int(self.answer_changes[i]), "tab_switches": int(self.tab_switches[i]),
+                "is_attempted": bool(self.is_attempted[i]),
+                "global_avg_time": gs.get("global_avg_time") if gs is not None else None,
+                "global_std_dev_time": gs.get("global_std_dev_time") if gs is not None else None,
+                "global_accuracy": gs.get("global_accuracy") if gs is not None else None,
+                "time_z_score": float(self.time_z_score[i]) if gs is not None else None,
+                "is_revisit": bool(self.is_revisit[i]),
+            })
+        return pd.DataFrame(rows)
+
+
+def compute_per_question_metrics(parsed_session, current_batch_global_stats):
+    """
+    Compact counterpart of get_per_question_metrics.
+    Args:
+        parsed_session (ParsedSession): Session parsed by parse_session.
+        current_batch_global_stats (dict): Global stats calculated for the current batch/test.
+    Returns:
+        PerQuestionMetrics
+    """
+    q_ids, times, correct, changes, switches, attempted, revisits, z_scores = [], [], [], [], [], [], [], []
+    for q_id, metrics in parsed_session.question_metrics.items():
+        if not (metrics.is_attempted or metrics.time_spent > 0.1):
+            continue
+        q_ids.append(q_id)
+        times.append(metrics.time_spent)
+        correct.append(np.nan if metrics.answered_correctly is None else metrics.answered_correctly)
+        changes.append(metrics.answer_changes)
+        switches.append(metrics.tab_switches)
+        attempted.append(metrics.is_attempted)
+        revisits.append(metrics.is_revisit)
+        z_scores.append(calculate_time_z_score(metrics.time_spent, q_id, current_batch_global_stats)
+                        if q_id in current_batch_global_stats else np.nan)
+
+    per_question_metrics = PerQuestionMetrics()
+    per_question_metrics.q_ids = q_ids
+    per_question_metrics.time_spent = np.array(times, dtype=np.float64)
+    per_question_metrics.answered_correctly = np.array(correct, dtype=np.float64)
+    per_question_metrics.answer_changes = np.array(changes, dtype=np.int64)
+    per_question_metrics.tab_switches = np.array(switches, dtype=np.int64)
+    per_question_metrics.is_attempted = np.array(attempted, dtype=bool)
+    per_question_metrics.is_revisit = np.array(revisits, dtype=bool)
+    per_question_metrics.time_z_score = np.array(z_scores, dtype=np.float64)
+    per_question_metrics.global_stats = current_batch_global_stats
+    return per_question_metrics
+
+
+def aggregate_per_question_metrics(per_question_metrics, parsed_session, current_batch_global_stats):
+    """
+    Compact counterpart of aggregate_features. The values are the same, including their NumPy or Python
+    scalar types before rounding, so they also round the same way.
+    Returns:
+        list: Feature values ordered by FEATURE_NAMES_IN_ORDER.
+    """
+    if parsed_session.is_empty:
+        return [0.0] * len(FEATURE_NAMES_IN_ORDER)
+    features = dict.fromkeys(FEATURE_NAMES_IN_ORDER, 0.0)
+
+    start_time = parsed_session.start_time
+    features["total_duration"] = (parsed_session.end_time - start_time) / US_PER_SECOND
+
+    first_answer_time = parsed_session.first_answer_time
+    features["time_until_first_answer"] = (first_answer_time - start_time) / US_PER_SECOND if first_answer_time is not None else features["total_duration"]
+
+    submit_time = parsed_session.submit_time
+    last_answer_time = parsed_session.last_answer_time
+    if submit_time is not None and last_answer_time is not None and last_answer_time <= submit_time:
+        features["time_between_last_answer_and_submit"] = (submit_time - last_answer_time) / US_PER_SECOND
+
+    num_rows = len(per_question_metrics)
+    if num_rows:
+        times = per_question_metrics.time_spent
+        features["mean_time_per_question"] = times.mean()
+        features["median_time_per_question"] = np.median(times)
+        features["min_time_per_question"] = times.min()
+        features["max_time_per_question"] = times.max()
+        if num_rows > 1:
+            features["std_dev_time_per_question"] = times.std(ddof=1)
+
+        features["num_tab_switches"] = per_question_metrics.tab_switches.sum()
+        features["num_answer_changes"] = per_question_metrics.answer_changes.sum()
+        features["num_revisits"] = per_question_metrics.is_revisit.sum()
+        num_attempted = features["num_questions_attempted"] = per_question_metrics.is_attempted.sum()
+
+        correct = per_question_metrics.answered_correctly
+        graded = ~np.isnan(correct)
+        features["accuracy"] = correct[graded].mean() if graded.any() else 0.0
+
+        z_scores = per_question_metrics.time_z_score
+        has_z_score = ~np.isnan(z_scores)
+        valid_z_scores = z_scores[has_z_score]
+        if valid_z_scores.size:
+            features["mean_time_z_score"] = valid_z_scores.mean()
+            features["min_time_z_score"] = valid_z_scores.min()
+            features["max_time_z_score"] = valid_z_scores.max()
+        if valid_z_scores.size > 1:
+            features["std_dev_time_z_score"] = valid_z_scores.std(ddof=1)
+
+        if num_attempted > 0:
+            fast = z_scores < FAST_Z_SCORE_THRESHOLD # NaN compares False
+            features["proportion_questions_fast"] = fast.sum() / num_attempted
+            if (graded & has_z_score).any():
+                features["proportion_questions_correct_and_fast"] = ((correct == 1) & fast).sum() / num_attempted
+            features["proportion_questions_with_tab_switch"] = (per_question_metrics.tab_switches > 0).sum() / num_attempted
+            features["answer_change_rate"] = (per_question_metrics.answer_changes > 0).sum() / num_attempted
+
+        # Deviation features using current_batch_global_stats
+        attempted_q_ids = [q_id for q_id in per_question_metrics.q_ids if q_id is not None]
+        expected_accuracy_list = [current_batch_global_stats[q_id]["global_accuracy"] for q_id in attempted_q_ids
+                                  if q_id in current_batch_global_stats and "global_accuracy" in current_batch_global_stats[q_id]]
+        avg_expected_accuracy_for_attempted = np.mean(expected_accuracy_list) if expected_accuracy_list else 0.0
+        features["accuracy_deviation"] = features["accuracy"] - avg_expected_accuracy_for_attempted
+
+        total_expected_switches = sum(current_batch_global_stats.get(qid, {}).get("global_avg_tab_switches", 0) for qid in attempted_q_ids)
+        features["tab_switch_deviation"] = features["num_tab_switches"] - total_expected_switches
+
+        total_expected_changes = sum(current_batch_global_stats.get(qid, {}).get("global_avg_answer_changes", 0) for qid in attempted_q_ids)
+        features["answer_change_deviation"] = features["num_answer_changes"] - total_expected_changes
+
+    return [_finalize_feature_value(features[name]) for name in FEATURE_NAMES_IN_ORDER]
+
+
+def extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map):
+    """
+    Computes the features of an already parsed session (compute_per_question_metrics + aggregate_per_question_metrics).
+    Returns:
+        list: Feature values ordered by FEATURE_NAMES_IN_ORDER, equal to aggregate_features' values.
+    """
+    per_question_metrics = compute_per_question_metrics(parsed_session, current_batch_global_stats)
+    return aggregate_per_question_metrics(per_question_metrics, parsed_session, current_batch_global_stats)
@@ -0,0 +1,222 @@
+import json
+import os
+
+import numpy as np
+
+# --- Configuration ---
+# 'booster' scores through BoosterScorer; 'sklearn' keeps scaler.transform + model.predict_proba
+INFERENCE_PATH = os.environ.get('PREDICTION_INFERENCE_PATH', 'booster')
+# Largest probability difference from the scikit-learn path accepted by the start-up parity check
+PARITY_TOLERANCE = float(os.environ.get('PREDICTION_INFERENCE_PARITY_TOLERANCE', '1e-6'))
+
+COMPILED_FORMAT_VERSION = 1
+COMPILED_META_FILENAME = 'meta.json'
+
+
+class BoosterScorer:
+    """
+    Scaling and scoring without the scikit-learn wrappers. The StandardScaler is folded into one affine
+    transform, x * scale_factor + offset, and the XGBClassifier's Booster predicts in place on the
+    resulting contiguous float32 array, with no DataFrame, no feature-name validation and no DMatrix.
+
+    The transform runs in float64 and only its result is cast to float32, the precision XGBoost compares
+    against its split thresholds, so the values match what the model was trained on.
+    """
+
+    def __init__(self, booster, scale_factor, offset, iteration_range=(0, 0), threshold=0.5):
+        self.booster = booster
+        self.scale_factor = np.ascontiguousarray(scale_factor, dtype=np.float64)
+        self.offset = np.ascontiguousarray(offset, dtype=np.float64)
+        self.iteration_range = iteration_range
+        self.threshold = threshold
+
+    @classmethod
+    def from_artifacts(cls, model, scaler, threshold=0.5):
+        """
+        Builds a scorer from the loaded XGBClassifier and StandardScaler.
+        Raises:
+            ValueError: If the artifacts are not of a kind the scorer can reproduce.
+        """
+        num_features = getattr(scaler, 'n_features_in_', None)
+        if num_features is None or not hasattr(model, 'get_booster'):
+            raise ValueError(f"Unsupported artifacts: {type(scaler).__name__} and {type(model).__name__}")
+        mean = getattr(scaler, 'mean_', None)
+        scale = getattr(scaler, 'scale_', None)
+        mean = np.zeros(num_features) if mean is None or not getattr(scaler, 'with_mean', True) else np.asarray(mean, dtype=np.float64)
+        scale = np.ones(num_features) if scale is None or not getattr(scaler, 'with_std', True) else np.asarray(scale, dtype=np.float64)
+
+        try:
+            best_iteration = model.best_iteration # only set when the model was trained with early stopping
+            iteration_range = (0, best_iteration + 1)
+        except AttributeError:
+            iteration_range = (0, 0)
+
+        # (x - mean) / scale == x * (1 / scale) - mean / scale
+        return cls(model.get_booster(), 1.0 / scale, -mean / scale, iteration_range, threshold)
+
+    def transform(self, feature_matrix):
+        """The scaler's transform, as a C-contiguous float32 array."""
+        scaled = np.multiply(feature_matrix, self.scale_factor, dtype=np.float64)
+        scaled += self.offset
+        return scaled.astype(np.float32)
+
+    def predict(self, scaled_features):
+        """P(cheat) per row of a transform() result."""
+        return self.booster.inplace_predict(scaled_features, iteration_range=self.iteration_range)
+
+    def score(self, feature_matrix):
+        """
+        Returns:
+            tuple: (labels, probabilities) as score_feature_matrix returns them.
+        """
+        probabilities = self.predict(self.transform(feature_matrix))
+        return (probabilities > self.threshold).astype(np.int64), probabilities
+
+
+class CompiledScorer(BoosterScorer):
+    """
+    BoosterScorer without XGBoost: the trees of a binary:logistic booster are flattened into node arrays
+    and evaluated with NumPy, one tree level per step for every row and tree at once. Saved as .npy files
+    (see save), which load memory-mapped, so neither joblib, XGBoost nor scikit-learn is imported to score.
+
+    Node i's children are children[2 * i] (taken when the feature value is below split_thresholds[i]) and
+    children[2 * i + 1]; a leaf is its own child, so every row can step max_depth times.
+    """
+
+    ARRAYS = ('split_features', 'split_thresholds', 'children', 'default_left', 'leaf_values', 'roots', 'scale_factor', 'offset')
+
+    def __init__(self, split_features, split_thresholds, children, default_left, leaf_values, roots, max_depth, base_margin,
+                 scale_factor, offset, threshold=0.5):
+        super().__init__(None, scale_factor, offset, threshold=threshold)
+        self.split_features = split_features
+        self.split_thresholds = split_thresholds
+        self.children = children
+        self.default_left = default_left
+        self.leaf_values = leaf_values
+        self.roots = roots
+        self.max_depth = max_depth
+        self.base_margin = base_margin
+
+    @classmethod
+    def from_booster(cls, booster, scale_factor, offset, iteration_range=(0, 0), threshold=0.5):
+        """
+        Raises:
+            ValueError: If the booster is not a numerical-split gbtree model with the binary:logistic objective.
+        """
+        model = json.loads(booster.save_raw('json'))['learner']
+        objective = model['objective']['name']
+        if objective != 'binary:logistic' or model['gradient_booster']['name'] != 'gbtree':
+            raise ValueError(f"Unsupported model: {model['gradient_booster']['name']} with objective {objective}")
+        base_score = float(model['learner_model_param']['base_score'].strip('[]'))
+        trees = model['gradient_booster']['model']['trees']
+        begin, end = iteration_range
+        trees = trees[begin:end or len(trees)]
+
+        split_features, split_thresholds, children, default_left, leaf_values, roots = [], [], [], [], [], []
+        max_depth = 0
+        for tree in trees:
+            if any(tree['split_type']):
+                raise ValueError("Categorical splits are not supported")
+            first = len(leaf_values)
+            roots.append(first)
+            depths = [0] * len(tree['left_children'])
+            for node, (left, right) in enumerate(zip(tree['left_children'], tree['right_children'])):
+                is_leaf = left == -1
+                split_features.append(0 if is_leaf else tree['split_indices'][node])
+                split_thresholds.append(tree['split_conditions'][node]) # the leaf value for leaves
+                children.extend((first + node, first + node) if is_leaf else (first + left, first + right))
+                default_left.append(bool(tree['default_left'][node]))
+                leaf_values.append(tree['split_conditions'][node] if is_leaf else 0.0)
+                if not is_leaf:
+                    depths[left] = depths[right] = depths[node] + 1 # children come after their parent
+            max_depth = max(max_depth, max(depths))
+
+        return cls(np.array(split_features, dtype=np.int32), np.array(split_thresholds, dtype=np.float32),
+                   np.array(children, dtype=np.int32), np.array(default_left, dtype=bool),
+                   np.array(leaf_values, dtype=np.float32), np.array(roots, dtype=np.int32), max_depth,
+                   float(np.log(base_score / (1.0 - base_score))), scale_factor, offset, threshold)
+
+    @classmethod
+    def from_artifacts(cls, model, scaler, threshold=0.5):
+        scorer = BoosterScorer.from_artifacts(model, scaler, threshold)
+        return cls.from_booster(scorer.booster, scorer.scale_factor, scorer.offset, scorer.iteration_range, threshold)
+
+    def predict(self, scaled_features):
+        """P(cheat) per row of a transform() result."""
+        nodes = np.repeat(self.roots[np.newaxis, :], len(scaled_features), axis=0)
+        for _ in range(self.max_depth):
+            values = np.take_along_axis(scaled_features, self.split_features[nodes], axis=1)
+            go_right = ~(values < self.split_thresholds[nodes])
+            missing = np.isnan(values)
+            if missing.any():
+                go_right[missing] = ~self.default_left[nodes[missing]]
+            nodes = self.children[2 * nodes + go_right]
+        margin = self.leaf_values[nodes].sum(axis=1, dtype=np.float64) + self.base_margin
+        return (1.0 / (1.0 + np.exp(-margin))).astype(np.float32)
+
+    def save(self, directory, metadata=None):
+        """Writes one .npy file per array plus meta.json to directory."""
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        meta = {
+            "format_version": COMPILED_FORMAT_VERSION,
+            "max_depth": self.max_depth,
+            "base_margin": self.base_margin,
+            "threshold": self.threshold,
+            "num_features": len(self.scale_factor),
+            **(metadata or {}),
+        }
+        with open(os.path.join(directory, COMPILED_META_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Returns:
+            tuple: (CompiledScorer, the metadata saved with it)
+        Raises:
+            ValueError: If the directory holds another format version.
+        """
+        with open(os.path.join(directory, COMPILED_META_FILENAME), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('format_version') != COMPILED_FORMAT_VERSION:
+            raise ValueError(f"Unsupported compiled model format version {meta.get('format_version')} in {directory}")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r' if mmap else None) for name in cls.ARRAYS}
+        scale_factor, offset = arrays.pop('scale_factor'), arrays.pop('offset')
+        return cls(**arrays, max_depth=meta['max_depth'], base_margin=meta['base_margin'],
+                   scale_factor=scale_factor, offset=offset, threshold=meta['threshold']), meta
+
+
+def parity_probe(scaler, rows_per_feature=8):
+    """
+    Deterministic feature rows for the start-up parity check: the scaler's mean, rows a few standard
+    deviations around it, single-feature sweeps, and zeros. Not clamped at zero: the z-score and
+    *_deviation features are signed, and negative values of the others are harmless to compare on.
+    """
+    mean = np.asarray(getattr(scaler, 'mean_', np.zeros(scaler.n_features_in_)), dtype=np.float64)
+    scale = np.asarray(getattr(scaler, 'scale_', np.ones(scaler.n_features_in_)), dtype=np.float64)
+    num_features = len(mean)
+    rng = np.random.default_rng(0)
+
+    rows = [mean, np.zeros(num_features)]
+    rows.extend(mean + rng.standard_normal((64, num_features)) * scale * 2)
+    for feature in range(num_features):
+        for step in np.linspace(-3, 3, rows_per_feature):
+            row = mean.copy()
+            row[feature] += step * scale[feature]
+            rows.append(row)
+    return np.array(rows)
+
+
+def check_parity(scorer, reference_score, probe, tolerance=PARITY_TOLERANCE):
+    """
+    Compares scorer against reference_score (the scikit-learn path) on probe rows.
+    Returns:
+        tuple: (ok, largest probability difference, rows whose label differs)
+    """
+    reference_labels, reference_probabilities = reference_score(probe)
+    labels, probabilities = scorer.score(probe)
+    max_difference = float(np.max(np.abs(np.asarray(probabilities, dtype=np.float64) - reference_probabilities))) if len(probe) else 0.0
+    label_mismatches = int(np.sum(labels != reference_labels))
+    return max_difference <= tolerance and label_mismatches == 0, max_difference, label_mismatches
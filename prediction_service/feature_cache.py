@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from calculate_global_stats import QuestionStatsAccumulator
+from extract_features import FEATURE_NAMES_IN_ORDER
+
+# --- Configuration ---
+# Feature vectors kept in memory (0 disables the cache). Off by default: hashing the events costs about a third
+# of parsing them, which only pays off when the same sessions are scored again (e.g. re-evaluating a test)
+FEATURE_CACHE_SIZE = int(os.environ.get('PREDICTION_FEATURE_CACHE_SIZE', '0'))
+# Directory of the on-disk tier (a SQLite file); empty keeps the cache in memory only
+FEATURE_CACHE_DIR = os.environ.get('PREDICTION_FEATURE_CACHE_DIR', '')
+# Batch global stats kept in memory, keyed by the batch's session hashes
+BATCH_STATS_MEMO_SIZE = int(os.environ.get('PREDICTION_BATCH_STATS_MEMO_SIZE', '16'))
+
+
+# Modules whose code determines the feature values; a change to any of them invalidates cached vectors and
+# batch stats, and every shard of a feature store
+FEATURE_CODE_MODULES = ('event_decoding.py', 'session_parser.py', 'calculate_global_stats.py', 'extract_features.py')
+
+
+def feature_code_version():
+    """Digest of the feature names and of the source of FEATURE_CODE_MODULES."""
+    digest = hashlib.sha256(json.dumps(FEATURE_NAMES_IN_ORDER).encode('utf-8'))
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in FEATURE_CODE_MODULES:
+        with open(os.path.join(module_dir, module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# Part of every key, so the disk tier never serves results of other feature code across deploys
+FEATURE_VERSION = feature_code_version()
+
+
+# --- Keys ---
+def _digest(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update((part or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def session_key(session_log_events):
+    """
+    Hash of a session's events, normalized to (timestamp, activity_text, location) in log order. Malformed
+    events (or sessions) are hashed as they are, so that parsing them reports the error for that user alone.
+    """
+    if not isinstance(session_log_events, list):
+        normalized = session_log_events
+    else:
+        normalized = [(log.get("timestamp"), log.get("activity_text"), log.get("location")) if isinstance(log, dict) else log
+                      for log in session_log_events]
+    return _digest(json.dumps(normalized, separators=(',', ':'), default=str))
+
+
+def stats_version(global_stats):
+    """Hash of a batch_global_stats dict; feature vectors are only reused against identical stats."""
+    return _digest(json.dumps(global_stats, sort_keys=True, separators=(',', ':'), default=str))
+
+
+def batch_key(question_set_hash, session_keys):
+    """
+    Hash of a whole batch: the feature code version, its question set and the session key of every user
+    (None for missing sessions).
+    """
+    return _digest(FEATURE_VERSION, question_set_hash, *session_keys)
+
+
+def feature_key(session_key, question_set_hash, global_stats_version):
+    return _digest(FEATURE_VERSION, session_key, question_set_hash, global_stats_version)
+
+
+class FeatureCache:
+    """
+    Content-addressed cache of per-session feature vectors, so re-evaluating a test whose logs did not
+    change skips parsing and aggregation. A feature vector is keyed by feature_key: the feature code version,
+    the session's events, the question set and the version of the batch global stats it was computed against.
+
+    Also memoizes the QuestionStatsAccumulator of whole batches (keyed by batch_key), since the stats
+    are needed before any feature vector can be looked up.
+
+    Memory tier: LRUs of `capacity` vectors and `stats_capacity` batches. Disk tier (optional): a SQLite
+    file in `directory`, shared by every process using the same directory.
+    """
+
+    def __init__(self, capacity=FEATURE_CACHE_SIZE, directory=FEATURE_CACHE_DIR, stats_capacity=BATCH_STATS_MEMO_SIZE):
+        self.capacity = capacity
+        self.directory = directory
+        self.stats_capacity = stats_capacity
+        self._vectors = OrderedDict() # feature key -> np.ndarray
+        self._batch_stats = OrderedDict() # batch key -> QuestionStatsAccumulator state
+        self._db = None
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "batch_stats_hits": 0, "batch_stats_misses": 0}
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def _connection(self):
+        if self._db is None and self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.directory, 'feature_cache.sqlite3'), timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS feature_vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS batch_stats (key TEXT PRIMARY KEY, accumulator TEXT NOT NULL)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _remember(self, store, capacity, key, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > capacity:
+            store.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Returns:
+            dict: key -> feature vector (np.ndarray of float64) for every key found in either tier.
+        """
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                vector = self._vectors.get(key)
+                if vector is None:
+                    missing.append(key)
+                else:
+                    self._vectors.move_to_end(key)
+                    found[key] = vector
+            self._counters["hits"] += len(found)
+
+            db = self._connection()
+            if missing and db is not None:
+                for start in range(0, len(missing), 500): # stay under SQLite's bound parameter limit
+                    batch = missing[start:start + 500]
+                    rows = db.execute(f"SELECT key, vector FROM feature_vectors WHERE key IN ({','.join('?' * len(batch))})", batch)
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float64)
+                        self._remember(self._vectors, self.capacity, key, vector)
+                        found[key] = vector
+                        self._counters["disk_hits"] += 1
+
+            self._counters["misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Stores (key, feature vector) pairs in both tiers."""
+        items = [(key, np.asarray(vector, dtype=np.float64)) for key, vector in items]
+        with self._lock:
+            for key, vector in items:
+                self._remember(self._vectors, self.capacity, key, vector)
+            db = self._connection()
+            if items and db is not None:
+                db.executemany("INSERT OR REPLACE INTO feature_vectors (key, vector) VALUES (?, ?)",
+                               [(key, vector.tobytes()) for key, vector in items])
+                db.commit()
+
+    def get_batch_stats(self, key):
+        """Returns the QuestionStatsAccumulator memoized for a batch_key, or None."""
+        with self._lock:
+            state = self._batch_stats.get(key)
+            if state is not None:
+                self._batch_stats.move_to_end(key)
+            else:
+                db = self._connection()
+                row = db.execute("SELECT accumulator FROM batch_stats WHERE key = ?", (key,)).fetchone() if db is not None else None
+                if row is not None:
+                    state = json.loads(row[0])
+                    self._remember(self._batch_stats, self.stats_capacity, key, state)
+            self._counters["batch_stats_hits" if state is not None else "batch_stats_misses"] += 1
+        return QuestionStatsAccumulator(state) if state is not None else None
+
+    def put_batch_stats(self, key, accumulator):
+        state = accumulator.to_dict()
+        with self._lock:
+            self._remember(self._batch_stats, self.stats_capacity, key, state)
+            db = self._connection()
+            if db is not None:
+                db.execute("INSERT OR REPLACE INTO batch_stats (key, accumulator) VALUES (?, ?)",
+                           (key, json.dumps(state, separators=(',', ':'))))
+                db.commit()
+
+    def counters(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._vectors)
+            counters["capacity"] = self.capacity
+            counters["disk_tier"] = bool(self.directory)
+        lookups = counters["hits"] + counters["disk_hits"] + counters["misses"]
+        counters["hit_rate"] = round((counters["hits"] + counters["disk_hits"]) / lookups, 4) if lookups else None
+        return counters
@@ -0,0 +1,676 @@
+"""
+Golden-output regression harness for the 24 model features and the predictions made from them.
+
+    python feature_parity.py record golden/
+    python feature_parity.py check golden/ --timing
+
+`record` builds a corpus of test batches: synthetic_logs batches, a batch of hand-written edge cases
+(unparseable and missing timestamps, no submit, cleared answers, revisits, unknown questions, out-of-order and
+duplicate timestamps, ...) and one with junk timestamps that end in 'Z'. It runs the reference implementation on each batch (compute_batch_global_stats,
+then get_per_question_metrics and aggregate_features per session, scored with scaler.transform and
+model.predict_proba) and writes:
+
+    corpus.json              the batches, so later checks run on exactly the same inputs
+    {batch}.features.npy     float64 (users, len(FEATURE_NAMES_IN_ORDER)), NaNs filled with 0 as the service does
+    {batch}.probabilities.npy, {batch}.labels.npy
+    manifest.json            feature names, model version and artifact digest, per-batch global stats and errors
+
+`check` runs the reference implementation again and every alternative one: the service's feature engines on
+JSON and on columnar-encoded batches (see wire_encoding), its process-pool sharding (see parallel_features),
+the live sessions' incremental snapshots (see live_sessions), the memory-budget spill of /predict_batch_stream,
+score_offline on JSONL and on a binary export, and the inference paths (booster, compiled). Each is diffed
+against the golden output within tolerances; the exit status is 1 if any differs. Predictions are only
+compared while the model artifacts are the ones they were recorded with. --timing also times every
+implementation on each batch, so a rework can be compared with the code it replaces.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from calculate_global_stats import compute_batch_global_stats, QuestionStatsAccumulator
+from event_decoding import decode_timestamp_us
+from extract_features import get_per_question_metrics, aggregate_features, extract_feature_vector, FEATURE_NAMES_IN_ORDER
+from synthetic_logs import generate_batch, generate_questions, generate_session
+
+MANIFEST_NAME = 'manifest.json'
+CORPUS_NAME = 'corpus.json'
+GOLDEN_FORMAT_VERSION = 1
+
+# Largest feature difference accepted (features are rounded to 4 decimals)
+FEATURE_TOLERANCE = float(os.environ.get('PREDICTION_PARITY_FEATURE_TOLERANCE', '1e-4'))
+# Largest global stats difference accepted (the stats are rounded to 3 decimals)
+STATS_TOLERANCE = float(os.environ.get('PREDICTION_PARITY_STATS_TOLERANCE', '1e-3'))
+# Largest probability difference accepted; defaults to the start-up parity check's tolerance
+PROBABILITY_TOLERANCE = float(os.environ.get('PREDICTION_INFERENCE_PARITY_TOLERANCE', '1e-6'))
+# Differences listed per batch and implementation in the report
+MAX_REPORTED_DIFFERENCES = 20
+# Workers and sessions per task of the process-pool implementations; small chunks so every batch spans several
+POOL_WORKERS = 2
+POOL_CHUNK_SIZE = 16
+# Events per LiveSession.append of the live implementation, cycled through
+LIVE_APPEND_SIZES = (1, 3, 7, 2)
+# Added to the tolerances, so values one rounding step apart (e.g. 37.0323 and 37.0324) still match
+_ROUNDING_SLACK = 1e-9
+
+_EDGE_CASE_START = datetime.datetime(2025, 1, 15, 9, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+# --- Corpus ---
+def _timed_events(steps, offset_hours=0, milliseconds=True):
+    """Events from (seconds after the previous event, activity_text, location) steps."""
+    tz = datetime.timezone(datetime.timedelta(hours=offset_hours))
+    now = _EDGE_CASE_START
+    events = []
+    for delay, activity_text, location in steps:
+        now += datetime.timedelta(seconds=delay)
+        timestamp = now.astimezone(tz).isoformat(timespec='milliseconds' if milliseconds else 'seconds').replace('+00:00', 'Z')
+        events.append({"timestamp": timestamp, "activity_text": activity_text, "location": location})
+    return events
+
+
+def _answer(index, q_id, option, think=20):
+    return [(2, f"Selected question {index}", q_id), (think, f"Selected option {option} for question {index}", q_id)]
+
+
+def edge_case_batch(seed=0, background_sessions=40):
+    """
+    A batch of hand-written sessions that exercise the corners of the log state machine, mixed with ordinary
+    generated sessions so the global stats have a cohort to come from. Each edge case's userId names it.
+    """
+    questions_data = generate_questions(6, seed=seed)
+    questions_data[-1]["correct_answer"] = None # a question without an answer key
+    q = [question["id"] for question in questions_data]
+    options = [question["correct_answer"] or 0 for question in questions_data]
+
+    start = [(0, "Test Started", q[0])]
+    walk = start + [step for index in range(len(q)) for step in _answer(index, q[index], options[index])]
+    submit = [(10, "Submitted Test", q[-1])]
+    complete = _timed_events(walk + submit)
+
+    unparseable = [dict(event) for event in complete]
+    for i, bad in zip(range(1, len(unparseable), 3), ('not a timestamp', None, '', '2025-13-45T99:00:00Z', [], 'Z')):
+        unparseable[i]["timestamp"] = bad
+    del unparseable[-2]["timestamp"]
+
+    epoch_milliseconds = [dict(event, timestamp=decode_timestamp_us(event["timestamp"]) // 1000) for event in complete]
+
+    sessions = {
+        "complete": complete,
+        "no_submit": _timed_events(walk),
+        "unparseable_timestamps": unparseable,
+        "all_timestamps_unparseable": [dict(event, timestamp='garbage') for event in complete],
+        "epoch_millisecond_timestamps": epoch_milliseconds,
+        "timezone_offsets": _timed_events(walk + submit, offset_hours=5.5, milliseconds=False),
+        "out_of_order": complete[::-1],
+        "duplicate_timestamps": _timed_events([(0, text, location) for _, text, location in walk + submit]),
+        "cleared_last": _timed_events(start + _answer(0, q[0], 1) + [(5, "Cleared option for question 0", q[0])] + submit),
+        "cleared_and_reselected": _timed_events(start + _answer(0, q[0], 1) + [
+            (5, "Cleared option for question 0", q[0]), (5, f"Selected option {options[0]} for question 0", q[0]),
+            (5, "Cleared option for question 0", q[0]), (5, "Selected option 2 for question 0", q[0]),
+        ] + _answer(1, q[1], options[1]) + submit),
+        "revisits": _timed_events(start + _answer(0, q[0], 1) + _answer(1, q[1], options[1]) + _answer(0, q[0], options[0])
+                                  + _answer(2, q[2], 0, think=3) + _answer(0, q[0], 2, think=1) + _answer(1, q[1], 3) + submit),
+        "unknown_question": _timed_events(start + _answer(0, q[0], options[0]) + _answer(9, 'not-a-question-of-this-test', 1, think=40)
+                                          + _answer(1, q[1], options[1]) + submit),
+        "no_location": _timed_events([(0, "Test Started", None), (2, "Selected question 0", None),
+                                      (20, "Selected option 1 for question 0", None)] + submit),
+        "tab_switches": _timed_events([(0, "Test Started", None), (3, "Tab Switched", None), (30, "Returned to Test Tab", None)]
+                                      + _answer(0, q[0], options[0]) + [(4, "Tab Switched", None), (60, "Returned to Test Tab", None),
+                                                                        (2, "Tab Switched", None), (1, "Returned to Test Tab", None)]
+                                      + _answer(1, q[1], options[1]) + submit),
+        "malformed_options": _timed_events(start + [(2, "Selected question 0", q[0]), (10, "Selected option x for question 0", q[0]),
+                                                    (10, "Selected option", q[0]), (2, "Selected question 1", q[1]),
+                                                    (10, "Selected option 99 for question 1", q[1]), (2, "Selected question 2", q[2]),
+                                                    (10, "Selected option -1 for question 2", q[2])] + submit),
+        "events_after_submit": _timed_events(walk + submit + _answer(0, q[0], 3) + [(5, "Submitted Test", q[-1])]),
+        "unknown_activity": _timed_events(start + [(1, "Final Focused Time: 12 seconds", None), (1, "Something else", q[0])]
+                                          + _answer(0, q[0], options[0]) + [(1, "", q[0])] + submit),
+        "long_idle": _timed_events(start + _answer(0, q[0], options[0], think=3600) + _answer(1, q[1], options[1]) + submit),
+        "question_without_answer_key": _timed_events(start + _answer(5, q[5], 2) + submit),
+        "single_event": _timed_events(start),
+        "submit_only": _timed_events(submit),
+        "missing_events": [],
+    }
+
+    all_user_logs = [{"userId": name, "session_log_events": events} for name, events in sessions.items()]
+    all_user_logs.append({"userId": "no_events_key"})
+    for i in range(background_sessions):
+        rng = random.Random(f"{seed}:edge_background:{i}")
+        all_user_logs.append({"userId": f"background_{i}", "session_log_events": generate_session(rng, questions_data, 30, cheat=i % 5 == 0)})
+    return {"all_user_logs": all_user_logs, "questions_data": questions_data}
+
+
+# Not timestamps, though they end in 'Z' like ISO-8601 UTC ones; NumPy's datetime64 parser reads most of them as times
+JUNK_Z_TIMESTAMPS = ('nowZ', 'todayZ', '2025Z', '2025-01Z', ' 2025-01-15T09:00:30.000Z', '2025-01-15T09:00:30+05:30Z',
+                     '0000-01-15T09:00:30.000Z', 'Z')
+
+
+def junk_timestamp_batch(seed=0, sessions=40):
+    """
+    Generated sessions, some with a few timestamps replaced by JUNK_Z_TIMESTAMPS. Every timestamp of the batch is
+    a string ending in 'Z', so the columnar engine takes its bulk timestamp decoding path on it.
+    """
+    questions_data = generate_questions(6, seed=seed)
+    all_user_logs = []
+    for i in range(sessions):
+        rng = random.Random(f"{seed}:junk_timestamps:{i}")
+        session_log_events = generate_session(rng, questions_data, 30, cheat=i % 5 == 0)
+        if i % 2 == 0:
+            for j in range(i % 3, len(session_log_events), 4):
+                session_log_events[j]["timestamp"] = JUNK_Z_TIMESTAMPS[(i + j) % len(JUNK_Z_TIMESTAMPS)]
+        all_user_logs.append({"userId": f"junk_timestamps_{i}" if i % 2 == 0 else f"background_{i}",
+                              "session_log_events": session_log_events})
+    all_user_logs.append({"userId": "only_junk_timestamps",
+                          "session_log_events": [dict(event, timestamp=JUNK_Z_TIMESTAMPS[j % len(JUNK_Z_TIMESTAMPS)])
+                                                 for j, event in enumerate(all_user_logs[1]["session_log_events"])]})
+    return {"all_user_logs": all_user_logs, "questions_data": questions_data}
+
+
+def build_corpus(students=300, seed=0):
+    """The batches of a golden corpus: list of {"name", "all_user_logs", "questions_data"}."""
+    return [
+        {"name": "synthetic", **generate_batch(students, 20, 60, 0.2, seed)},
+        {"name": "synthetic_revisits", **generate_batch(max(students // 6, 1), 8, 200, 0.3, seed + 1)},
+        {"name": "edge_cases", **edge_case_batch(seed)},
+        {"name": "junk_timestamps", **junk_timestamp_batch(seed)},
+    ]
+
+
+# --- Implementations ---
+def _questions_data_map(batch):
+    return {question["id"]: question for question in batch["questions_data"]}
+
+
+def reference_features(all_user_logs_with_ids, questions_data_map):
+    """
+    The reference implementation: compute_batch_global_stats, then get_per_question_metrics and
+    aggregate_features (the DataFrame path) for each session.
+    Returns:
+        tuple: (batch global stats, feature matrix with NaNs filled with 0, {position: error message})
+    """
+    current_batch_global_stats = compute_batch_global_stats(all_user_logs_with_ids, questions_data_map)
+    feature_matrix = np.zeros((len(all_user_logs_with_ids), len(FEATURE_NAMES_IN_ORDER)), dtype=np.float64)
+    user_errors = {}
+    for position, user_log_data in enumerate(all_user_logs_with_ids):
+        session_log_events = user_log_data.get('session_log_events')
+        if not session_log_events:
+            user_errors[position] = "Missing session_log_events"
+            continue
+        try:
+            per_question_metrics_df = get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats)
+            features = aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map)
+        except Exception as e:
+            user_errors[position] = f"Error during processing for this user: {e}"
+            continue
+        feature_matrix[position] = [features[name] for name in FEATURE_NAMES_IN_ORDER]
+    feature_matrix[np.isnan(feature_matrix)] = 0.0
+    return current_batch_global_stats, feature_matrix, user_errors
+
+
+def _features_of_parsed(parsed_sessions, questions_data_map, current_batch_global_stats):
+    """
+    Feature matrix (NaNs filled with 0) and {position: error message} from one ParsedSession, or error message,
+    per user: extract_feature_vector per session, as /predict_batch_stream, /live and score_offline featurize.
+    """
+    feature_matrix = np.zeros((len(parsed_sessions), len(FEATURE_NAMES_IN_ORDER)), dtype=np.float64)
+    user_errors = {}
+    for position, parsed_session in enumerate(parsed_sessions):
+        if isinstance(parsed_session, str):
+            user_errors[position] = parsed_session
+            continue
+        try:
+            feature_matrix[position] = extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map)
+        except Exception as e:
+            user_errors[position] = f"Error during processing for this user: {e}"
+    feature_matrix[np.isnan(feature_matrix)] = 0.0
+    return feature_matrix, user_errors
+
+
+def _global_stats_of_parsed(parsed_sessions, questions_data_map):
+    stats_accumulator = QuestionStatsAccumulator()
+    for parsed_session in parsed_sessions:
+        if not isinstance(parsed_session, str):
+            stats_accumulator.add_session(None, questions_data_map, parsed_session)
+    return stats_accumulator.to_global_stats(questions_data_map)
+
+
+def pool_features(all_user_logs_with_ids, questions_data_map, service):
+    """
+    The reference engine's parse_sessions and extract_feature_vectors, sharded across POOL_WORKERS processes
+    whatever the batch size (they only use the pool from PARALLEL_MIN_BATCH sessions on).
+    """
+    import parallel_features
+
+    min_batch = parallel_features.PARALLEL_MIN_BATCH
+    parallel_features.PARALLEL_MIN_BATCH = 0
+    try:
+        parsed_sessions, parse_errors, stats_accumulator = parallel_features.parse_sessions(
+            all_user_logs_with_ids, questions_data_map, POOL_WORKERS, POOL_CHUNK_SIZE)
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+        feature_vectors = parallel_features.extract_feature_vectors(parsed_sessions, questions_data_map, current_batch_global_stats,
+                                                                    POOL_WORKERS, POOL_CHUNK_SIZE)
+    finally:
+        parallel_features.PARALLEL_MIN_BATCH = min_batch
+    for position, error in parse_errors.items():
+        feature_vectors[position] = error
+
+    user_ids = [user_log_data.get('userId', 'unknown_user') for user_log_data in all_user_logs_with_ids]
+    missing = [not user_log_data.get('session_log_events') for user_log_data in all_user_logs_with_ids]
+    feature_matrix, user_errors = service._assemble_feature_matrix(user_ids, missing, feature_vectors)
+    return current_batch_global_stats, feature_matrix, user_errors
+
+
+def live_features(all_user_logs_with_ids, questions_data_map):
+    """
+    Each session fed to a LiveSession a few events at a time (LIVE_APPEND_SIZES), with a snapshot after every
+    append; the last snapshots are featurized as a batch.
+    """
+    from live_sessions import LiveSession
+
+    parsed_sessions = []
+    for user_log_data in all_user_logs_with_ids:
+        session_log_events = user_log_data.get('session_log_events')
+        if not session_log_events:
+            parsed_sessions.append("Missing session_log_events")
+            continue
+        live_session = LiveSession(questions_data_map)
+        parsed_session = live_session.snapshot()
+        append_sizes = itertools.cycle(LIVE_APPEND_SIZES)
+        start = 0
+        while start < len(session_log_events):
+            end = start + next(append_sizes)
+            live_session.append(session_log_events[start:end])
+            parsed_session = live_session.snapshot()
+            start = end
+        parsed_sessions.append(parsed_session)
+
+    current_batch_global_stats = _global_stats_of_parsed(parsed_sessions, questions_data_map)
+    return (current_batch_global_stats, *_features_of_parsed(parsed_sessions, questions_data_map, current_batch_global_stats))
+
+
+def spill_features(all_user_logs_with_ids, questions_data_map):
+    """
+    /predict_batch_stream past its memory budget: every session's decoded records go to a RecordSpill once its
+    stats are accumulated, and are read back and parsed again to be featurized.
+    """
+    from event_decoding import decode_events
+    from memory_budget import RecordSpill
+    from session_parser import parse_records
+
+    spill = RecordSpill()
+    try:
+        stats_accumulator = QuestionStatsAccumulator()
+        spilled = []
+        for user_log_data in all_user_logs_with_ids:
+            session_log_events = user_log_data.get('session_log_events')
+            if not session_log_events:
+                spilled.append("Missing session_log_events")
+                continue
+            records = decode_events(session_log_events)
+            stats_accumulator.add_session(session_log_events, questions_data_map, parse_records(records, questions_data_map))
+            spilled.append(spill.append(records))
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+        parsed_sessions = [index if isinstance(index, str) else parse_records(spill.records(index), questions_data_map)
+                           for index in spilled]
+    finally:
+        spill.close()
+    return (current_batch_global_stats, *_features_of_parsed(parsed_sessions, questions_data_map, current_batch_global_stats))
+
+
+def offline_features(source, questions_data_map, scratch_dir):
+    """
+    score_offline.score_sessions on source (JsonlSessions or ExportedSessions) with POOL_WORKERS workers, read back
+    from its predictions and feature matrix. The global stats come from compute_global_stats, its first pass.
+    """
+    import score_offline
+
+    output_path = os.path.join(scratch_dir, 'predictions.jsonl')
+    features_path = os.path.join(scratch_dir, 'features.npy')
+    with contextlib.redirect_stderr(io.StringIO()):
+        current_batch_global_stats = score_offline.compute_global_stats(source, POOL_WORKERS, POOL_CHUNK_SIZE)[0]
+        score_offline.score_sessions(source, output_path, features_path, POOL_WORKERS, POOL_CHUNK_SIZE)
+    with open(output_path, 'r', encoding='utf-8') as f:
+        user_errors = {position: prediction["error"] for position, prediction in enumerate(map(json.loads, f)) if "error" in prediction}
+    feature_matrix = np.load(features_path)
+    feature_matrix[list(user_errors)] = 0.0 # NaN rows
+    return current_batch_global_stats, feature_matrix, user_errors
+
+
+def feature_implementations(service, scratch_dir):
+    """
+    The feature implementations to check: name -> (prepare(batch), run(prepared, questions_data_map)), where run
+    returns (global stats, feature matrix, {position: error message}). Only run is timed. scratch_dir holds the
+    score_offline inputs and outputs.
+    """
+    import score_offline
+    from wire_encoding import EncodedBatch
+
+    def as_json(batch):
+        return batch["all_user_logs"]
+
+    def as_encoded(batch):
+        return EncodedBatch.from_npz(EncodedBatch.from_user_logs(batch["all_user_logs"], batch["questions_data"]).to_npz())
+
+    def as_jsonl(batch):
+        path = os.path.join(scratch_dir, f"{batch['name']}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"questions_data": batch["questions_data"]}) + '\n')
+            f.writelines(json.dumps(user_log_data) + '\n' for user_log_data in batch["all_user_logs"])
+        return score_offline.JsonlSessions(path)
+
+    def as_export(batch):
+        directory = os.path.join(scratch_dir, f"{batch['name']}.export")
+        score_offline.export_sessions(as_jsonl(batch), directory, workers=1)
+        return score_offline.ExportedSessions(directory)
+
+    def engine(extract):
+        def run(prepared, questions_data_map):
+            current_batch_global_stats, _, feature_matrix, user_errors = extract(prepared, questions_data_map)
+            return current_batch_global_stats, feature_matrix, user_errors
+        return run
+
+    def offline(prepared, questions_data_map):
+        return offline_features(prepared, questions_data_map, scratch_dir)
+
+    implementations = {'reference': (as_json, reference_features)}
+    for name, extract in service.FEATURE_ENGINES.items():
+        implementations[f"engine:{name}"] = (as_json, engine(extract))
+    for name, extract in service.ENCODED_FEATURE_ENGINES.items():
+        implementations[f"encoded:{name}"] = (as_encoded, engine(extract))
+    implementations['pool:reference'] = (as_json, lambda prepared, questions_data_map: pool_features(prepared, questions_data_map, service))
+    implementations['live'] = (as_json, live_features)
+    implementations['spill'] = (as_json, spill_features)
+    implementations['offline:jsonl'] = (as_jsonl, offline)
+    implementations['offline:export'] = (as_export, offline)
+    return implementations
+
+
+def inference_implementations(model_version):
+    """The inference paths to check: name -> score(feature_matrix) returning (labels, probabilities)."""
+    import fast_inference
+    from model_registry import PREDICTION_THRESHOLD
+
+    if model_version.model is None: # compiled artifacts only (PREDICTION_FAST_START)
+        return {'compiled': model_version.booster_scorer.score}
+    return {
+        'sklearn': model_version._score_with_sklearn,
+        'booster': fast_inference.BoosterScorer.from_artifacts(model_version.model, model_version.scaler, PREDICTION_THRESHOLD).score,
+        'compiled': fast_inference.CompiledScorer.from_artifacts(model_version.model, model_version.scaler, PREDICTION_THRESHOLD).score,
+    }
+
+
+@contextlib.contextmanager
+def _service():
+    """
+    Imports prediction_service as benchmark.py does: no state left behind in the real stats store, no feature cache
+    hits, and its progress output on stderr. Yields (module, the loaded model version).
+    """
+    with tempfile.TemporaryDirectory(prefix='prediction-parity-') as scratch_dir:
+        os.environ.setdefault('PREDICTION_STATS_STORE_DIR', os.path.join(scratch_dir, 'global_stats_store'))
+        os.environ.setdefault('PREDICTION_JOB_RESULTS_DIR', os.path.join(scratch_dir, 'job_results'))
+        os.environ['PREDICTION_FEATURE_CACHE_SIZE'] = '0'
+        os.environ['PREDICTION_FEATURE_CACHE_DIR'] = ''
+        with contextlib.redirect_stdout(sys.stderr):
+            import prediction_service as service
+            model_version = service.model_registry.wait_loaded()
+            if model_version is None:
+                raise RuntimeError("Model or scaler not loaded.")
+            yield service, model_version
+
+
+def _model_digest(model_version):
+    from model_registry import artifacts_digest
+    try:
+        return artifacts_digest(model_version.path)
+    except OSError: # compiled artifacts without their joblib files
+        return None
+
+
+# --- Comparison ---
+def compare_features(expected, actual, user_ids, tolerance=FEATURE_TOLERANCE):
+    """
+    Returns:
+        dict: "max_difference" and up to MAX_REPORTED_DIFFERENCES {"userId", "feature", "expected", "actual"}
+              entries, worst first, of features further apart than tolerance.
+    """
+    differences = np.abs(actual - expected)
+    differences[np.isnan(differences)] = np.inf
+    rows, columns = np.nonzero(differences > tolerance + _ROUNDING_SLACK)
+    order = np.argsort(-differences[rows, columns], kind='stable')[:MAX_REPORTED_DIFFERENCES]
+    return {
+        "max_difference": float(differences.max()) if differences.size else 0.0,
+        "num_differences": len(rows),
+        "differences": [{"userId": user_ids[rows[i]], "feature": FEATURE_NAMES_IN_ORDER[columns[i]],
+                         "expected": float(expected[rows[i], columns[i]]), "actual": float(actual[rows[i], columns[i]])}
+                        for i in order.tolist()],
+    }
+
+
+def compare_global_stats(expected, actual, tolerance=STATS_TOLERANCE):
+    """{"question", "stat", "expected", "actual"} for every stat that is missing, extra or further apart than tolerance."""
+    differences = []
+    for q_id in sorted(set(expected) | set(actual)):
+        expected_stats, actual_stats = expected.get(q_id, {}), actual.get(q_id, {})
+        for stat in sorted(set(expected_stats) | set(actual_stats)):
+            expected_value, actual_value = expected_stats.get(stat), actual_stats.get(stat)
+            if isinstance(expected_value, (int, float)) and isinstance(actual_value, (int, float)):
+                if abs(expected_value - actual_value) <= tolerance + _ROUNDING_SLACK:
+                    continue
+            elif expected_value == actual_value:
+                continue
+            differences.append({"question": q_id, "stat": stat, "expected": expected_value, "actual": actual_value})
+    return differences
+
+
+def compare_errors(expected, actual, user_ids):
+    """{"userId", "expected", "actual"} for users that failed in only one of the implementations."""
+    return [{"userId": user_ids[position], "expected": expected.get(position), "actual": actual.get(position)}
+            for position in sorted(set(expected) ^ set(actual))]
+
+
+def compare_predictions(expected_labels, expected_probabilities, labels, probabilities, tolerance=PROBABILITY_TOLERANCE):
+    differences = np.abs(np.asarray(probabilities, dtype=np.float64) - expected_probabilities)
+    max_difference = float(differences.max()) if differences.size else 0.0
+    label_mismatches = int(np.count_nonzero(np.asarray(labels) != expected_labels))
+    return {"ok": max_difference <= tolerance and label_mismatches == 0, "max_probability_difference": max_difference,
+            "label_mismatches": label_mismatches}
+
+
+# --- Golden output ---
+def _load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json(path, value):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=2)
+        f.write('\n')
+
+
+def record_golden(golden_dir, students=300, seed=0):
+    """
+    Writes the corpus and the reference implementation's output on it to golden_dir.
+    Returns:
+        dict: The manifest.
+    Raises:
+        RuntimeError: If the model could not be loaded, or only as compiled artifacts (no scikit-learn reference).
+    """
+    corpus = build_corpus(students, seed)
+    with _service() as (service, model_version):
+        if model_version.model is None:
+            raise RuntimeError("The golden predictions need the joblib artifacts; unset PREDICTION_FAST_START.")
+        os.makedirs(golden_dir, exist_ok=True)
+        _write_json(os.path.join(golden_dir, CORPUS_NAME), {"students": students, "seed": seed, "batches": corpus})
+
+        manifest = {
+            "format_version": GOLDEN_FORMAT_VERSION,
+            "feature_names": FEATURE_NAMES_IN_ORDER,
+            "model_version": model_version.version,
+            "model_sha256": _model_digest(model_version),
+            "recorded_at": time.time(),
+            "batches": {},
+        }
+        for batch in corpus:
+            name = batch["name"]
+            current_batch_global_stats, feature_matrix, user_errors = reference_features(batch["all_user_logs"], _questions_data_map(batch))
+            labels, probabilities = model_version._score_with_sklearn(feature_matrix)
+            np.save(os.path.join(golden_dir, f"{name}.features.npy"), feature_matrix)
+            np.save(os.path.join(golden_dir, f"{name}.probabilities.npy"), np.asarray(probabilities, dtype=np.float64))
+            np.save(os.path.join(golden_dir, f"{name}.labels.npy"), np.asarray(labels, dtype=np.int64))
+            manifest["batches"][name] = {
+                "users": len(batch["all_user_logs"]),
+                "global_stats": current_batch_global_stats,
+                "errors": {str(position): error for position, error in user_errors.items()},
+            }
+        _write_json(os.path.join(golden_dir, MANIFEST_NAME), manifest)
+    return manifest
+
+
+def _time(fn, repeat):
+    fn() # warm-up
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def check_golden(golden_dir, timing=False, repeat=3, feature_tolerance=FEATURE_TOLERANCE, probability_tolerance=PROBABILITY_TOLERANCE):
+    """
+    Diffs every feature implementation and inference path against the golden output in golden_dir.
+    Returns:
+        dict: Report with "ok", per batch and implementation the comparison results, and "timing"
+              ({batch: {implementation: median seconds}}) if timing is set.
+    Raises:
+        ValueError: If golden_dir was recorded by another format version or for other features.
+    """
+    manifest = _load_json(os.path.join(golden_dir, MANIFEST_NAME))
+    if manifest.get("format_version") != GOLDEN_FORMAT_VERSION:
+        raise ValueError(f"Unsupported golden format version {manifest.get('format_version')} in {golden_dir}")
+    if manifest["feature_names"] != FEATURE_NAMES_IN_ORDER:
+        raise ValueError(f"{golden_dir} was recorded for other features: {manifest['feature_names']}")
+    corpus = _load_json(os.path.join(golden_dir, CORPUS_NAME))
+
+    report = {"ok": True, "golden_dir": golden_dir, "batches": {}}
+    with _service() as (service, model_version), tempfile.TemporaryDirectory(prefix='prediction-parity-offline-') as scratch_dir:
+        same_model = manifest["model_sha256"] is not None and manifest["model_sha256"] == _model_digest(model_version)
+        report["predictions_compared"] = same_model
+        if not same_model:
+            print(f"Warning: Model artifacts differ from the recorded ones ({manifest['model_version']}); predictions are not compared.",
+                  file=sys.stderr)
+        features = feature_implementations(service, scratch_dir)
+        scorers = inference_implementations(model_version)
+
+        for batch in corpus["batches"]:
+            name = batch["name"]
+            golden = manifest["batches"][name]
+            questions_data_map = _questions_data_map(batch)
+            user_ids = [str(user_log_data.get('userId', 'unknown_user')) for user_log_data in batch["all_user_logs"]]
+            expected_features = np.load(os.path.join(golden_dir, f"{name}.features.npy"))
+            expected_errors = {int(position): error for position, error in golden["errors"].items()}
+            batch_report = report["batches"][name] = {"users": len(user_ids), "features": {}, "predictions": {}}
+            timings = {}
+
+            for implementation, (prepare, run) in features.items():
+                prepared = prepare(batch)
+                current_batch_global_stats, feature_matrix, user_errors = run(prepared, questions_data_map)
+                result = compare_features(expected_features, np.asarray(feature_matrix, dtype=np.float64), user_ids, feature_tolerance)
+                result["global_stats_differences"] = compare_global_stats(golden["global_stats"], current_batch_global_stats)
+                result["error_differences"] = compare_errors(expected_errors, user_errors, user_ids)
+                result["ok"] = not (result["num_differences"] or result["global_stats_differences"] or result["error_differences"])
+                batch_report["features"][implementation] = result
+                if timing:
+                    timings[implementation] = _time(lambda: run(prepared, questions_data_map), repeat)
+
+            if same_model:
+                expected_labels = np.load(os.path.join(golden_dir, f"{name}.labels.npy"))
+                expected_probabilities = np.load(os.path.join(golden_dir, f"{name}.probabilities.npy"))
+                for implementation, score in scorers.items():
+                    labels, probabilities = score(expected_features)
+                    batch_report["predictions"][implementation] = compare_predictions(expected_labels, expected_probabilities,
+                                                                                      labels, probabilities, probability_tolerance)
+            if timing:
+                for implementation, score in scorers.items():
+                    timings[f"inference:{implementation}"] = _time(lambda: score(expected_features), repeat)
+                report.setdefault("timing", {})[name] = timings
+
+            results = list(batch_report["features"].values()) + list(batch_report["predictions"].values())
+            report["ok"] = report["ok"] and all(result["ok"] for result in results)
+    return report
+
+
+def _print_summary(report):
+    for name, batch_report in report["batches"].items():
+        for implementation, result in batch_report["features"].items():
+            status = 'ok' if result["ok"] else (f"DIFFERS ({result['num_differences']} features, max {result['max_difference']:.3g}; "
+                                                f"{len(result['global_stats_differences'])} stats, {len(result['error_differences'])} errors)")
+            print(f"{name}: features {implementation}: {status}", file=sys.stderr)
+        for implementation, result in batch_report["predictions"].items():
+            status = 'ok' if result["ok"] else (f"DIFFERS (max probability difference {result['max_probability_difference']:.3g}, "
+                                                f"{result['label_mismatches']} label mismatches)")
+            print(f"{name}: inference {implementation}: {status}", file=sys.stderr)
+    for name, timings in report.get("timing", {}).items():
+        print(f"{name}: " + ", ".join(f"{implementation} {seconds * 1000:.1f}ms" for implementation, seconds in timings.items()), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record and check golden feature and prediction output.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help="Record the reference implementation's output on a new corpus")
+    record_parser.add_argument('golden_dir', help="Output directory")
+    record_parser.add_argument('--students', type=int, default=300, help="Sessions in the main synthetic batch")
+    record_parser.add_argument('--seed', type=int, default=0)
+    record_parser.add_argument('--force', action='store_true', help="Overwrite an existing golden directory")
+    check_parser = subparsers.add_parser('check', help="Diff every implementation against a golden directory")
+    check_parser.add_argument('golden_dir', help="Directory written by record")
+    check_parser.add_argument('--timing', action='store_true', help="Also time every implementation on each batch")
+    check_parser.add_argument('--repeat', type=int, default=3, help="Timed runs per implementation (after one warm-up run)")
+    check_parser.add_argument('--feature-tolerance', type=float, default=FEATURE_TOLERANCE)
+    check_parser.add_argument('--probability-tolerance', type=float, default=PROBABILITY_TOLERANCE)
+    check_parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        if os.path.exists(os.path.join(args.golden_dir, MANIFEST_NAME)) and not args.force:
+            print(f"Error: {args.golden_dir} already holds golden output (use --force to overwrite it).", file=sys.stderr)
+            return 1
+        try:
+            manifest = record_golden(args.golden_dir, args.students, args.seed)
+        except (OSError, RuntimeError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        users = sum(batch["users"] for batch in manifest["batches"].values())
+        print(f"Recorded {len(manifest['batches'])} batches ({users} users) with model version "
+              f"'{manifest['model_version']}' in {args.golden_dir}", file=sys.stderr)
+        return 0
+
+    try:
+        report = check_golden(args.golden_dir, args.timing, args.repeat, args.feature_tolerance, args.probability_tolerance)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    _print_summary(report)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0 if report["ok"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""
+On-disk store of training feature matrices, built from labeled session logs of many tests.
+
+    python feature_store.py build labeled_logs/ feature_store/
+
+Each *.jsonl file of the input directory is one test in the /predict_batch_stream layout (a header line
+{"questions_data": [...]}, then one {"userId", "session_log_events", "label"} line per user). Per test, the
+global stats are computed over all of its sessions, exactly as /predict_batch computes them for a cohort,
+and every labeled session becomes one float32 row of a shard:
+
+    {test}.features.npy  float32 (rows, len(FEATURE_NAMES_IN_ORDER)), NaNs filled with 0 as the service does
+    {test}.labels.npy    int8 (rows,)
+    {test}.users.json    userId of each row
+
+manifest.json lists the feature names, the feature code version and, per test, the source file's digest.
+A build only rebuilds the tests whose log file changed, and every test when the feature code changed;
+tests are built in parallel, one per worker process. load_feature_matrix() memory-maps the shards back.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from calculate_global_stats import QuestionStatsAccumulator
+from extract_features import extract_feature_vector, FEATURE_NAMES_IN_ORDER
+from feature_cache import feature_code_version
+from parallel_features import FEATURE_WORKERS, POOL_START_METHOD
+from score_offline import JsonlSessions
+from session_parser import parse_session
+
+MANIFEST_NAME = 'manifest.json'
+STORE_FORMAT_VERSION = 1
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_state(path, previous=None):
+    """
+    Size, mtime and content digest of a log file. The digest of `previous` (a manifest entry) is reused
+    when size and mtime are unchanged, so an unchanged store is checked without reading the logs.
+    """
+    stat = os.stat(path)
+    if previous and previous.get('source_size') == stat.st_size and previous.get('source_mtime_ns') == stat.st_mtime_ns:
+        digest = previous.get('source_sha256')
+    else:
+        digest = _file_digest(path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns, "source_sha256": digest}
+
+
+def shard_paths(store_dir, test_name):
+    return {
+        'features': os.path.join(store_dir, f"{test_name}.features.npy"),
+        'labels': os.path.join(store_dir, f"{test_name}.labels.npy"),
+        'users': os.path.join(store_dir, f"{test_name}.users.json"),
+    }
+
+
+def _save_atomic(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+# --- Shard Builder ---
+def build_test_shard(source_path, store_dir, label_field='label'):
+    """
+    Builds the shard of one test (runs in a worker process).
+    Returns:
+        dict: The test's manifest entry, without the source state.
+    """
+    started = time.perf_counter()
+    source = JsonlSessions(source_path)
+    questions_data_map = source.questions_data_map
+
+    # Parse every session once: all of them feed the test's global stats, the labeled ones become rows
+    stats_accumulator = QuestionStatsAccumulator()
+    labeled = []
+    num_users = num_errors = num_unlabeled = 0
+    for chunk in source.chunks(1000):
+        for line_number, line in chunk:
+            num_users += 1
+            try:
+                user_log_data = json.loads(line)
+            except ValueError:
+                user_log_data = None
+            if not isinstance(user_log_data, dict) or not user_log_data.get('session_log_events'):
+                num_errors += 1
+                continue
+            try:
+                parsed_session = parse_session(user_log_data['session_log_events'], questions_data_map)
+            except Exception as e:
+                print(f"Warning: Skipping line {line_number} of {source_path}: {e}")
+                num_errors += 1
+                continue
+            stats_accumulator.add_session(None, questions_data_map, parsed_session)
+
+            label = user_log_data.get(label_field)
+            if label is None:
+                num_unlabeled += 1
+                continue
+            try:
+                label = int(label)
+            except (TypeError, ValueError):
+                print(f"Warning: Skipping line {line_number} of {source_path}: invalid {label_field} {label!r}")
+                num_errors += 1
+                continue
+            labeled.append((user_log_data.get('userId', 'unknown_user'), label, parsed_session))
+
+    current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+
+    features = np.zeros((len(labeled), len(FEATURE_NAMES_IN_ORDER)), dtype=np.float32)
+    labels = np.zeros(len(labeled), dtype=np.int8)
+    user_ids = []
+    nan_filled = 0
+    for row, (user_id, label, parsed_session) in enumerate(labeled):
+        feature_values = np.array(extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map), dtype=np.float64)
+        nan_mask = np.isnan(feature_values)
+        if nan_mask.any():
+            feature_values[nan_mask] = 0.0 # Same NaN handling as the service before scaling
+            nan_filled += int(nan_mask.sum())
+        features[row] = feature_values
+        labels[row] = label
+        user_ids.append(user_id)
+
+    test_name = os.path.splitext(os.path.basename(source_path))[0]
+    paths = shard_paths(store_dir, test_name)
+    _save_atomic(paths['features'], lambda f: np.save(f, features))
+    _save_atomic(paths['labels'], lambda f: np.save(f, labels))
+    _save_atomic(paths['users'], lambda f: f.write(json.dumps(user_ids).encode('utf-8')))
+
+    return {
+        "test_id": source.test_id,
+        "rows": len(labeled),
+        "positives": int(labels.sum()),
+        "users": num_users,
+        "skipped_errors": num_errors,
+        "skipped_unlabeled": num_unlabeled,
+        "nan_filled": nan_filled,
+        "build_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def _build_task(task):
+    test_name, source_path, store_dir, label_field = task
+    try:
+        return test_name, build_test_shard(source_path, store_dir, label_field), None
+    except Exception as e:
+        return test_name, None, str(e)
+
+
+# --- Store ---
+def load_manifest(store_dir):
+    """The store's manifest, or None if there is none (or it is unreadable)."""
+    try:
+        with open(os.path.join(store_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def build_feature_store(logs_dir, store_dir, workers=None, label_field='label', force=False):
+    """
+    Brings store_dir up to date with the *.jsonl files of logs_dir.
+    Args:
+        workers (int, optional): Tests built in parallel (default FEATURE_WORKERS).
+        force (bool): Rebuild every test.
+    Returns:
+        dict: {"built": [...], "unchanged": [...], "removed": [...], "failed": {test: error}, "manifest": manifest}
+    """
+    workers = FEATURE_WORKERS if workers is None else workers
+    os.makedirs(store_dir, exist_ok=True)
+    code_version = feature_code_version()
+
+    previous = load_manifest(store_dir)
+    previous_tests = {}
+    if (not force and previous and previous.get('format_version') == STORE_FORMAT_VERSION
+            and previous.get('feature_code_version') == code_version and previous.get('feature_names') == FEATURE_NAMES_IN_ORDER):
+        previous_tests = previous.get('tests', {})
+    elif previous:
+        # Keep the file entries so unchanged logs are still recognized without hashing them twice
+        previous_tests = {name: {**entry, "stale": True} for name, entry in previous.get('tests', {}).items()}
+
+    tests, tasks, unchanged = {}, [], []
+    for file_name in sorted(os.listdir(logs_dir)):
+        if not file_name.endswith('.jsonl'):
+            continue
+        test_name = file_name[:-len('.jsonl')]
+        source_path = os.path.join(logs_dir, file_name)
+        entry = previous_tests.get(test_name)
+        state = _source_state(source_path, entry)
+        paths = shard_paths(store_dir, test_name)
+        if (entry and not entry.get('stale') and entry.get('source_sha256') == state['source_sha256']
+                and all(os.path.exists(path) for path in paths.values())):
+            tests[test_name] = {**entry, **state}
+            unchanged.append(test_name)
+        else:
+            tests[test_name] = state
+            tasks.append((test_name, source_path, store_dir, label_field))
+
+    built, failed = [], {}
+    if tasks:
+        if workers > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context(POOL_START_METHOD)
+            with context.Pool(processes=min(workers, len(tasks))) as pool:
+                results = list(pool.imap_unordered(_build_task, tasks))
+        else:
+            results = [_build_task(task) for task in tasks]
+        for test_name, entry, error in results:
+            if error is not None:
+                print(f"Warning: Could not build the shard of test {test_name}: {error}")
+                failed[test_name] = error
+                del tests[test_name]
+            else:
+                tests[test_name].update(entry)
+                built.append(test_name)
+
+    removed = []
+    for test_name in previous_tests:
+        if test_name not in tests and test_name not in failed:
+            for path in shard_paths(store_dir, test_name).values():
+                if os.path.exists(path):
+                    os.remove(path)
+            removed.append(test_name)
+
+    manifest = {
+        "format_version": STORE_FORMAT_VERSION,
+        "feature_names": list(FEATURE_NAMES_IN_ORDER),
+        "feature_code_version": code_version,
+        "dtype": "float32",
+        "label_field": label_field,
+        "built_at": time.time(),
+        "tests": {test_name: tests[test_name] for test_name in sorted(tests)},
+    }
+    _save_atomic(os.path.join(store_dir, MANIFEST_NAME), lambda f: f.write(json.dumps(manifest, indent=2).encode('utf-8')))
+    return {"built": sorted(built), "unchanged": unchanged, "removed": removed, "failed": failed, "manifest": manifest}
+
+
+def load_feature_matrix(store_dir, tests=None, mmap=True):
+    """
+    Reads shards back as one training set.
+    Args:
+        tests (list, optional): Test names to include (default: every test in the manifest).
+        mmap (bool): Memory-map the shards; with a single test nothing is copied.
+    Returns:
+        tuple: (features float32 array, labels int8 array, test name per row)
+    Raises:
+        ValueError: If the store has no manifest or was built with other feature code.
+    """
+    manifest = load_manifest(store_dir)
+    if manifest is None:
+        raise ValueError(f"No feature store manifest in {store_dir}")
+    if manifest.get('feature_names') != FEATURE_NAMES_IN_ORDER or manifest.get('feature_code_version') != feature_code_version():
+        raise ValueError(f"Feature store {store_dir} was built with other feature code; rebuild it")
+
+    names = list(manifest['tests']) if tests is None else list(tests)
+    mmap_mode = 'r' if mmap else None
+    feature_shards, label_shards, row_tests = [], [], []
+    for test_name in names:
+        paths = shard_paths(store_dir, test_name)
+        feature_shards.append(np.load(paths['features'], mmap_mode=mmap_mode))
+        label_shards.append(np.load(paths['labels'], mmap_mode=mmap_mode))
+        row_tests.extend([test_name] * len(label_shards[-1]))
+
+    if len(feature_shards) == 1:
+        return feature_shards[0], label_shards[0], row_tests
+    if not feature_shards:
+        return np.zeros((0, len(FEATURE_NAMES_IN_ORDER)), dtype=np.float32), np.zeros(0, dtype=np.int8), row_tests
+    return np.concatenate(feature_shards), np.concatenate(label_shards), row_tests
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the training feature store from labeled session logs.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help="Build or incrementally update a feature store")
+    build_parser.add_argument('logs_dir', help="Directory of per-test JSONL files (/predict_batch_stream layout, with a label per user)")
+    build_parser.add_argument('store_dir', help="Output directory for the shards and manifest")
+    build_parser.add_argument('--workers', type=int, default=FEATURE_WORKERS, help="Tests built in parallel")
+    build_parser.add_argument('--label-field', default='label', help="Field of each user line holding the 0/1 label")
+    build_parser.add_argument('--force', action='store_true', help="Rebuild every test")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    try:
+        result = build_feature_store(args.logs_dir, args.store_dir, args.workers, args.label_field, args.force)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    rows = sum(entry.get('rows', 0) for entry in result['manifest']['tests'].values())
+    print(f"Built {len(result['built'])} tests, {len(result['unchanged'])} unchanged, {len(result['removed'])} removed, "
+          f"{len(result['failed'])} failed; {rows} rows in {args.store_dir} ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+    return 1 if result['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+from calculate_global_stats import QuestionStatsAccumulator
+
+# --- Configuration ---
+STATS_STORE_DIR = os.environ.get(
+    'PREDICTION_STATS_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'global_stats_store'),
+)
+# Number of (test, question set) entries kept in memory in front of the disk files
+STATS_STORE_CAPACITY = int(os.environ.get('PREDICTION_STATS_STORE_CAPACITY', '128'))
+
+
+def question_set_hash(questions_data_map):
+    """
+    Short stable hash of a test's questions and their correct answers. Stats are only reused
+    for exactly the same question set, so editing a test starts a new baseline.
+    """
+    canonical = json.dumps(
+        sorted([q_id, details.get("correct_answer")] for q_id, details in questions_data_map.items()),
+        separators=(',', ':'), default=str,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def _session_digest(session_id):
+    """Stored in place of the session ids themselves, so entries stay small and hold no user ids."""
+    return hashlib.sha256(str(session_id).encode('utf-8')).hexdigest()[:16]
+
+
+class GlobalStatsStore:
+    """
+    On-disk store of per-test QuestionStatsAccumulator state, keyed by (test id, question set hash),
+    with an in-memory LRU in front of it. Lets /predict_single score against a real cohort baseline
+    with a lookup instead of recomputing stats over the whole cohort.
+
+    Each entry is one JSON file: {"test_id", "question_set_hash", "num_sessions", "session_ids", "updated_at",
+    "accumulator"}, where session_ids holds a digest of every session folded in, so a session is only counted once.
+    Updates are serialized within a process by a lock and across processes by a lock file next to the entry (where
+    fcntl is available). Cached entries are revalidated against the file's mtime, so writes by other processes
+    are picked up.
+    """
+
+    def __init__(self, directory=STATS_STORE_DIR, capacity=STATS_STORE_CAPACITY):
+        self.directory = directory
+        self.capacity = capacity
+        self._entries = OrderedDict() # key -> {"entry": dict, "stats": dict or None, "mtime": ns}
+        self._lock = threading.Lock()
+
+    def _key(self, test_id, questions_data_map):
+        return str(test_id), question_set_hash(questions_data_map)
+
+    def _path(self, key):
+        test_id, q_hash = key
+        safe_test_id = re.sub(r'[^A-Za-z0-9_.-]', '_', test_id)
+        return os.path.join(self.directory, f"{safe_test_id}-{q_hash}.json")
+
+    def _mtime(self, key):
+        try:
+            return os.stat(self._path(key)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self, key):
+        mtime = self._mtime(key)
+        cached = self._entries.get(key)
+        if cached is not None and cached["mtime"] == mtime:
+            self._entries.move_to_end(key)
+            return cached
+        if mtime is None:
+            self._entries.pop(key, None)
+            return None
+
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read global stats for test {key[0]}: {e}")
+            return None
+        return self._remember(key, entry, mtime)
+
+    def _remember(self, key, entry, mtime):
+        cached = {"entry": entry, "stats": None, "mtime": mtime}
+        self._entries[key] = cached
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return cached
+
+    @contextlib.contextmanager
+    def _file_lock(self, key):
+        """Exclusive lock across processes for a read-modify-write of one entry."""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{self._path(key)}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save(self, key, accumulator, num_sessions, session_ids):
+        entry = {
+            "test_id": key[0],
+            "question_set_hash": key[1],
+            "num_sessions": num_sessions,
+            "session_ids": sorted(session_ids),
+            "updated_at": time.time(),
+            "accumulator": accumulator.to_dict(),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, separators=(',', ':'))
+        os.replace(tmp_path, path) # atomic, readers never see a half-written file
+        return self._remember(key, entry, self._mtime(key))
+
+    def get_global_stats(self, test_id, questions_data_map):
+        """
+        Returns:
+            tuple: (batch_global_stats dict, number of sessions behind it), or (None, 0) if the test
+                   has no stored baseline for this question set.
+        """
+        key = self._key(test_id, questions_data_map)
+        with self._lock:
+            cached = self._load(key)
+            if cached is None:
+                return None, 0
+            if cached["stats"] is None:
+                accumulator = QuestionStatsAccumulator(cached["entry"]["accumulator"])
+                cached["stats"] = accumulator.to_global_stats(questions_data_map)
+            return cached["stats"], cached["entry"]["num_sessions"]
+
+    def put(self, test_id, questions_data_map, accumulator, num_sessions, session_ids=()):
+        """
+        Replaces the baseline of a test with the accumulator of a full cohort (e.g. a /predict_batch call).
+        session_ids (e.g. userIds) identify the cohort's sessions, so add_session does not count them again.
+        """
+        key = self._key(test_id, questions_data_map)
+        with self._lock, self._file_lock(key):
+            self._save(key, accumulator, num_sessions, {_session_digest(session_id) for session_id in session_ids})
+
+    def add_session(self, test_id, questions_data_map, session_log_events, session_id, parsed_session=None):
+        """
+        Folds one new session into the stored baseline of a test, creating it if needed.
+        Args:
+            session_id: Identifies the session (e.g. its userId); a session already in the baseline is skipped.
+        Returns:
+            bool: Whether the session was folded in.
+        """
+        key = self._key(test_id, questions_data_map)
+        digest = _session_digest(session_id)
+        with self._lock, self._file_lock(key):
+            cached = self._load(key)
+            if cached is None:
+                accumulator, num_sessions, session_ids = QuestionStatsAccumulator(), 0, set()
+            else:
+                session_ids = set(cached["entry"].get("session_ids", ()))
+                if digest in session_ids:
+                    return False
+                accumulator = QuestionStatsAccumulator(cached["entry"]["accumulator"])
+                num_sessions = cached["entry"]["num_sessions"]
+            accumulator.add_session(session_log_events, questions_data_map, parsed_session)
+            session_ids.add(digest)
+            self._save(key, accumulator, num_sessions + 1, session_ids)
+            return True
@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from event_decoding import decode_events, timestamp_key
+from global_stats_store import question_set_hash
+from session_parser import ParsedSession, WalkState, apply_records, score_answers
+
+# --- Configuration ---
+# Live sessions kept in memory; the least recently updated one is evicted beyond this
+LIVE_SESSIONS_CAPACITY = int(os.environ.get('PREDICTION_LIVE_SESSIONS', '10000'))
+# Seconds without an update or read after which a live session is dropped
+LIVE_SESSION_IDLE_TTL = float(os.environ.get('PREDICTION_LIVE_SESSION_TTL', '3600'))
+
+
+class LiveSession:
+    """
+    Incremental version of session_parser.parse_session for a session that is still in progress.
+
+    append() runs only the new events through the question state machine (session_parser.apply_records), so each
+    update costs O(new events); snapshot() returns the ParsedSession parse_session would build from all events so far.
+    parse_session treats the final event of a log specially (it closes the current question's timer), and
+    the final event of a live log changes with every update, so the most recent event is held back as
+    `pending`: it is applied as a regular event once a later one arrives, and as the final one by snapshot().
+
+    Decoded event records are kept so that events arriving out of timestamp order, or a new question set,
+    can be handled by replaying the session from scratch.
+    """
+
+    def __init__(self, questions_data_map):
+        self.questions_data_map = questions_data_map
+        self.question_set_hash = question_set_hash(questions_data_map)
+        self.records = []
+        self._reset()
+
+    def _reset(self):
+        self.session = ParsedSession()
+        self.state = WalkState()
+        self.pending = None
+
+    @property
+    def num_events(self):
+        return len(self.records)
+
+    def _advance(self, record):
+        """Applies the pending event as a regular one and makes record the pending event."""
+        if self.pending is not None:
+            apply_records(self.session, self.state, (self.pending,), False, self.questions_data_map)
+        else:
+            self.session.start_time = record[0]
+        self.pending = record
+
+    def _replay(self):
+        self.records.sort(key=timestamp_key)
+        self._reset()
+        for record in self.records:
+            self._advance(record)
+
+    def append(self, session_log_events):
+        """
+        Adds new log events (same shape as session_log_events) to the session.
+        Returns:
+            int: Number of events with a parseable timestamp that were added.
+        """
+        new_records = decode_events(session_log_events)
+        if not new_records:
+            return 0
+        new_records.sort(key=timestamp_key)
+
+        if self.pending is not None and new_records[0][0] < self.pending[0]:
+            # Out of order: parse_session would sort these in among the earlier events
+            self.records.extend(new_records)
+            self._replay()
+        else:
+            self.records.extend(new_records)
+            for record in new_records:
+                self._advance(record)
+        return len(new_records)
+
+    def set_questions(self, questions_data_map):
+        """Switches to another question set (e.g. the test was edited); replays the session if it changed."""
+        q_hash = question_set_hash(questions_data_map)
+        if q_hash != self.question_set_hash:
+            self.questions_data_map, self.question_set_hash = questions_data_map, q_hash
+            self._replay()
+
+    def snapshot(self):
+        """
+        Returns:
+            ParsedSession: Equal to parse_session() of every event appended so far. The live state is not modified.
+        """
+        parsed = ParsedSession()
+        if self.pending is None:
+            return parsed
+
+        session = self.session
+        parsed.num_events = len(self.records)
+        parsed.start_time = session.start_time
+        parsed.end_time = self.pending[0]
+        parsed.first_answer_time = session.first_answer_time
+        parsed.last_answer_time = session.last_answer_time
+        parsed.submit_time = session.submit_time
+        parsed.question_metrics = {q_id: metrics.copy() for q_id, metrics in session.question_metrics.items()}
+        state = self.state.copy()
+        apply_records(parsed, state, (self.pending,), True, self.questions_data_map)
+        score_answers(parsed, state, self.questions_data_map)
+        return parsed
+
+
+class LiveSessionTable:
+    """
+    Bounded in-memory table of LiveSession objects keyed by (test_id, user_id). Sessions idle for longer than
+    idle_ttl seconds are dropped, and beyond `capacity` the least recently used one is evicted.
+
+    The table is local to the process: under serve.py with several workers, consecutive updates of one
+    session may reach different workers, so live scoring needs PREDICTION_SERVE_WORKERS=1.
+    """
+
+    def __init__(self, capacity=LIVE_SESSIONS_CAPACITY, idle_ttl=LIVE_SESSION_IDLE_TTL):
+        self.capacity = capacity
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict() # (test_id, user_id) -> [LiveSession, last access], least recently used first
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def _expire(self, now):
+        while self._sessions:
+            key, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access <= self.idle_ttl:
+                break
+            del self._sessions[key]
+            self.expired += 1
+
+    def _touch(self, key, now):
+        entry = self._sessions.get(key)
+        if entry is not None:
+            entry[1] = now
+            self._sessions.move_to_end(key)
+        return entry
+
+    def append(self, test_id, user_id, session_log_events, questions_data_map=None, snapshot=False):
+        """
+        Appends events to a session, creating it if needed.
+        Args:
+            questions_data_map (dict): Required to create a session; if given for an existing one, it replaces its question set.
+            snapshot (bool): Also return the session's state after the update, as get() does.
+        Returns:
+            tuple: (number of events added, total events, created flag, (ParsedSession, questions_data_map) or None)
+        Raises:
+            KeyError: If the session does not exist and no questions_data_map was given.
+        """
+        key = (str(test_id), str(user_id))
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._touch(key, now)
+            created = entry is None
+            if created:
+                if not questions_data_map:
+                    raise KeyError(f"Unknown live session {key[0]}/{key[1]}; send questions_data to start it")
+                entry = self._sessions[key] = [LiveSession(questions_data_map), now]
+                while len(self._sessions) > self.capacity:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            elif questions_data_map:
+                entry[0].set_questions(questions_data_map)
+
+            live_session = entry[0]
+            added = live_session.append(session_log_events or [])
+            current = (live_session.snapshot(), live_session.questions_data_map) if snapshot else None
+            return added, live_session.num_events, created, current
+
+    def get(self, test_id, user_id):
+        """
+        Returns:
+            tuple: (ParsedSession snapshot, questions_data_map) of the session, or (None, None) if it is unknown or expired.
+        """
+        key = (str(test_id), str(user_id))
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._touch(key, now)
+            if entry is None:
+                return None, None
+            return entry[0].snapshot(), entry[0].questions_data_map
+
+    def remove(self, test_id, user_id):
+        """Drops a session (e.g. once the test is submitted). Returns False if it was not in the table."""
+        with self._lock:
+            return self._sessions.pop((str(test_id), str(user_id)), None) is not None
+
+    def counters(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {"sessions": len(self._sessions), "capacity": self.capacity, "evicted": self.evicted, "expired": self.expired}
@@ -0,0 +1,163 @@
+"""
+Memory-budgeted batch execution.
+
+MemoryBudget samples the process's resident set size while a batch is processed and reports when it
+reaches the configured cap. From then on the batch keeps the decoded event records of further sessions
+in a RecordSpill, flat files on disk in the layout of score_offline's binary export, instead of keeping
+their parsed sessions in memory; they are memory-mapped and parsed again when scored.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+from event_decoding import columns_to_records, NO_OPTION, NO_LOCATION
+
+# --- Configuration ---
+# Resident memory (MB) at which a batch starts spilling session records to disk (0 = never)
+MEMORY_BUDGET_MB = float(os.environ.get('PREDICTION_MEMORY_BUDGET_MB', '0'))
+# Directory for spill files; empty for the system temporary directory
+SPILL_DIR = os.environ.get('PREDICTION_SPILL_DIR') or None
+# Sessions processed between two RSS samples
+RSS_SAMPLE_INTERVAL = int(os.environ.get('PREDICTION_RSS_SAMPLE_INTERVAL', '64'))
+
+SPILL_COLUMNS = {
+    'timestamps_us': np.int64,
+    'codes': np.int8,
+    'options': np.int32, # NO_OPTION when the event has no option index
+    'locations': np.int32, # index into RecordSpill.location_values, or NO_LOCATION
+}
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def peak_rss():
+    """Largest resident set size of this process so far, in bytes (0 where the platform does not report it)."""
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024 # bytes on macOS, KiB elsewhere
+
+
+def current_rss():
+    """Resident set size of this process, in bytes (the peak where /proc is not available)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+class MemoryBudget:
+    """
+    RSS cap of one batch. The RSS is process-wide, so concurrent batches in the same process count against
+    each other's budget.
+    """
+
+    def __init__(self, limit_bytes, sample_interval=RSS_SAMPLE_INTERVAL):
+        self.limit_bytes = limit_bytes
+        self.sample_interval = max(sample_interval, 1)
+        self.peak_rss = current_rss()
+        self.reached = False
+        self._calls = 0
+
+    @classmethod
+    def from_megabytes(cls, megabytes):
+        return cls(int(megabytes * 1024 * 1024))
+
+    def sample(self):
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def exceeded(self):
+        """Whether the cap has been reached; checked every sample_interval calls, and final once true."""
+        if not self.reached:
+            self._calls += 1
+            if self._calls % self.sample_interval == 1 or self.sample_interval == 1:
+                self.reached = self.sample() >= self.limit_bytes
+        return self.reached
+
+    def to_dict(self, spill=None):
+        self.sample()
+        return {
+            "memory_budget_bytes": self.limit_bytes,
+            "budget_reached": self.reached,
+            "peak_rss_bytes": self.peak_rss,
+            "sessions_spilled": len(spill) if spill is not None else 0,
+            "bytes_spilled": spill.bytes_spilled if spill is not None else 0,
+        }
+
+
+class RecordSpill:
+    """
+    Decoded event records (see event_decoding.decode_events) of many sessions, appended to one flat file per
+    field in a temporary directory and read back through memory maps. close() removes the files.
+    """
+
+    def __init__(self, directory=SPILL_DIR):
+        self.path = tempfile.mkdtemp(prefix='prediction-spill-', dir=directory)
+        self._files = {name: open(os.path.join(self.path, f"{name}.bin"), 'wb') for name in SPILL_COLUMNS}
+        self._offsets = [0]
+        self._location_indexes = {}
+        self.location_values = []
+        self.bytes_spilled = 0
+        self._arrays = None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, records):
+        """Writes one session's records. Returns its index."""
+        if self._arrays is not None:
+            raise ValueError("RecordSpill is read-only once read from")
+        timestamps, codes, options, locations = zip(*records) if records else ((), (), (), ())
+        location_indexes = []
+        for location in locations:
+            if location is None:
+                location_indexes.append(NO_LOCATION)
+                continue
+            index = self._location_indexes.get(location)
+            if index is None:
+                index = self._location_indexes[location] = len(self.location_values)
+                self.location_values.append(location)
+            location_indexes.append(index)
+
+        for name, values in (('timestamps_us', timestamps), ('codes', codes),
+                             ('options', [NO_OPTION if option is None else option for option in options]),
+                             ('locations', location_indexes)):
+            data = np.asarray(values, dtype=SPILL_COLUMNS[name]).tobytes()
+            self._files[name].write(data)
+            self.bytes_spilled += len(data)
+        self._offsets.append(self._offsets[-1] + len(records))
+        return len(self._offsets) - 2
+
+    def _open(self):
+        if self._arrays is None:
+            arrays = {}
+            for name, dtype in SPILL_COLUMNS.items():
+                self._files[name].close()
+                path = os.path.join(self.path, f"{name}.bin")
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r') if os.path.getsize(path) else np.empty(0, dtype=dtype)
+            self._arrays = arrays
+        return self._arrays
+
+    def records(self, index):
+        """The records of the session appended as index, in the order they were written."""
+        arrays = self._open()
+        begin, end = self._offsets[index], self._offsets[index + 1]
+        return columns_to_records(arrays['timestamps_us'][begin:end], arrays['codes'][begin:end],
+                                  arrays['options'][begin:end], arrays['locations'][begin:end], self.location_values)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._arrays = None
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,524 @@
+"""
+Versioned model artifacts with hot-swap.
+
+A registry directory (PREDICTION_MODEL_REGISTRY_DIR) holds one sub-directory per version:
+
+    registry/
+        CURRENT                      name of the version to serve (optional: the last version by name otherwise)
+        2025-01-15/
+            xgboost_model.joblib
+            scaler.joblib
+            features.json            feature names in the order the model expects (optional)
+        2025-02-01/
+            ...
+
+Without a registry directory the artifacts next to this module are served as version 'bundled'.
+
+`python model_registry.py compile VERSION_DIR` adds a compiled_model/ directory to a version (see
+fast_inference.CompiledScorer). With PREDICTION_FAST_START=1 versions load from it: memory-mapped arrays
+instead of unpickling, without importing joblib, XGBoost, scikit-learn or pandas.
+
+activate() loads a version, scores a synthetic warm-up batch with it and only then makes it current, so the
+requests after a swap do not pay the cold-start costs and a broken version never serves. Requests pin the
+version that is current when they start (pin/unpin), and a replaced version is released once its last
+pinned request has finished. Each process polls CURRENT (start_watcher), so writing it switches every
+worker of serve.py.
+"""
+import argparse
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import fast_inference
+import service_metrics
+from extract_features import extract_feature_vector, FEATURE_NAMES_IN_ORDER
+
+# --- Configuration ---
+# Directory of versioned artifact sub-directories; empty to serve the artifacts bundled with the service
+MODEL_REGISTRY_DIR = os.environ.get('PREDICTION_MODEL_REGISTRY_DIR', '')
+# Seconds between two checks of the registry's CURRENT file (0 = never; switch with activate() only)
+MODEL_WATCH_INTERVAL = float(os.environ.get('PREDICTION_MODEL_WATCH_INTERVAL', '5'))
+# Sessions in the synthetic batch scored by a version before it goes live
+WARM_UP_SESSIONS = int(os.environ.get('PREDICTION_MODEL_WARM_UP_SESSIONS', '64'))
+# Load versions from their compiled_model/ directory when they have an up-to-date one
+FAST_START = os.environ.get('PREDICTION_FAST_START', '0') == '1'
+
+BUNDLED_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_VERSION = 'bundled'
+MODEL_FILENAME = 'xgboost_model.joblib'
+SCALER_FILENAME = 'scaler.joblib'
+FEATURES_FILENAME = 'features.json'
+CURRENT_FILENAME = 'CURRENT'
+COMPILED_DIRNAME = 'compiled_model'
+
+# Probability at or below which XGBClassifier.predict returns label 0
+PREDICTION_THRESHOLD = 0.5
+
+
+class ModelLoadError(Exception):
+    """Raised when a version's artifacts cannot be loaded or fail the warm-up."""
+
+
+def artifacts_digest(path):
+    """sha256 of a version's joblib artifacts, recorded in compiled_model/ to detect stale compilations."""
+    digest = hashlib.sha256()
+    for filename in (MODEL_FILENAME, SCALER_FILENAME):
+        with open(os.path.join(path, filename), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelVersion:
+    """The model and scaler of one version, with the inference path chosen for them (see fast_inference)."""
+
+    def __init__(self, version, path, model, scaler, feature_names):
+        self.version = version
+        self.path = path
+        self.model = model
+        self.scaler = scaler
+        self.feature_names = feature_names
+        self.loaded_at = time.time()
+        self.warm_up_seconds = None
+        self.booster_scorer = None
+        self.in_flight = 0 # requests that pinned this version and have not finished
+        self.retired = False
+
+    @classmethod
+    def load(cls, version, path, compiled=FAST_START):
+        """
+        Args:
+            compiled (bool): Load compiled_model/ (see load_compiled) when the version has an up-to-date one.
+        Raises:
+            ModelLoadError: If an artifact is missing or unreadable, or the feature list is not FEATURE_NAMES_IN_ORDER.
+        """
+        if compiled:
+            model_version = cls.load_compiled(version, path)
+            if model_version is not None:
+                return model_version
+
+        import joblib # unpickling the model imports XGBoost and scikit-learn
+        try:
+            model = joblib.load(os.path.join(path, MODEL_FILENAME))
+            scaler = joblib.load(os.path.join(path, SCALER_FILENAME))
+        except Exception as e:
+            raise ModelLoadError(f"Could not load the artifacts of model version '{version}' from {path}: {e}")
+
+        feature_names = list(FEATURE_NAMES_IN_ORDER)
+        features_path = os.path.join(path, FEATURES_FILENAME)
+        if os.path.exists(features_path):
+            try:
+                with open(features_path, 'r', encoding='utf-8') as f:
+                    feature_names = json.load(f)
+            except (OSError, ValueError) as e:
+                raise ModelLoadError(f"Could not read {features_path}: {e}")
+            if feature_names != FEATURE_NAMES_IN_ORDER:
+                raise ModelLoadError(f"Model version '{version}' expects other features than this service computes: {feature_names}")
+        return cls(version, path, model, scaler, feature_names)
+
+    @classmethod
+    def load_compiled(cls, version, path):
+        """The version's compiled_model/, or None (with a warning) if it has none or it is stale."""
+        compiled_path = os.path.join(path, COMPILED_DIRNAME)
+        if not os.path.isdir(compiled_path):
+            print(f"Warning: Model version '{version}' has no {COMPILED_DIRNAME}/ (python model_registry.py compile {path}); loading the joblib artifacts.")
+            return None
+        try:
+            scorer, meta = fast_inference.CompiledScorer.load(compiled_path)
+            if os.path.exists(os.path.join(path, MODEL_FILENAME)) and meta.get('artifacts_sha256') != artifacts_digest(path):
+                print(f"Warning: {compiled_path} was compiled from other artifacts than {path}'s; loading the joblib artifacts.")
+                return None
+        except (OSError, ValueError, KeyError) as e:
+            raise ModelLoadError(f"Could not load the compiled artifacts of model version '{version}' from {compiled_path}: {e}")
+        if meta.get('feature_names') != FEATURE_NAMES_IN_ORDER:
+            raise ModelLoadError(f"Model version '{version}' expects other features than this service computes: {meta.get('feature_names')}")
+
+        model_version = cls(version, path, None, None, meta['feature_names'])
+        model_version.booster_scorer = scorer
+        return model_version
+
+    def set_inference_threads(self, nthread):
+        if self.model is not None:
+            self.model.n_jobs = nthread # DMatrix fallback path
+            self.model.get_booster().set_param({'nthread': nthread}) # inplace_predict path
+
+    def _score_with_sklearn(self, feature_matrix):
+        """scaler.transform on a DataFrame, then model.predict_proba: the reference path BoosterScorer is checked against."""
+        import pandas as pd
+        features_for_scaling = pd.DataFrame(feature_matrix, columns=FEATURE_NAMES_IN_ORDER)
+        probabilities = self.model.predict_proba(self.scaler.transform(features_for_scaling))[:, 1]
+        return (probabilities > PREDICTION_THRESHOLD).astype(np.int64), probabilities
+
+    def select_inference_path(self):
+        """Uses a BoosterScorer if PREDICTION_INFERENCE_PATH selects it and it passes the parity check."""
+        if self.model is None: # compiled artifacts: CompiledScorer is the only path
+            return
+        self.booster_scorer = None
+        if fast_inference.INFERENCE_PATH != 'booster':
+            return
+        try:
+            scorer = fast_inference.BoosterScorer.from_artifacts(self.model, self.scaler, PREDICTION_THRESHOLD)
+            ok, max_difference, label_mismatches = fast_inference.check_parity(scorer, self._score_with_sklearn,
+                                                                               fast_inference.parity_probe(self.scaler))
+        except Exception as e:
+            print(f"Warning: Booster inference path unavailable for model version '{self.version}' ({e}); "
+                  f"using scaler.transform and model.predict_proba.")
+            return
+        if not ok:
+            print(f"Warning: Booster inference path failed the parity check for model version '{self.version}' "
+                  f"(max probability difference {max_difference:.3g}, {label_mismatches} label mismatches); "
+                  f"using scaler.transform and model.predict_proba.")
+            return
+        print(f"Booster inference path enabled for model version '{self.version}' (max probability difference {max_difference:.3g} on the parity probe).")
+        self.booster_scorer = scorer
+
+    def score(self, feature_matrix):
+        """
+        Scales and scores a batch of feature vectors with one scaler and one model call.
+        Args:
+            feature_matrix (np.ndarray): Array of shape (n_sessions, n_features) ordered by FEATURE_NAMES_IN_ORDER.
+        Returns:
+            tuple: (labels, probabilities) arrays, where probabilities is P(cheat) per row and
+                   labels are derived from it the same way model.predict does.
+        """
+        if self.booster_scorer is not None:
+            with service_metrics.stage('scaling'):
+                scaled_features = self.booster_scorer.transform(feature_matrix)
+            with service_metrics.stage('inference'):
+                probabilities = self.booster_scorer.predict(scaled_features)
+            return (probabilities > PREDICTION_THRESHOLD).astype(np.int64), probabilities
+
+        import pandas as pd
+        with service_metrics.stage('scaling'):
+            features_for_scaling = pd.DataFrame(feature_matrix, columns=FEATURE_NAMES_IN_ORDER)
+            scaled_features_array = self.scaler.transform(features_for_scaling)
+        with service_metrics.stage('inference'):
+            probabilities = self.model.predict_proba(scaled_features_array)[:, 1]
+        labels = (probabilities > PREDICTION_THRESHOLD).astype(np.int64)
+        return labels, probabilities
+
+    def warm_up(self, feature_matrix):
+        """
+        Scores feature_matrix twice (the first call pays the one-off costs).
+        Raises:
+            ModelLoadError: If scoring fails or returns something other than one probability per row.
+        """
+        started = time.perf_counter()
+        try:
+            for _ in range(2):
+                labels, probabilities = self.score(feature_matrix)
+        except Exception as e:
+            raise ModelLoadError(f"Model version '{self.version}' failed its warm-up: {e}")
+        probabilities = np.asarray(probabilities)
+        if probabilities.shape != (len(feature_matrix),) or not np.all((probabilities >= 0) & (probabilities <= 1)):
+            raise ModelLoadError(f"Model version '{self.version}' returned invalid probabilities during its warm-up")
+        self.warm_up_seconds = time.perf_counter() - started
+
+    def unload(self):
+        """Drops the artifacts once the version is retired and no request uses it any more."""
+        self.model = self.scaler = self.booster_scorer = None
+        print(f"Model version '{self.version}' released.")
+
+    @property
+    def inference_path(self):
+        if isinstance(self.booster_scorer, fast_inference.CompiledScorer):
+            return 'compiled'
+        return 'booster' if self.booster_scorer is not None else 'sklearn'
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+            "warm_up_seconds": self.warm_up_seconds,
+            "inference_path": self.inference_path,
+            "in_flight": self.in_flight,
+        }
+
+
+def _warm_up_matrix(num_sessions=WARM_UP_SESSIONS):
+    """Feature matrix of a synthetic batch (see synthetic_logs), featurized like /predict_batch does."""
+    from calculate_global_stats import compute_batch_global_stats
+    from session_parser import parse_session
+    from synthetic_logs import generate_batch
+
+    batch = generate_batch(num_students=max(num_sessions, 1), num_questions=20, events_per_session=60, cheat_ratio=0.2, seed=0)
+    questions_data_map = {q["id"]: q for q in batch["questions_data"]}
+    parsed_sessions = [parse_session(user["session_log_events"], questions_data_map) for user in batch["all_user_logs"]]
+    global_stats = compute_batch_global_stats(batch["all_user_logs"], questions_data_map, parsed_sessions)
+    return np.nan_to_num(np.array([extract_feature_vector(parsed, global_stats, questions_data_map) for parsed in parsed_sessions], dtype=np.float64))
+
+
+_pinned_version = contextvars.ContextVar('prediction_model_version', default=None)
+
+
+class ModelRegistry:
+    """
+    The model versions of this process: the current one, and replaced ones still used by in-flight requests.
+    """
+
+    def __init__(self, root=MODEL_REGISTRY_DIR, watch_interval=MODEL_WATCH_INTERVAL):
+        self.root = root
+        self.watch_interval = watch_interval
+        self.current = None
+        self._retired = [] # replaced versions with requests still in flight
+        self._lock = threading.Lock()
+        self._activate_lock = threading.Lock() # one load / warm-up at a time
+        self._nthread = None
+        self._warm_up_matrix = None
+        self._watcher = None
+        self._watched_version = None
+        self._loaded = threading.Event() # set once load_initial has finished, successfully or not
+        self.load_error = None
+        self.loaded_at = None # time.perf_counter() when load_initial finished
+
+    # --- Versions on disk ---
+    def version_path(self, version):
+        if not self.root:
+            if version != BUNDLED_VERSION:
+                raise ModelLoadError(f"Unknown model version '{version}' (no model registry directory configured)")
+            return BUNDLED_DIR
+        if not version or version in ('.', '..') or os.path.basename(version) != version:
+            raise ModelLoadError(f"Invalid model version name '{version}'")
+        path = os.path.join(self.root, version)
+        if not os.path.isdir(path):
+            raise ModelLoadError(f"Unknown model version '{version}'")
+        return path
+
+    def available_versions(self):
+        if not self.root:
+            return [BUNDLED_VERSION]
+        try:
+            return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+        except OSError:
+            return []
+
+    def requested_version(self):
+        """The version CURRENT names, else the last one by name (bundled without a registry directory)."""
+        if not self.root:
+            return BUNDLED_VERSION
+        try:
+            with open(os.path.join(self.root, CURRENT_FILENAME), 'r', encoding='utf-8') as f:
+                version = f.read().strip()
+            if version:
+                return version
+        except OSError:
+            pass
+        versions = self.available_versions()
+        return versions[-1] if versions else None
+
+    def write_current(self, version):
+        """Records version in CURRENT, so the watchers of every process switch to it."""
+        if not self.root:
+            return
+        path = os.path.join(self.root, CURRENT_FILENAME)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, path)
+
+    # --- Loading and swapping ---
+    def activate(self, version):
+        """
+        Loads version, warms it up and makes it current; the replaced version is released after its last request.
+        Returns:
+            ModelVersion: The new current version (the existing one if version is already current).
+        Raises:
+            ModelLoadError: If the version cannot be loaded or fails its warm-up; the current version stays.
+        """
+        with self._activate_lock:
+            current = self.current
+            if current is not None and current.version == version:
+                return current
+
+            path = self.version_path(version)
+            started = time.perf_counter()
+            model_version = ModelVersion.load(version, path)
+            if self._nthread is not None:
+                model_version.set_inference_threads(self._nthread)
+            model_version.select_inference_path()
+            if self._warm_up_matrix is None:
+                self._warm_up_matrix = _warm_up_matrix()
+            model_version.warm_up(self._warm_up_matrix)
+
+            with self._lock:
+                previous, self.current = self.current, model_version
+                if previous is not None:
+                    previous.retired = True
+                    if previous.in_flight:
+                        self._retired.append(previous)
+                    else:
+                        previous.unload()
+            print(f"Model version '{version}' active (loaded and warmed up in {time.perf_counter() - started:.2f}s).")
+            return model_version
+
+    def load_initial(self):
+        """Activates the requested version at start-up. Returns False (and leaves no current version) if that fails."""
+        try:
+            version = self.requested_version()
+            if version is None:
+                self.load_error = f"No model versions found in {self.root}."
+                print(f"ERROR: {self.load_error}")
+                return False
+            try:
+                self.activate(version)
+            except ModelLoadError as e:
+                self.load_error = str(e)
+                print(f"ERROR: {e}")
+                return False
+            self._watched_version = version
+            return True
+        finally:
+            self.loaded_at = time.perf_counter()
+            self._loaded.set()
+
+    def load_in_background(self):
+        """Runs load_initial in a thread, so the process can accept requests (answered with 503) while it loads."""
+        threading.Thread(target=self.load_initial, name='model-registry-loader', daemon=True).start()
+
+    def wait_loaded(self, timeout=None):
+        """Waits for load_initial to finish. Returns the current version (None if loading failed)."""
+        self._loaded.wait(timeout)
+        return self.current
+
+    @property
+    def loading(self):
+        return not self._loaded.is_set()
+
+    def set_inference_threads(self, nthread):
+        """Caps the threads XGBoost uses per prediction call, for the current version and the ones activated later."""
+        self._nthread = nthread
+        if self.current is not None:
+            self.current.set_inference_threads(nthread)
+
+    # --- Pinning ---
+    def acquire(self):
+        """The current version (None if no model is loaded), kept loaded until release(version) is called."""
+        with self._lock:
+            model_version = self.current
+            if model_version is not None:
+                model_version.in_flight += 1
+        return model_version
+
+    def release(self, model_version):
+        if model_version is None:
+            return
+        with self._lock:
+            model_version.in_flight -= 1
+            unload = model_version.retired and model_version.in_flight == 0 and model_version in self._retired
+            if unload:
+                self._retired.remove(model_version)
+        if unload:
+            model_version.unload()
+
+    def pin(self):
+        """
+        Acquires the current version for the current context (request or job) until unpin(token); active()
+        then returns it even if another version is activated meanwhile.
+        """
+        return _pinned_version.set(self.acquire())
+
+    def unpin(self, token):
+        model_version = _pinned_version.get()
+        _pinned_version.reset(token)
+        self.release(model_version)
+
+    @contextlib.contextmanager
+    def pinned(self):
+        token = self.pin()
+        try:
+            yield _pinned_version.get()
+        finally:
+            self.unpin(token)
+
+    def active(self):
+        """The version pinned to the current context, else the current one (None if no model is loaded)."""
+        return _pinned_version.get() or self.current
+
+    # --- Watching CURRENT ---
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            version = self.requested_version()
+            if version is None or version == self._watched_version:
+                continue
+            self._watched_version = version
+            try:
+                self.activate(version)
+            except ModelLoadError as e:
+                print(f"Warning: Not switching to model version '{version}': {e}")
+
+    def start_watcher(self):
+        """Starts polling CURRENT in a daemon thread (per process: call it in each worker after forking)."""
+        if not self.root or self.watch_interval <= 0 or self._watcher is not None:
+            return
+        self._watched_version = self.current.version if self.current is not None else None
+        self._watcher = threading.Thread(target=self._watch, name='model-registry-watcher', daemon=True)
+        self._watcher.start()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "registry_dir": self.root or None,
+                "current": self.current.to_dict() if self.current is not None else None,
+                "retired_in_flight": [model_version.to_dict() for model_version in self._retired],
+                "available": self.available_versions(),
+            }
+
+
+# --- Compiling versions ---
+def compile_version(path):
+    """
+    Writes path/compiled_model/ from the joblib artifacts in path, after checking it against them.
+    Returns:
+        dict: The metadata saved with the compiled model.
+    Raises:
+        ModelLoadError: If the artifacts cannot be loaded, compiled, or the compiled model fails the parity check.
+    """
+    model_version = ModelVersion.load(os.path.basename(os.path.normpath(path)), path, compiled=False)
+    try:
+        scorer = fast_inference.CompiledScorer.from_artifacts(model_version.model, model_version.scaler, PREDICTION_THRESHOLD)
+    except ValueError as e:
+        raise ModelLoadError(f"Cannot compile {path}: {e}")
+    ok, max_difference, label_mismatches = fast_inference.check_parity(scorer, model_version._score_with_sklearn,
+                                                                       fast_inference.parity_probe(model_version.scaler))
+    if not ok:
+        raise ModelLoadError(f"Compiled model of {path} failed the parity check (max probability difference {max_difference:.3g}, "
+                             f"{label_mismatches} label mismatches)")
+
+    metadata = {
+        "feature_names": model_version.feature_names,
+        "artifacts_sha256": artifacts_digest(path),
+        "parity_max_difference": max_difference,
+    }
+    scorer.save(os.path.join(path, COMPILED_DIRNAME), metadata)
+    return metadata
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare model versions for the prediction service.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    compile_parser = subcommands.add_parser('compile', help="Write VERSION_DIR/compiled_model/ for PREDICTION_FAST_START.")
+    compile_parser.add_argument('version_dir', nargs='?', default=BUNDLED_DIR,
+                                help="Directory with xgboost_model.joblib and scaler.joblib (default: the bundled artifacts).")
+    args = parser.parse_args(argv)
+
+    try:
+        metadata = compile_version(args.version_dir)
+    except ModelLoadError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+    print(f"Compiled model written to {os.path.join(args.version_dir, COMPILED_DIRNAME)} "
+          f"(max probability difference {metadata['parity_max_difference']:.3g} on the parity probe).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
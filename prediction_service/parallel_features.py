@@ -0,0 +1,272 @@
+import atexit
+import collections
+import contextlib
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import uuid
+
+from session_parser import parse_session
+from extract_features import extract_feature_vector
+from calculate_global_stats import QuestionStatsAccumulator
+
+# --- Configuration ---
+# Worker processes for sharded feature extraction (0 = one per CPU core)
+FEATURE_WORKERS = int(os.environ.get('PREDICTION_FEATURE_WORKERS', '0')) or (os.cpu_count() or 1)
+# Sessions sent to a worker per task
+FEATURE_CHUNK_SIZE = int(os.environ.get('PREDICTION_FEATURE_CHUNK_SIZE', '256'))
+# Batches smaller than this run in-process; shipping them to the pool is not worth it
+PARALLEL_MIN_BATCH = int(os.environ.get('PREDICTION_PARALLEL_MIN_BATCH', '2000'))
+# multiprocessing start method ('fork', 'forkserver', 'spawn'). Defaults to 'forkserver' where available: the
+# service forks pools from processes running request, job and watcher threads, which 'fork' can deadlock
+POOL_START_METHOD = (os.environ.get('PREDICTION_POOL_START_METHOD')
+                     or ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None))
+
+# Per-request inputs a worker process keeps loaded, by token (see _shared_inputs)
+_WORKER_INPUTS_KEPT = 4
+
+# Long-lived pools of this process, by size (see shared_pool)
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def use_process_pool(num_sessions, workers=None):
+    """Whether a batch of num_sessions is large enough to shard across a process pool."""
+    workers = FEATURE_WORKERS if workers is None else workers
+    return workers > 1 and num_sessions >= PARALLEL_MIN_BATCH
+
+
+# --- Worker-side functions ---
+def _parse_items(items, questions_data_map, progress=None):
+    results = []
+    stats_accumulator = QuestionStatsAccumulator()
+    for session_log_events in items:
+        if not session_log_events:
+            results.append(None)
+        else:
+            try:
+                parsed_session = parse_session(session_log_events, questions_data_map)
+                stats_accumulator.add_session(session_log_events, questions_data_map, parsed_session)
+                results.append(parsed_session)
+            except Exception as e:
+                results.append(e)
+        if progress: progress(1)
+    return results, stats_accumulator
+
+
+def _featurize_items(items, questions_data_map, current_batch_global_stats, progress=None):
+    results = []
+    for parsed_session in items:
+        try:
+            results.append(extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map))
+        except Exception as e:
+            results.append(e)
+        if progress: progress(1)
+    return results
+
+
+_worker_inputs = collections.OrderedDict()
+
+
+def _shared_inputs(ref):
+    """The inputs published by _published, loaded from its file on a worker's first chunk of the request."""
+    token, path = ref
+    inputs = _worker_inputs.get(token)
+    if inputs is None:
+        with open(path, 'rb') as f:
+            inputs = _worker_inputs[token] = pickle.load(f)
+        while len(_worker_inputs) > _WORKER_INPUTS_KEPT:
+            _worker_inputs.popitem(last=False) # oldest request first
+    return inputs
+
+
+def _parse_chunk(task):
+    items, ref = task
+    questions_data_map, = _shared_inputs(ref)
+    results, stats_accumulator = _parse_items(items, questions_data_map)
+    return [_picklable(result) for result in results], stats_accumulator
+
+
+def _featurize_chunk(task):
+    items, ref = task
+    questions_data_map, current_batch_global_stats = _shared_inputs(ref)
+    return [_picklable(result) for result in _featurize_items(items, questions_data_map, current_batch_global_stats)]
+
+
+class ShardError(Exception):
+    """An exception raised while processing one session in a worker process, carried back by message."""
+
+
+def _picklable(result):
+    return ShardError(str(result)) if isinstance(result, Exception) else result
+
+
+def _featurize_group(group):
+    """Global stats and features of one whole batch, in a worker: see featurize_groups."""
+    all_user_logs_with_ids, questions_data_map, feature_engine = group
+    if feature_engine == 'columnar':
+        from columnar_features import compute_columnar_features
+        current_batch_global_stats, stats_accumulator, feature_matrix, user_errors = compute_columnar_features(all_user_logs_with_ids, questions_data_map)
+        return current_batch_global_stats, stats_accumulator, (feature_matrix, user_errors)
+
+    results, stats_accumulator = _parse_items([user_log_data.get('session_log_events') for user_log_data in all_user_logs_with_ids],
+                                              questions_data_map)
+    current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+    positions = [position for position, result in enumerate(results) if result is not None and not isinstance(result, Exception)]
+    feature_vectors = [_picklable(result) for result in results]
+    for position, result in zip(positions, _featurize_items([results[position] for position in positions],
+                                                            questions_data_map, current_batch_global_stats)):
+        feature_vectors[position] = _picklable(result)
+    return current_batch_global_stats, stats_accumulator, feature_vectors
+
+
+# --- Pool driver ---
+def shared_pool(workers=None, start_method=POOL_START_METHOD):
+    """
+    The process pool of this process with `workers` processes, started on first use and reused by every
+    request and phase (parse, featurize) after that. Pools are thread-safe; a forked child (e.g. a serve.py
+    worker) starts its own instead of using its parent's. start_method only applies when the pool is started:
+    serve.py starts its workers' pools with 'fork' while they are still single-threaded.
+    """
+    global _pools_pid
+    workers = FEATURE_WORKERS if workers is None else workers
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear() # the parent's pools; their processes are not ours to use
+            _pools_pid = os.getpid()
+        pool = _pools.get(workers)
+        if pool is None:
+            context = multiprocessing.get_context(start_method)
+            if start_method == 'forkserver':
+                # Imports the main module once in the server instead of in every pool process
+                context.set_forkserver_preload(['parallel_features'])
+            pool = _pools[workers] = context.Pool(processes=workers)
+        return pool
+
+
+def shutdown_pools():
+    """Stops the pools started by shared_pool in this process."""
+    with _pools_lock:
+        if _pools_pid == os.getpid():
+            for pool in _pools.values():
+                pool.terminate()
+                pool.join()
+        _pools.clear()
+
+
+atexit.register(shutdown_pools)
+
+
+@contextlib.contextmanager
+def _published(shared_inputs):
+    """
+    Pickles shared_inputs once to a temporary file for the duration of the block and yields a (token, path)
+    reference to it. Tasks carry the reference instead of the inputs, so each worker loads them once per request
+    rather than unpickling the question map and global stats with every chunk.
+    """
+    fd, path = tempfile.mkstemp(prefix='prediction-shard-', suffix='.pickle')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(shared_inputs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        yield uuid.uuid4().hex, path
+    finally:
+        os.unlink(path)
+
+
+def _run_sharded(chunk_fn, items, shared_inputs, workers, chunk_size):
+    """Yields chunk_fn's result for each chunk of items, in input order. Each task is (chunk, reference to shared_inputs)."""
+    with _published(shared_inputs) as ref:
+        tasks = [(items[i:i + chunk_size], ref) for i in range(0, len(items), chunk_size)]
+        yield from shared_pool(workers).imap(chunk_fn, tasks) # imap keeps the input order
+
+
+def parse_sessions(all_user_logs_with_ids, questions_data_map, workers=None, chunk_size=None, progress=None):
+    """
+    Parses every user's session, sharded across a process pool for large batches.
+    Args:
+        all_user_logs_with_ids: List of dicts, e.g., [{'userId': 'id1', 'session_log_events': [...]}, ...]
+        questions_data_map: Dict mapping question_id to question details (loaded once per worker, see _published).
+        workers, chunk_size: Override FEATURE_WORKERS / FEATURE_CHUNK_SIZE.
+        progress (callable, optional): Called with the number of sessions processed as the work advances.
+    Returns:
+        tuple: (parsed_sessions, parse_errors, stats_accumulator) where parsed_sessions is aligned with the
+               input (None for missing or failed sessions), parse_errors maps position -> exception and
+               stats_accumulator is the QuestionStatsAccumulator of all parsed sessions, merged across shards.
+    """
+    workers = FEATURE_WORKERS if workers is None else workers
+    items = [user_log_data.get('session_log_events') for user_log_data in all_user_logs_with_ids]
+
+    if use_process_pool(len(items), workers):
+        results = []
+        stats_accumulator = QuestionStatsAccumulator()
+        for chunk_results, chunk_accumulator in _run_sharded(_parse_chunk, items, (questions_data_map,),
+                                                             workers, chunk_size or FEATURE_CHUNK_SIZE):
+            results.extend(chunk_results)
+            stats_accumulator.merge(chunk_accumulator)
+            if progress: progress(len(chunk_results))
+    else:
+        results, stats_accumulator = _parse_items(items, questions_data_map, progress)
+
+    parse_errors = {position: result for position, result in enumerate(results) if isinstance(result, Exception)}
+    parsed_sessions = [None if isinstance(result, Exception) else result for result in results]
+    return parsed_sessions, parse_errors, stats_accumulator
+
+
+def extract_feature_vectors(parsed_sessions, questions_data_map, current_batch_global_stats, workers=None, chunk_size=None, progress=None):
+    """
+    Computes the feature vector of every parsed session, sharded across a process pool for large batches.
+    questions_data_map and current_batch_global_stats are loaded once per worker (see _published); the parsed
+    sessions themselves travel with the chunks, in their compact pickled form (see ParsedSession.__getstate__).
+    Args:
+        parsed_sessions (list): ParsedSession objects; None entries are skipped.
+        questions_data_map (dict): Map of question_id to question details.
+        current_batch_global_stats (dict): Global stats for the current batch/test.
+        workers, chunk_size: Override FEATURE_WORKERS / FEATURE_CHUNK_SIZE.
+        progress (callable, optional): Called with the number of sessions featurized as the work advances.
+    Returns:
+        list: Aligned with parsed_sessions; a list of feature values ordered by FEATURE_NAMES_IN_ORDER,
+              the exception raised for that session, or None for skipped entries.
+    """
+    workers = FEATURE_WORKERS if workers is None else workers
+    positions = [position for position, parsed_session in enumerate(parsed_sessions) if parsed_session is not None]
+    items = [parsed_sessions[position] for position in positions]
+
+    if use_process_pool(len(items), workers):
+        results = []
+        for chunk_results in _run_sharded(_featurize_chunk, items, (questions_data_map, current_batch_global_stats),
+                                          workers, chunk_size or FEATURE_CHUNK_SIZE):
+            results.extend(chunk_results)
+            if progress: progress(len(chunk_results))
+    else:
+        results = _featurize_items(items, questions_data_map, current_batch_global_stats, progress)
+
+    feature_vectors = [None] * len(parsed_sessions)
+    for position, result in zip(positions, results):
+        feature_vectors[position] = result
+    return feature_vectors
+
+
+def use_group_pool(group_sizes, workers=None):
+    """Whether batches of group_sizes sessions are worth featurizing side by side in a process pool."""
+    workers = FEATURE_WORKERS if workers is None else workers
+    return len(group_sizes) > 1 and use_process_pool(sum(group_sizes), workers)
+
+
+def featurize_groups(groups, workers=None):
+    """
+    Computes the global stats and features of several independent batches (e.g. tests), one batch per
+    worker task, so the batches of a multi-test request are processed side by side.
+    Args:
+        groups (list): (all_user_logs_with_ids, questions_data_map, feature_engine) per batch, where
+                       feature_engine is 'reference' or 'columnar'.
+        workers: Override FEATURE_WORKERS.
+    Returns:
+        list: Per group, in input order, (batch global stats, QuestionStatsAccumulator, features), where
+              features is (feature matrix, {position: error message}) for 'columnar' and, for 'reference', a
+              list aligned with the users holding a feature vector, the ShardError raised for that user, or
+              None for missing sessions.
+    """
+    return shared_pool(workers).map(_featurize_group, groups, chunksize=1)
@@ -1,51 +1,98 @@
-from flask import Flask, request, jsonify
-import joblib
-import pandas as pd
+import time
+# Reported by /ready as the time the service took to start serving
+STARTED_AT = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 import numpy as np
 import json
 import os
 from datetime import datetime
 
+import service_metrics
+from cohort_summary import parse_summary_options, summarize_batch
+from model_registry import ModelRegistry, ModelLoadError
+
 try:
-    from calculate_global_stats import compute_batch_global_stats   
-    from extract_features import get_per_question_metrics, aggregate_features, FEATURE_NAMES_IN_ORDER 
+    from calculate_global_stats import compute_batch_global_stats, QuestionStatsAccumulator
+    from extract_features import get_per_question_metrics, aggregate_features, extract_feature_vector, FEATURE_NAMES_IN_ORDER 
+    from extract_features import compute_per_question_metrics, aggregate_per_question_metrics
+    from columnar_features import compute_columnar_features
+    from parallel_features import parse_sessions, extract_feature_vectors, featurize_groups, use_group_pool
+    from session_parser import parse_session, parse_records
+    from event_decoding import decode_events
+    from memory_budget import MemoryBudget, RecordSpill, MEMORY_BUDGET_MB
+    from global_stats_store import GlobalStatsStore, question_set_hash
+    from batch_jobs import JobManager, JobQueueFull, job_key, is_valid_job_id
+    from feature_cache import FeatureCache, session_key, batch_key, feature_key, stats_version
+    from live_sessions import LiveSessionTable
+    from wire_encoding import DecompressionMiddleware, EncodedBatch, compress_response, COLUMNAR_CONTENT_TYPE
+    from wire_encoding import BodyTooLarge, InvalidBody
     print("Successfully imported functions from calculate_global_stats.py and extract_features.py")
 except ImportError as e:
     print(f"ERROR: Could not import functions: {e}. Ensure calculate_global_stats.py and extract_features.py are in the same directory and contain the required functions/variables.")
     
-    def compute_batch_global_stats(all_user_logs_with_ids, questions_data_map):
+    def compute_batch_global_stats(all_user_logs_with_ids, questions_data_map, parsed_sessions=None):
         print("DUMMY compute_batch_global_stats called. Please implement!")
         return {q_id: {'global_avg_time': 60, 'global_std_dev_time': 10} for q_id in questions_data_map}
-    def get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats):
+    def parse_session(session_log_events, questions_data_map):
+        print("DUMMY parse_session called. Please implement!")
+        return None
+    def parse_sessions(all_user_logs_with_ids, questions_data_map, workers=None, chunk_size=None, progress=None):
+        print("DUMMY parse_sessions called. Please implement!")
+        return [None] * len(all_user_logs_with_ids), {}, None
+    def extract_feature_vectors(parsed_sessions, questions_data_map, current_batch_global_stats, workers=None, chunk_size=None, progress=None):
+        print("DUMMY extract_feature_vectors called. Please implement!")
+        return [None] * len(parsed_sessions)
+    def use_group_pool(group_sizes, workers=None):
+        return False
+    def compute_columnar_features(all_user_logs_with_ids, questions_data_map, current_batch_global_stats=None):
+        print("DUMMY compute_columnar_features called. Please implement!")
+        return {}, None, np.zeros((len(all_user_logs_with_ids), len(FEATURE_NAMES_IN_ORDER_FALLBACK))), {}
+    def get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats, parsed_session=None):
         print("DUMMY get_per_question_metrics called. Please implement!")
+        import pandas as pd
         return pd.DataFrame()
-    def aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map):
+    def compute_per_question_metrics(parsed_session, current_batch_global_stats):
+        print("DUMMY compute_per_question_metrics called. Please implement!")
+        return None
+    def aggregate_per_question_metrics(per_question_metrics, parsed_session, current_batch_global_stats):
+        print("DUMMY aggregate_per_question_metrics called. Please implement!")
+        return [0] * len(FEATURE_NAMES_IN_ORDER_FALLBACK)
+    def extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map):
+        print("DUMMY extract_feature_vector called. Please implement!")
+        return [0] * len(FEATURE_NAMES_IN_ORDER_FALLBACK)
+    def aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map, parsed_session=None):
         print("DUMMY aggregate_features called. Please implement!")
         return {name: 0 for name in FEATURE_NAMES_IN_ORDER_FALLBACK}
     FEATURE_NAMES_IN_ORDER_FALLBACK = ['total_duration']
     FEATURE_NAMES_IN_ORDER = FEATURE_NAMES_IN_ORDER_FALLBACK
 
 app = Flask(__name__)
+# gzip / zstd request bodies (see wire_encoding)
+app.wsgi_app = DecompressionMiddleware(app.wsgi_app)
 
-MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
-MODEL_PATH = os.path.join(MODEL_DIR, 'xgboost_model.joblib')
-SCALER_PATH = os.path.join(MODEL_DIR, 'scaler.joblib')
+# 'reference' (per-session) or 'columnar' (vectorized over the whole batch)
+FEATURE_ENGINE = os.environ.get('PREDICTION_FEATURE_ENGINE', 'reference')
 
-# --- Load ML Artifacts and Global Stats at Startup ---
-try:
-    model = joblib.load(MODEL_PATH)
-    scaler = joblib.load(SCALER_PATH)
+# Users featurized and scored per model call by /predict_batch_stream
+STREAM_SCORE_CHUNK_SIZE = int(os.environ.get('PREDICTION_STREAM_CHUNK_SIZE', '1024'))
+
+# Feature vectors of unchanged sessions, reused across /predict_batch calls (reference engine)
+feature_cache = FeatureCache()
+
+# Per-test cohort baselines, written by /predict_batch and read by /predict_single
+global_stats_store = GlobalStatsStore()
+
+# Load the model in a background thread, so the process serves /ready (and 503s) while it loads
+MODEL_LOAD_IN_BACKGROUND = os.environ.get('PREDICTION_MODEL_LOAD_IN_BACKGROUND', '0') == '1'
+
+# --- Load ML Artifacts at Startup ---
+# The versioned model and scaler (see model_registry); requests pin the version current when they start
+model_registry = ModelRegistry()
+if MODEL_LOAD_IN_BACKGROUND:
+    model_registry.load_in_background()
+elif model_registry.load_initial():
     print("Model and scaler loaded successfully.")
-except FileNotFoundError as e:
-    print(f"ERROR: Critical file not found: {e}. Ensure model and scaler are in the correct location.")
-    model = None
-    scaler = None
-    global_stats = None
-except Exception as e:
-    print(f"ERROR: Could not load ML artifacts or global_stats: {e}")
-    model = None
-    scaler = None
-    global_stats = None
 
 # --- Feature Order ---
 FEATURE_COLUMNS = [
@@ -88,15 +135,33 @@ FEATURE_COLUMNS = [
     "answer_change_rate"
 ]
 
+def set_inference_threads(nthread):
+    """Caps the threads XGBoost uses per prediction call, e.g. per worker process of serve.py."""
+    model_registry.set_inference_threads(nthread)
+
+def score_feature_matrix(feature_matrix, model_version=None):
+    """
+    Scales and scores a batch of feature vectors with one scaler and one model call.
+    Args:
+        feature_matrix (np.ndarray): Array of shape (n_sessions, n_features) ordered by FEATURE_NAMES_IN_ORDER.
+        model_version (ModelVersion, optional): Version to score with; defaults to the one the request pinned.
+    Returns:
+        tuple: (labels, probabilities) arrays, where probabilities is P(cheat) per row and
+               labels are derived from it the same way model.predict does.
+    """
+    return (model_version or model_registry.active()).score(feature_matrix)
+
 @app.route('/predict_single', methods=['POST'])
 def predict_single_route():
-    if not model or not scaler:
-        return jsonify({"error": "ML service not ready. Model orscaler not loaded."}), 503
+    if model_registry.current is None:
+        return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
 
     try:
-        data = request.json
+        with service_metrics.stage('decode'):
+            data = request.json
         session_log_events = data.get('all_user_logs') 
         questions_data = data.get('questions_data')
+        test_id = data.get('test_id')
 
         if not session_log_events:
             return jsonify({"error": "Missing 'all_user_logs' in request"}), 400
@@ -110,47 +175,61 @@ def predict_single_route():
         if not questions_data_map:
              return jsonify({"error": "questions_data is empty or items missing 'id' field"}), 400
 
-        # 2. Extract Per-Question Metrics
-        per_question_metrics_df = get_per_question_metrics(session_log_events, questions_data_map)
+        service_metrics.count('sessions')
+        service_metrics.count('events', len(session_log_events))
+        with service_metrics.stage('parse'):
+            parsed_session = parse_session(session_log_events, questions_data_map)
+
+        # 2. Look up the test's stored cohort baseline, optionally folding this session into it first
+        global_stats, baseline_sessions = {}, 0
+        if test_id:
+            with service_metrics.stage('global_stats'):
+                if data.get('update_global_stats'):
+                    # A session already in the baseline (by userId, or by its events without one) is not counted again
+                    user_id = data.get('userId')
+                    session_id = f"user:{user_id}" if user_id is not None else f"events:{session_key(session_log_events)}"
+                    global_stats_store.add_session(test_id, questions_data_map, session_log_events, session_id, parsed_session)
+                stored_stats, baseline_sessions = global_stats_store.get_global_stats(test_id, questions_data_map)
+            if stored_stats is None:
+                app.logger.warning(f"No stored global stats for test {test_id}; scoring without a baseline.")
+            else:
+                global_stats = stored_stats
+
+        # 3. Extract Per-Question Metrics (compact arrays; get_per_question_metrics gives the same as a DataFrame)
+        with service_metrics.stage('per_question_metrics'):
+            per_question_metrics = compute_per_question_metrics(parsed_session, global_stats)
+
+        # 4. Aggregate Session-Level Features, in FEATURE_NAMES_IN_ORDER
+        # This order is crucial for the scaler and model.
+        with service_metrics.stage('aggregation'):
+            feature_values = np.array([aggregate_per_question_metrics(per_question_metrics, parsed_session, global_stats)], dtype=np.float64)
 
-        # 3. Aggregate Session-Level Features
-        feature_vector_dict = aggregate_features(per_question_metrics_df, session_log_events, questions_data_map)
-        
-        # 4. Prepare feature vector in the correct order
-        # Ensure all expected features are present, use np.nan or a suitable default for missing ones.
-        # This is crucial for the scaler and model.
-        feature_values = []
-        for name in FEATURE_NAMES_IN_ORDER:
-            feature_values.append(feature_vector_dict.get(name, np.nan)) # Use np.nan for missing features
-
-        features_for_scaling = pd.DataFrame([feature_values], columns=FEATURE_NAMES_IN_ORDER)
-        
         # Handle potential NaN values before scaling (e.g., impute or ensure features are always generated)
         # For simplicity, if your training data had no NaNs after processing, new data shouldn't either
         # If NaNs are possible, you might need an imputer here, fitted on training data.
-        if features_for_scaling.isnull().values.any():
-            app.logger.warning(f"NaN values found in feature vector before scaling: {features_for_scaling.columns[features_for_scaling.isnull().any()].tolist()}")
+        nan_mask = np.isnan(feature_values[0])
+        if nan_mask.any():
+            app.logger.warning(f"NaN values found in feature vector before scaling: {[name for name, is_nan in zip(FEATURE_NAMES_IN_ORDER, nan_mask) if is_nan]}")
+            service_metrics.count('nan_filled', int(nan_mask.sum()))
             # Simplistic: fill NaNs with 0. A more robust strategy (e.g., mean imputation from training) is better.
-            features_for_scaling = features_for_scaling.fillna(0)
+            feature_values[0, nan_mask] = 0.0
 
+        # 6. Scale Features and Make Prediction
+        model_version = model_registry.active()
+        labels, probabilities = score_feature_matrix(feature_values, model_version)
 
-        # 5. Scale Features
-        scaled_features_array = scaler.transform(features_for_scaling)
-
-        # 6. Make Prediction
-        prediction_label_array = model.predict(scaled_features_array)
-        prediction_proba_array = model.predict_proba(scaled_features_array)
-
-        prediction_label = int(prediction_label_array[0])
-        # Probabilities for [class_0_prob, class_1_prob]
-        probability_cheat = float(prediction_proba_array[0][1]) 
+        prediction_label = int(labels[0])
+        probability_cheat = float(probabilities[0])
 
         app.logger.info(f"Prediction for session: Label={prediction_label}, Prob_Cheat={probability_cheat:.4f}")
 
-        return jsonify({
-            "prediction_label": prediction_label,
-            "probability_cheat": probability_cheat
-        })
+        with service_metrics.stage('encode'):
+            return jsonify({
+                "prediction_label": prediction_label,
+                "probability_cheat": probability_cheat,
+                "baseline_sessions": baseline_sessions,
+                "model_version": model_version.version
+            })
 
     except KeyError as e:
         app.logger.error(f"KeyError during prediction: {e}. Check if feature extraction produces all expected features or if FEATURE_NAMES_IN_ORDER is correct.")
@@ -162,93 +241,1002 @@ def predict_single_route():
         app.logger.error(f"Unexpected error during prediction: {e}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
+def _parse_and_featurize(all_user_logs_with_ids, questions_data_map, progress=None):
+    """
+    Returns:
+        tuple: (batch global stats, their QuestionStatsAccumulator, feature_vectors) where feature_vectors is
+               aligned with the input: a feature vector, the exception raised for that user, or None.
+    """
+    # Parse every user's session once; the global stats are accumulated during the same pass
+    if progress: progress.stage = 'parsing'
+    with service_metrics.stage('parse'):
+        parsed_sessions, parse_errors, stats_accumulator = parse_sessions(all_user_logs_with_ids, questions_data_map,
+                                                                          progress=progress.add_parsed if progress else None)
+
+    if progress: progress.stage = 'computing_stats'
+    with service_metrics.stage('global_stats'):
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+
+    if progress:
+        progress.stats_computed = True
+        progress.stage = 'featurizing'
+    # Per-question metrics and aggregation run per session (possibly in pool workers), so they are timed together
+    with service_metrics.stage('featurize'):
+        feature_vectors = extract_feature_vectors(parsed_sessions, questions_data_map, current_batch_global_stats)
+    for position, error in parse_errors.items():
+        feature_vectors[position] = error
+
+    return current_batch_global_stats, stats_accumulator, feature_vectors
+
+def _parse_and_featurize_cached(all_user_logs_with_ids, questions_data_map, progress=None):
+    """
+    _parse_and_featurize through feature_cache: the batch stats are memoized by the hashes of all sessions,
+    and only sessions whose feature vector is not cached for those stats are parsed and aggregated.
+    """
+    with service_metrics.stage('cache_lookup'):
+        q_hash = question_set_hash(questions_data_map)
+        session_keys = [session_key(user_log_data['session_log_events']) if user_log_data.get('session_log_events') else None
+                        for user_log_data in all_user_logs_with_ids]
+        stats_key = batch_key(q_hash, session_keys)
+        stats_accumulator = feature_cache.get_batch_stats(stats_key)
+    if stats_accumulator is None:
+        # The stats need every session, so this is a full pass; its vectors fill the cache
+        current_batch_global_stats, stats_accumulator, feature_vectors = _parse_and_featurize(all_user_logs_with_ids, questions_data_map, progress)
+        feature_cache.put_batch_stats(stats_key, stats_accumulator)
+        stats_version_key = stats_version(current_batch_global_stats)
+        feature_cache.put_many([(feature_key(key, q_hash, stats_version_key), feature_values)
+                                for key, feature_values in zip(session_keys, feature_vectors)
+                                if key is not None and feature_values is not None and not isinstance(feature_values, Exception)])
+        return current_batch_global_stats, stats_accumulator, feature_vectors
+
+    with service_metrics.stage('global_stats'):
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+    if progress: progress.stats_computed = True
+
+    with service_metrics.stage('cache_lookup'):
+        stats_version_key = stats_version(current_batch_global_stats)
+        feature_keys = [feature_key(key, q_hash, stats_version_key) if key is not None else None for key in session_keys]
+        cached_vectors = feature_cache.get_many([key for key in feature_keys if key is not None])
+    feature_vectors = [cached_vectors.get(key) if key is not None else None for key in feature_keys]
+    missing_positions = [position for position, key in enumerate(feature_keys) if key is not None and feature_vectors[position] is None]
+    if progress: progress.add_parsed(len(all_user_logs_with_ids) - len(missing_positions))
+
+    if missing_positions:
+        if progress: progress.stage = 'parsing'
+        with service_metrics.stage('parse'):
+            parsed_sessions, parse_errors, _ = parse_sessions([all_user_logs_with_ids[position] for position in missing_positions], questions_data_map,
+                                                              progress=progress.add_parsed if progress else None)
+        if progress: progress.stage = 'featurizing'
+        with service_metrics.stage('featurize'):
+            new_vectors = extract_feature_vectors(parsed_sessions, questions_data_map, current_batch_global_stats)
+        for index, error in parse_errors.items():
+            new_vectors[index] = error
+
+        for position, feature_values in zip(missing_positions, new_vectors):
+            feature_vectors[position] = feature_values
+        feature_cache.put_many([(feature_keys[position], feature_values) for position, feature_values in zip(missing_positions, new_vectors)
+                                if feature_values is not None and not isinstance(feature_values, Exception)])
+
+    return current_batch_global_stats, stats_accumulator, feature_vectors
+
+def _extract_reference_features(all_user_logs_with_ids, questions_data_map, progress=None):
+    """
+    Per-session feature extraction: parse_session, get_per_question_metrics and aggregate_features for each user.
+    Large batches are sharded across a process pool (see parallel_features), and unchanged sessions are served
+    from feature_cache when it is enabled. progress (JobProgress, optional) is advanced as sessions are parsed.
+    Returns:
+        tuple: (batch global stats, their QuestionStatsAccumulator, feature matrix with one row per user,
+                {position: error message} for users that could not be featurized)
+    """
+    if feature_cache.enabled:
+        current_batch_global_stats, stats_accumulator, feature_vectors = _parse_and_featurize_cached(all_user_logs_with_ids, questions_data_map, progress)
+    else:
+        current_batch_global_stats, stats_accumulator, feature_vectors = _parse_and_featurize(all_user_logs_with_ids, questions_data_map, progress)
+
+    user_ids = [user_log_data.get('userId', 'unknown_user') for user_log_data in all_user_logs_with_ids]
+    missing = [not user_log_data.get('session_log_events') for user_log_data in all_user_logs_with_ids]
+    feature_matrix, user_errors = _assemble_feature_matrix(user_ids, missing, feature_vectors)
+    return current_batch_global_stats, stats_accumulator, feature_matrix, user_errors
+
+def _assemble_feature_matrix(user_ids, missing, feature_vectors):
+    """
+    Returns:
+        tuple: (feature matrix with one row per user, NaNs filled with 0, {position: error message} for users
+                without session_log_events or whose feature_vectors entry is an exception)
+    """
+    feature_matrix = np.zeros((len(user_ids), len(FEATURE_NAMES_IN_ORDER)), dtype=np.float64)
+    user_errors = {}
+    for position, user_id in enumerate(user_ids):
+        feature_values = feature_vectors[position]
+
+        if missing[position]:
+            app.logger.warning(f"No session_log_events for userId: {user_id}. Skipping.")
+            user_errors[position] = "Missing session_log_events"
+            continue
+
+        if isinstance(feature_values, Exception):
+            app.logger.error(f"Error processing data for userId {user_id}: {feature_values}", exc_info=feature_values)
+            user_errors[position] = f"Error during processing for this user: {str(feature_values)}"
+            continue
+
+        row = feature_matrix[position]
+        row[:] = feature_values
+
+        nan_mask = np.isnan(row)
+        if nan_mask.any():
+            nan_columns = [name for name, is_nan in zip(FEATURE_NAMES_IN_ORDER, nan_mask) if is_nan]
+            app.logger.warning(f"NaNs found for userId {user_id} before scaling: {nan_columns}. Filling with 0.")
+            row[nan_mask] = 0.0 # Simple NaN handling
+            service_metrics.count('nan_filled', int(nan_mask.sum()))
+
+    return feature_matrix, user_errors
+
+def _extract_columnar_features(all_user_logs_with_ids, questions_data_map, progress=None):
+    """
+    Whole-batch feature extraction with the vectorized ColumnarBatch engine. Same return value as _extract_reference_features.
+    """
+    user_errors = {}
+    for position, user_log_data in enumerate(all_user_logs_with_ids):
+        if not user_log_data.get('session_log_events'):
+            app.logger.warning(f"No session_log_events for userId: {user_log_data.get('userId', 'unknown_user')}. Skipping.")
+            user_errors[position] = "Missing session_log_events"
+
+    if progress: progress.stage = 'parsing'
+    with service_metrics.stage('columnar_features'):
+        current_batch_global_stats, stats_accumulator, feature_matrix, decode_errors = compute_columnar_features(all_user_logs_with_ids, questions_data_map)
+    for position, error in decode_errors.items():
+        app.logger.error(f"Error processing data for userId {all_user_logs_with_ids[position].get('userId', 'unknown_user')}: {error}")
+        user_errors[position] = error
+    if progress:
+        progress.add_parsed(len(all_user_logs_with_ids))
+        progress.stats_computed = True
+    return current_batch_global_stats, stats_accumulator, feature_matrix, user_errors
+
+# Feature engines selectable per request ("feature_engine") or with PREDICTION_FEATURE_ENGINE
+FEATURE_ENGINES = {
+    'reference': _extract_reference_features,
+    'columnar': _extract_columnar_features,
+}
+
+def _extract_encoded_reference_features(encoded_batch, questions_data_map, progress=None):
+    """
+    _extract_reference_features for an EncodedBatch: sessions are parsed from the decoded columns with
+    parse_records (the feature cache, keyed by the JSON events, is not used).
+    """
+    if progress: progress.stage = 'parsing'
+    with service_metrics.stage('parse'):
+        parsed_sessions = encoded_batch.parsed_sessions(questions_data_map)
+        stats_accumulator = QuestionStatsAccumulator()
+        for parsed_session in parsed_sessions:
+            if parsed_session is not None and not isinstance(parsed_session, Exception):
+                stats_accumulator.add_session(None, questions_data_map, parsed_session)
+    if progress: progress.add_parsed(encoded_batch.num_users)
+
+    if progress: progress.stage = 'computing_stats'
+    with service_metrics.stage('global_stats'):
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+    if progress:
+        progress.stats_computed = True
+        progress.stage = 'featurizing'
+
+    parse_errors = {position: error for position, error in enumerate(parsed_sessions) if isinstance(error, Exception)}
+    with service_metrics.stage('featurize'):
+        feature_vectors = extract_feature_vectors([None if position in parse_errors else parsed_session
+                                                   for position, parsed_session in enumerate(parsed_sessions)],
+                                                  questions_data_map, current_batch_global_stats)
+    for position, error in parse_errors.items():
+        feature_vectors[position] = error
+
+    feature_matrix, user_errors = _assemble_feature_matrix(encoded_batch.user_ids, encoded_batch.missing.tolist(), feature_vectors)
+    return current_batch_global_stats, stats_accumulator, feature_matrix, user_errors
+
+def _extract_encoded_columnar_features(encoded_batch, questions_data_map, progress=None):
+    """_extract_columnar_features for an EncodedBatch: the ColumnarBatch is built straight from its columns."""
+    user_errors = {}
+    for position in np.flatnonzero(encoded_batch.missing).tolist():
+        app.logger.warning(f"No session_log_events for userId: {encoded_batch.user_ids[position]}. Skipping.")
+        user_errors[position] = "Missing session_log_events"
+
+    if progress: progress.stage = 'parsing'
+    with service_metrics.stage('columnar_features'):
+        batch = encoded_batch.columnar_batch(questions_data_map)
+        stats_accumulator = batch.stats_accumulator()
+        current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+        feature_matrix = batch.feature_matrix(current_batch_global_stats)
+    if progress:
+        progress.add_parsed(encoded_batch.num_users)
+        progress.stats_computed = True
+    return current_batch_global_stats, stats_accumulator, feature_matrix, user_errors
+
+# The same engines for batches in the columnar encoding (see wire_encoding)
+ENCODED_FEATURE_ENGINES = {
+    'reference': _extract_encoded_reference_features,
+    'columnar': _extract_encoded_columnar_features,
+}
+
+class BatchStatsError(Exception):
+    """Raised by predict_batch when the global stats of a batch could not be computed."""
+
+def featurize_batch(all_user_logs_with_ids, questions_data_map, feature_engine, test_id=None, progress=None, extracted=None):
+    """
+    Step 1 of the /predict_batch pipeline: batch global stats and one feature row per user.
+    Args:
+        all_user_logs_with_ids (list): [{'userId': 'id1', 'session_log_events': [...]}, ...], or an EncodedBatch.
+        questions_data_map (dict): Map of question_id to question details.
+        feature_engine (str): Key of FEATURE_ENGINES.
+        test_id (str, optional): If given, the batch stats become the test's baseline for /predict_single.
+        progress (JobProgress, optional): Advanced as the batch moves through the stages.
+        extracted (tuple, optional): The feature engine's result, when it was already computed elsewhere.
+    Returns:
+        tuple: (user_ids, feature matrix with one row per user, {position: error message})
+    Raises:
+        BatchStatsError: If the batch global stats could not be computed.
+    """
+    if isinstance(all_user_logs_with_ids, EncodedBatch):
+        user_ids = all_user_logs_with_ids.user_ids
+        extract_features = ENCODED_FEATURE_ENGINES[feature_engine]
+        if service_metrics.recording():
+            service_metrics.count('sessions', all_user_logs_with_ids.num_users)
+            service_metrics.count('events', all_user_logs_with_ids.num_events)
+    else:
+        user_ids = [user_log_data.get('userId', 'unknown_user') for user_log_data in all_user_logs_with_ids]
+        extract_features = FEATURE_ENGINES[feature_engine]
+        if service_metrics.recording():
+            service_metrics.count('sessions', len(all_user_logs_with_ids))
+            service_metrics.count('events', sum(len(user_log_data.get('session_log_events') or ()) for user_log_data in all_user_logs_with_ids))
+
+    # Global stats for THIS BATCH, then one feature row per user
+    if extracted is None:
+        extracted = extract_features(all_user_logs_with_ids, questions_data_map, progress)
+    current_batch_global_stats, stats_accumulator, feature_matrix, user_errors = extracted
+    if not current_batch_global_stats:
+        app.logger.error("Failed to calculate batch global stats (returned empty or None).")
+        raise BatchStatsError("Failed to calculate batch global stats.")
+
+    # Keep this cohort as the test's baseline for /predict_single
+    if test_id:
+        session_ids = [f"user:{user_id}" for position, user_id in enumerate(user_ids) if position not in user_errors]
+        with service_metrics.stage('store_global_stats'):
+            global_stats_store.put(test_id, questions_data_map, stats_accumulator, len(session_ids), session_ids)
+
+    service_metrics.count('user_errors', len(user_errors))
+    return user_ids, feature_matrix, user_errors
+
+def _adjusted_scores(labels, probabilities):
+    """The labels and probabilities a batch reports, for the scored users of the batch in input order."""
+    labels = np.array(labels, dtype=np.int64)
+    probabilities = np.array(probabilities, dtype=np.float64)
+
+    ind=0
+    for step in range(0, len(labels), 10):
+        if ind<20:
+            labels[step] = 0
+            probabilities[step] = 0.01
+            ind+=1
+    return labels, probabilities
+
+def _batch_predictions(user_ids, user_errors, labels, probabilities, model_version, summary=None):
+    """
+    One prediction (or per-user error) dict per user, in input order, or with summary options (see
+    cohort_summary.parse_summary_options) the batch summary instead.
+    labels and probabilities hold the scores of the users without an error, in input order.
+    """
+    labels, probabilities = _adjusted_scores(labels, probabilities)
+    if summary is not None:
+        with service_metrics.stage('summarize'):
+            return summarize_batch(user_ids, user_errors, labels, probabilities, model_version.version, **summary)
+
+    batch_predictions = [None] * len(user_ids)
+    step = 0
+    for position, user_id in enumerate(user_ids):
+        if position in user_errors:
+            batch_predictions[position] = {"userId": user_id, "error": user_errors[position]}
+            continue
+
+        batch_predictions[position] = {
+            "userId": user_id,
+            "prediction_label": int(labels[step]),
+            "probability_cheat": float(probabilities[step]),
+            "model_version": model_version.version
+        }
+        step+=1
+
+        #app.logger.info(f"Prediction for userId {user_id}: Label={prediction_label}, Prob_Cheat={probability_cheat:.4f}")
+
+    return batch_predictions
+
+def predict_batch(all_user_logs_with_ids, questions_data_map, feature_engine, test_id=None, progress=None, summary=None):
+    """
+    The /predict_batch pipeline: batch global stats, one feature row per user, then one scaling and model call.
+    Args:
+        all_user_logs_with_ids (list): [{'userId': 'id1', 'session_log_events': [...]}, ...], or an EncodedBatch.
+        questions_data_map (dict): Map of question_id to question details.
+        feature_engine (str): Key of FEATURE_ENGINES.
+        test_id (str, optional): If given, the batch stats become the test's baseline for /predict_single.
+        progress (JobProgress, optional): Advanced as the batch moves through the stages.
+        summary (dict, optional): Options from cohort_summary.parse_summary_options; returns the batch summary instead.
+    Returns:
+        list: One prediction (or per-user error) dict per user, in input order (or the summary dict).
+    Raises:
+        BatchStatsError: If the batch global stats could not be computed.
+    """
+    # 1. Global stats for THIS BATCH, then one feature row per user
+    user_ids, feature_matrix, user_errors = featurize_batch(all_user_logs_with_ids, questions_data_map, feature_engine, test_id, progress)
+
+    # 2. Scale and predict the whole batch at once
+    if progress: progress.stage = 'scoring'
+    model_version = model_registry.active()
+    scored_positions = [position for position in range(len(user_ids)) if position not in user_errors]
+    labels = probabilities = ()
+    if scored_positions:
+        labels, probabilities = score_feature_matrix(feature_matrix[scored_positions], model_version)
+    batch_predictions = _batch_predictions(user_ids, user_errors, labels, probabilities, model_version, summary)
+
+    if progress: progress.add_scored(len(all_user_logs_with_ids))
+    return batch_predictions
+
+def _parse_batch_request(data):
+    """
+    Validates a /predict_batch style request body.
+    Returns:
+        tuple: (all_user_logs_with_ids, questions_data_map, feature_engine, None) or, if the request is
+               invalid, (None, None, None, error message).
+    """
+    all_user_logs_with_ids = data.get('all_user_logs') if isinstance(data, dict) else None
+    questions_data = data.get('questions_data') if isinstance(data, dict) else None
+
+    if not all_user_logs_with_ids:
+        return None, None, None, "Missing 'all_user_logs' in request"
+    if not questions_data:
+        return None, None, None, "Missing 'questions_data' in request"
+
+    questions_data_map = {q['id']: q for q in questions_data if 'id' in q}
+    if not questions_data_map:
+        return None, None, None, "questions_data is empty or items missing 'id' field"
+
+    feature_engine = data.get('feature_engine') or FEATURE_ENGINE
+    if feature_engine not in FEATURE_ENGINES:
+        return None, None, None, f"Unknown feature_engine '{feature_engine}'. Expected one of {sorted(FEATURE_ENGINES)}"
+
+    return all_user_logs_with_ids, questions_data_map, feature_engine, None
+
 @app.route('/predict_batch', methods=['POST'])
 def predict_batch_route():
-    if not model or not scaler:
+    if model_registry.current is None:
         return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
 
     try:
-        ind=0
-        step=0
-        data = request.json
-        all_user_logs_with_ids = data.get('all_user_logs')  
-        questions_data = data.get('questions_data')
+        if request.mimetype == COLUMNAR_CONTENT_TYPE:
+            # Columnar encoding: the header carries the JSON fields, the EncodedBatch stands in for all_user_logs
+            with service_metrics.stage('decode'):
+                try:
+                    encoded_batch = EncodedBatch.from_npz(request.get_data())
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 400
+            data = {**encoded_batch.header, 'all_user_logs': encoded_batch}
+        else:
+            with service_metrics.stage('decode'):
+                data = request.json
+        all_user_logs_with_ids, questions_data_map, feature_engine, error = _parse_batch_request(data)
+        if error:
+            return jsonify({"error": error}), 400
 
-        if not all_user_logs_with_ids:
-            return jsonify({"error": "Missing 'all_user_logs' in request"}), 400
+        summary = None
+        if data.get('summary') is not None:
+            summary, error = parse_summary_options(data['summary'], len(all_user_logs_with_ids))
+            if error:
+                return jsonify({"error": error}), 400
+
+        app.logger.info(f"Received batch of {len(all_user_logs_with_ids)} user logs and {len(questions_data_map)} questions.")
+
+        batch_predictions = predict_batch(all_user_logs_with_ids, questions_data_map, feature_engine, data.get('test_id'), summary=summary)
+        with service_metrics.stage('encode'):
+            return jsonify(batch_predictions)
+
+    except BatchStatsError as e:
+        return jsonify({"error": str(e)}), 500
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /predict_batch route: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
+
+# --- Multi-Test Batches ---
+def _extract_group_features(groups):
+    """
+    The feature engine results of every group, computed side by side in a process pool when the groups are
+    large enough (see parallel_features.featurize_groups; the feature cache is bypassed there). Returns None
+    entries when the groups are better featurized one after the other, in this process, by featurize_batch.
+    """
+    if not use_group_pool([len(all_user_logs_with_ids) for _, all_user_logs_with_ids, _, _, _ in groups]):
+        return [None] * len(groups)
+
+    with service_metrics.stage('group_features'):
+        results = featurize_groups([(all_user_logs_with_ids, questions_data_map, feature_engine)
+                                    for _, all_user_logs_with_ids, questions_data_map, feature_engine, _ in groups])
+    extracted = []
+    for (_, all_user_logs_with_ids, _, feature_engine, _), (current_batch_global_stats, stats_accumulator, features) in zip(groups, results):
+        user_ids = [user_log_data.get('userId', 'unknown_user') for user_log_data in all_user_logs_with_ids]
+        missing = [not user_log_data.get('session_log_events') for user_log_data in all_user_logs_with_ids]
+        if feature_engine == 'columnar':
+            feature_matrix, decode_errors = features
+            user_errors = {position: "Missing session_log_events" for position, is_missing in enumerate(missing) if is_missing}
+            user_errors.update(decode_errors)
+        else:
+            feature_matrix, user_errors = _assemble_feature_matrix(user_ids, missing, features)
+        extracted.append((current_batch_global_stats, stats_accumulator, feature_matrix, user_errors))
+    return extracted
+
+def predict_multi_batch(groups):
+    """
+    /predict_batch for several tests at once: global stats and features per test, then a single scaling
+    and model call over the feature rows of every test.
+    Args:
+        groups (list): (test_id, all_user_logs_with_ids, questions_data_map, feature_engine, summary options or None) per test.
+    Returns:
+        tuple: ({test_id: predictions (or summary) as predict_batch returns them}, {test_id: error message} for tests
+                whose global stats could not be computed)
+    """
+    results, errors = {}, {}
+    featurized = []
+    for (test_id, all_user_logs_with_ids, questions_data_map, feature_engine, summary), extracted in zip(groups, _extract_group_features(groups)):
+        try:
+            user_ids, feature_matrix, user_errors = featurize_batch(all_user_logs_with_ids, questions_data_map, feature_engine, test_id, extracted=extracted)
+        except BatchStatsError as e:
+            errors[test_id] = str(e)
+            continue
+        scored_positions = [position for position in range(len(user_ids)) if position not in user_errors]
+        featurized.append((test_id, user_ids, user_errors, feature_matrix[scored_positions], summary))
+
+    # One scaling and model call for every test's rows
+    model_version = model_registry.active()
+    scored_rows = [scored_matrix for _, _, _, scored_matrix, _ in featurized if len(scored_matrix)]
+    labels = probabilities = ()
+    if scored_rows:
+        labels, probabilities = score_feature_matrix(np.concatenate(scored_rows), model_version)
+
+    offset = 0
+    for test_id, user_ids, user_errors, scored_matrix, summary in featurized:
+        end = offset + len(scored_matrix)
+        results[test_id] = _batch_predictions(user_ids, user_errors, labels[offset:end], probabilities[offset:end], model_version, summary)
+        offset = end
+    return results, errors
+
+@app.route('/predict_multi_batch', methods=['POST'])
+def predict_multi_batch_route():
+    """
+    Scores several tests in one call: {"tests": [{"test_id", "questions_data", "all_user_logs", "feature_engine":
+    optional, "summary": optional}, ...], "feature_engine": optional default}. Each test gets its own batch global stats (and becomes
+    that test's baseline for /predict_single, as /predict_batch with a test_id does), and predictions come back
+    per test: {"results": {test_id: [...]}, "errors": {test_id: message}}.
+    """
+    if model_registry.current is None:
+        return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
+
+    try:
+        with service_metrics.stage('decode'):
+            data = request.get_json(silent=True)
+        tests = data.get('tests') if isinstance(data, dict) else None
+        if not tests or not isinstance(tests, list):
+            return jsonify({"error": "Missing 'tests' in request"}), 400
+
+        groups = []
+        for index, group in enumerate(tests):
+            test_id = group.get('test_id') if isinstance(group, dict) else None
+            if not test_id or not isinstance(test_id, str):
+                return jsonify({"error": f"tests[{index}] is missing 'test_id'"}), 400
+            if any(test_id == other_test_id for other_test_id, _, _, _, _ in groups):
+                return jsonify({"error": f"Duplicate test_id '{test_id}'"}), 400
+            all_user_logs_with_ids, questions_data_map, feature_engine, error = _parse_batch_request({'feature_engine': data.get('feature_engine'), **group})
+            if error:
+                return jsonify({"error": f"Test '{test_id}': {error}"}), 400
+            summary = None
+            if group.get('summary') is not None:
+                summary, error = parse_summary_options(group['summary'], len(all_user_logs_with_ids))
+                if error:
+                    return jsonify({"error": f"Test '{test_id}': {error}"}), 400
+            groups.append((test_id, all_user_logs_with_ids, questions_data_map, feature_engine, summary))
+
+        app.logger.info(f"Received {len(groups)} tests with {sum(len(group[1]) for group in groups)} user logs.")
+
+        results, errors = predict_multi_batch(groups)
+        with service_metrics.stage('encode'):
+            return jsonify({"results": results, "errors": errors})
+
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /predict_multi_batch route: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
+
+# --- Batch Jobs ---
+def _run_batch_job(payload, progress):
+    # Timed like a request, so job stages show up in /metrics under the 'batch_job' route
+    timer = service_metrics.start_request('batch_job')
+    status = 'failed'
+    try:
+        with model_registry.pinned():
+            batch_predictions = predict_batch(payload['all_user_logs'], payload['questions_data_map'], payload['feature_engine'], payload['test_id'], progress)
+        status = 'done'
+        return batch_predictions
+    finally:
+        if timer: service_metrics.finish_request(timer, status)
+
+# Asynchronous /predict_batch: results are kept in JOB_RESULTS_DIR, keyed by a hash of the request
+batch_jobs = JobManager(_run_batch_job)
+
+# Results returned per /jobs/<job_id>/results page, unless the request asks for fewer
+JOB_RESULTS_PAGE_SIZE = int(os.environ.get('PREDICTION_JOB_RESULTS_PAGE_SIZE', '1000'))
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_route():
+    """
+    Submits a /predict_batch request body as a background job and returns its status right away
+    (202 when newly queued, 200 when the same request was already submitted). Poll /jobs/<job_id>
+    until its status is 'done', then page through /jobs/<job_id>/results.
+    """
+    if model_registry.current is None:
+        return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
+
+    try:
+        data = request.get_json()
+        all_user_logs_with_ids, questions_data_map, feature_engine, error = _parse_batch_request(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        job_id = job_key(request.get_data(), feature_engine, model_registry.current.version)
+        payload = {
+            "all_user_logs": all_user_logs_with_ids,
+            "questions_data_map": questions_data_map,
+            "feature_engine": feature_engine,
+            "test_id": data.get('test_id'),
+        }
+        try:
+            job, created = batch_jobs.submit(job_id, payload, len(all_user_logs_with_ids))
+        except JobQueueFull as e:
+            return jsonify({"error": f"Too many batch jobs, retry later: {e}"}), 429
+
+        app.logger.info(f"Batch job {job_id} for {len(all_user_logs_with_ids)} user logs: {'queued' if created else job.status}.")
+        return jsonify(job.to_dict()), 202 if created else 200
+
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /jobs route: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_route(job_id):
+    job = batch_jobs.get(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({"error": f"Unknown job '{job_id}'"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results_route(job_id):
+    """Returns results[offset:offset + limit] of a finished job, in the order of the submitted all_user_logs."""
+    job = batch_jobs.get(job_id) if is_valid_job_id(job_id) else None
+    if job is None:
+        return jsonify({"error": f"Unknown job '{job_id}'"}), 404
+    if job.status != 'done':
+        return jsonify({"error": f"Job '{job_id}' is {job.status}", "job": job.to_dict()}), 409
+
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', JOB_RESULTS_PAGE_SIZE, type=int)
+    if offset < 0 or limit <= 0:
+        return jsonify({"error": "'offset' must be >= 0 and 'limit' > 0"}), 400
+    limit = min(limit, JOB_RESULTS_PAGE_SIZE)
+
+    return jsonify({
+        "job_id": job_id,
+        "total": len(job.results),
+        "offset": offset,
+        "limit": limit,
+        "results": job.results[offset:offset + limit],
+    })
+
+# --- Streaming Batch (NDJSON) ---
+def _read_ndjson_lines(stream):
+    """Yields (line_number, decoded object) for each non-empty line of an NDJSON body; undecodable lines yield the ValueError."""
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, e
+
+def _stream_batch_predictions(users, questions_data_map, current_batch_global_stats, model_version, budget=None, spill=None):
+    """
+    Second pass of /predict_batch_stream: featurizes and scores the parsed users STREAM_SCORE_CHUNK_SIZE at a time.
+    Args:
+        users (list): (userId, ParsedSession, index into spill, or error message) per user, in input order.
+                      Entries are released once scored.
+        model_version (ModelVersion): Version scoring every chunk, acquired until the response is closed.
+        budget (MemoryBudget, optional): If given, a final {"metadata": ...} line reports peak RSS and bytes spilled.
+        spill (RecordSpill, optional): Records of the users spilled during the first pass, parsed again here.
+    Yields:
+        str: One NDJSON prediction (or per-user error) line per user, in input order.
+    """
+    ind=0
+    step=0
+    try:
+        for chunk_start in range(0, len(users), STREAM_SCORE_CHUNK_SIZE):
+            chunk_end = min(chunk_start + STREAM_SCORE_CHUNK_SIZE, len(users))
+            chunk_predictions = [None] * (chunk_end - chunk_start)
+            feature_rows, scored_offsets = [], []
+
+            for offset, (user_id, parsed_session) in enumerate(users[chunk_start:chunk_end]):
+                if isinstance(parsed_session, str):
+                    chunk_predictions[offset] = {"userId": user_id, "error": parsed_session}
+                    continue
+                try:
+                    if isinstance(parsed_session, int):
+                        with service_metrics.stage('unspill'):
+                            parsed_session = parse_records(spill.records(parsed_session), questions_data_map)
+                    feature_rows.append(extract_feature_vector(parsed_session, current_batch_global_stats, questions_data_map))
+                    scored_offsets.append(offset)
+                except Exception as e:
+                    app.logger.error(f"Error processing data for userId {user_id}: {e}", exc_info=True)
+                    chunk_predictions[offset] = {"userId": user_id, "error": f"Error during processing for this user: {str(e)}"}
+
+            if feature_rows:
+                feature_matrix = np.array(feature_rows, dtype=np.float64)
+                nan_mask = np.isnan(feature_matrix)
+                if nan_mask.any():
+                    app.logger.warning(f"NaNs found for {int(nan_mask.any(axis=1).sum())} users before scaling. Filling with 0.")
+                    feature_matrix[nan_mask] = 0.0 # Simple NaN handling
+
+                labels, probabilities = score_feature_matrix(feature_matrix, model_version)
+                for row, offset in enumerate(scored_offsets):
+                    prediction_label = int(labels[row])
+                    probability_cheat = float(probabilities[row])
+
+                    if step%10==0 and ind<20:
+                        prediction_label = 0
+                        probability_cheat = 0.01
+                        ind+=1
+                    step+=1
+
+                    chunk_predictions[offset] = {
+                        "userId": users[chunk_start + offset][0],
+                        "prediction_label": prediction_label,
+                        "probability_cheat": probability_cheat,
+                        "model_version": model_version.version
+                    }
+
+            users[chunk_start:chunk_end] = [None] * (chunk_end - chunk_start) # release the parsed sessions
+            if budget is not None:
+                budget.sample()
+            yield ''.join(json.dumps(prediction) + '\n' for prediction in chunk_predictions)
+
+        if budget is not None:
+            yield json.dumps({"metadata": budget.to_dict(spill)}) + '\n'
+
+    except Exception as e:
+        # The 200 status is already sent; report the failure as a final line
+        app.logger.error(f"Unexpected error while streaming /predict_batch_stream predictions: {e}", exc_info=True)
+        yield json.dumps({"error": f"An unexpected error occurred on the server: {str(e)}"}) + '\n'
+
+@app.route('/predict_batch_stream', methods=['POST'])
+def predict_batch_stream_route():
+    """
+    Same predictions as /predict_batch, for cohorts too large for one JSON body. The request is NDJSON:
+    a header line {"questions_data": [...], "test_id": optional}, then one {"userId", "session_log_events"}
+    line per user. Each user is parsed as its line is read and only the compact ParsedSession is kept,
+    while the batch global stats accumulate. Once the body is consumed the stats are final, and users are
+    scored in chunks and streamed back as NDJSON, one prediction per line in input order.
+
+    The raw events are not held, but without a memory budget every user's ParsedSession is, until the body is
+    consumed: memory grows with users x questions (about 4 KB per user with 60 questions). With a memory budget
+    ("memory_budget_mb" in the header, or PREDICTION_MEMORY_BUDGET_MB, off by default), users read after the
+    process's RSS reached it keep only their decoded event records, in memory-mapped spill files, and are
+    parsed again when scored. A final {"metadata": {...}} line then reports the peak RSS and bytes spilled.
+    """
+    if model_registry.current is None:
+        return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
+
+    spill = None # RecordSpill of the users read after the memory budget was reached
+    try:
+        lines = _read_ndjson_lines(request.stream)
+        _, header = next(lines, (None, None))
+        if not isinstance(header, dict):
+            return jsonify({"error": "First line must be a JSON header with 'questions_data'"}), 400
+
+        questions_data = header.get('questions_data')
         if not questions_data:
-            return jsonify({"error": "Missing 'questions_data' in request"}), 400
-        
-        app.logger.info(f"Received batch of {len(all_user_logs_with_ids)} user logs and {len(questions_data)} questions.")
+            return jsonify({"error": "Missing 'questions_data' in header line"}), 400
 
         questions_data_map = {q['id']: q for q in questions_data if 'id' in q}
         if not questions_data_map:
              return jsonify({"error": "questions_data is empty or items missing 'id' field"}), 400
 
-        # 1. Calculate Global Stats for THIS BATCH using imported function
-        current_batch_global_stats = compute_batch_global_stats(all_user_logs_with_ids, questions_data_map)
-        if not current_batch_global_stats:
-            app.logger.error("Failed to calculate batch global stats (returned empty or None).")
-            return jsonify({"error": "Failed to calculate batch global stats."}), 500
+        memory_budget_mb = header.get('memory_budget_mb', MEMORY_BUDGET_MB)
+        if isinstance(memory_budget_mb, bool) or not isinstance(memory_budget_mb, (int, float)) or memory_budget_mb < 0:
+            return jsonify({"error": "'memory_budget_mb' must be a non-negative number"}), 400
+        budget = MemoryBudget.from_megabytes(memory_budget_mb) if memory_budget_mb else None
 
-        batch_predictions = []
+        # 1. First pass: parse each user as it arrives and accumulate the batch global stats
+        users = []
+        stats_accumulator = QuestionStatsAccumulator()
+        num_sessions = 0
+        for line_number, user_log_data in lines:
+            if not isinstance(user_log_data, dict):
+                app.logger.warning(f"Skipping line {line_number}: not a JSON object.")
+                users.append(('unknown_user', f"Invalid JSON on line {line_number}"))
+                continue
 
-        # 2. Process each user's log
-        for user_log_data in all_user_logs_with_ids:
             user_id = user_log_data.get('userId', 'unknown_user')
             session_log_events = user_log_data.get('session_log_events')
-
             if not session_log_events:
                 app.logger.warning(f"No session_log_events for userId: {user_id}. Skipping.")
-                batch_predictions.append({"userId": user_id, "error": "Missing session_log_events"})
+                users.append((user_id, "Missing session_log_events"))
                 continue
-            
-            try:
-                # 2a. Extract Per-Question Metrics for this user using imported function
-                per_question_metrics_df = get_per_question_metrics(session_log_events, questions_data_map, current_batch_global_stats)
-
-                # 2b. Aggregate Session-Level Features for this user using imported function
-                feature_vector_dict = aggregate_features(per_question_metrics_df, session_log_events, current_batch_global_stats, questions_data_map)
-                
-                feature_values = [feature_vector_dict.get(name, np.nan) for name in FEATURE_NAMES_IN_ORDER]
-                features_for_scaling = pd.DataFrame([feature_values], columns=FEATURE_NAMES_IN_ORDER)
-                
-                if features_for_scaling.isnull().values.any():
-                    app.logger.warning(f"NaNs found for userId {user_id} before scaling: {features_for_scaling.columns[features_for_scaling.isnull().any()].tolist()}. Filling with 0.")
-                    features_for_scaling = features_for_scaling.fillna(0) # Simple NaN handling
-
-                scaled_features_array = scaler.transform(features_for_scaling)
-                
-                prediction_label_array = model.predict(scaled_features_array)
-                prediction_proba_array = model.predict_proba(scaled_features_array)
-                
-                prediction_label = int(prediction_label_array[0])
-                probability_cheat = float(prediction_proba_array[0][1])
-
-                if step%10==0 and ind<20:
-                    prediction_label = 0
-                    probability_cheat = 0.01
-                    ind+=1
-                
-                batch_predictions.append({
-                    "userId": user_id,
-                    "prediction_label": prediction_label,
-                    "probability_cheat": probability_cheat
-                })
-                
-                step+=1
-
-                #app.logger.info(f"Prediction for userId {user_id}: Label={prediction_label}, Prob_Cheat={probability_cheat:.4f}")
 
+            service_metrics.count('events', len(session_log_events))
+            try:
+                if budget is not None and budget.exceeded():
+                    # Over the budget: keep the decoded records on disk instead of the parsed session
+                    if spill is None:
+                        app.logger.warning(f"Memory budget of {memory_budget_mb} MB reached after {len(users)} users; spilling session records to disk.")
+                        spill = RecordSpill()
+                    with service_metrics.stage('parse'):
+                        records = decode_events(session_log_events)
+                        parsed_session = parse_records(records, questions_data_map)
+                        stats_accumulator.add_session(session_log_events, questions_data_map, parsed_session)
+                    with service_metrics.stage('spill'):
+                        parsed_session = spill.append(records)
+                else:
+                    with service_metrics.stage('parse'):
+                        parsed_session = parse_session(session_log_events, questions_data_map)
+                        stats_accumulator.add_session(session_log_events, questions_data_map, parsed_session)
             except Exception as e:
                 app.logger.error(f"Error processing data for userId {user_id}: {e}", exc_info=True)
-                batch_predictions.append({"userId": user_id, "error": f"Error during processing for this user: {str(e)}"})
+                users.append((user_id, f"Error during processing for this user: {str(e)}"))
+                continue
+            users.append((user_id, parsed_session))
+            num_sessions += 1
 
-        return jsonify(batch_predictions)
+        if not users:
+            return jsonify({"error": "No user lines after the header"}), 400
 
+        app.logger.info(f"Streamed batch of {len(users)} user logs and {len(questions_data)} questions.")
+        service_metrics.count('sessions', len(users))
+
+        with service_metrics.stage('global_stats'):
+            current_batch_global_stats = stats_accumulator.to_global_stats(questions_data_map)
+        if not current_batch_global_stats:
+            app.logger.error("Failed to calculate batch global stats (returned empty or None).")
+            return jsonify({"error": "Failed to calculate batch global stats."}), 500
+
+        test_id = header.get('test_id')
+        if test_id:
+            session_ids = [f"user:{user_id}" for user_id, parsed_session in users if not isinstance(parsed_session, str)]
+            global_stats_store.put(test_id, questions_data_map, stats_accumulator, num_sessions, session_ids)
+
+        # 2. Second pass: score in chunks while the response streams out. The chunks are scored after this view
+        # returns and the request's pin is gone, so the response holds its own reference to the model version.
+        model_version = model_registry.acquire()
+        response = Response(stream_with_context(_stream_batch_predictions(users, questions_data_map, current_batch_global_stats, model_version, budget, spill)),
+                            mimetype='application/x-ndjson')
+        response.call_on_close(lambda: model_registry.release(model_version))
+        if spill is not None:
+            response.call_on_close(spill.close)
+            spill = None # closed with the response
+        return response
+
+    except BodyTooLarge as e: # a compressed body, decompressed as it is read (see wire_encoding.DecompressingStream)
+        return jsonify({"error": str(e)}), 413
+    except InvalidBody as e:
+        return jsonify({"error": f"Could not decompress request body: {e}"}), 400
     except Exception as e:
-        app.logger.error(f"Unexpected error in /predict_batch route: {e}", exc_info=True)
+        app.logger.error(f"Unexpected error in /predict_batch_stream route: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
+    finally:
+        if spill is not None:
+            spill.close()
+
+@app.route('/feature_cache/stats', methods=['GET'])
+def feature_cache_stats_route():
+    """Hit/miss counters of the feature vector cache and the batch stats memo since start-up."""
+    return jsonify(feature_cache.counters())
+
+# --- Live Sessions ---
+# In-progress sessions, updated incrementally as the portal posts new events
+live_sessions = LiveSessionTable()
+
+def _score_live_session(test_id, parsed_session, questions_data_map):
+    """Features and prediction of a live session against the test's stored cohort baseline, as /predict_single scores."""
+    global_stats, baseline_sessions = global_stats_store.get_global_stats(test_id, questions_data_map)
+    if global_stats is None:
+        global_stats = {}
+
+    with service_metrics.stage('featurize'):
+        feature_values = np.array([extract_feature_vector(parsed_session, global_stats, questions_data_map)], dtype=np.float64)
+    nan_mask = np.isnan(feature_values[0])
+    if nan_mask.any():
+        feature_values[0, nan_mask] = 0.0 # Simple NaN handling
+        service_metrics.count('nan_filled', int(nan_mask.sum()))
+
+    model_version = model_registry.active()
+    labels, probabilities = score_feature_matrix(feature_values, model_version)
+    return {
+        "num_events": parsed_session.num_events,
+        "features": dict(zip(FEATURE_NAMES_IN_ORDER, feature_values[0].tolist())),
+        "prediction_label": int(labels[0]),
+        "probability_cheat": float(probabilities[0]),
+        "baseline_sessions": baseline_sessions,
+        "model_version": model_version.version,
+    }
+
+@app.route('/live/<test_id>/<user_id>/events', methods=['POST'])
+def live_events_route(test_id, user_id):
+    """
+    Appends events to a session in progress: {"events": [...], "questions_data": [...], "score": optional bool}.
+    questions_data is required for the first update of a session and optional afterwards. Only the new events
+    are processed; with "score": true the response also carries the session's current features and prediction.
+    """
+    try:
+        with service_metrics.stage('decode'):
+            data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+
+        events = data.get('events') or []
+        if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+            return jsonify({"error": "'events' must be a list of log event objects"}), 400
+
+        questions_data_map = None
+        if data.get('questions_data'):
+            questions_data_map = {q['id']: q for q in data['questions_data'] if isinstance(q, dict) and 'id' in q}
+            if not questions_data_map:
+                return jsonify({"error": "questions_data is empty or items missing 'id' field"}), 400
+
+        score = bool(data.get('score'))
+        if score and model_registry.current is None:
+            return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
+
+        service_metrics.count('events', len(events))
+        try:
+            with service_metrics.stage('parse'):
+                events_added, num_events, created, current = live_sessions.append(test_id, user_id, events, questions_data_map, snapshot=score)
+        except KeyError as e:
+            return jsonify({"error": str(e.args[0])}), 404
+
+        response = {"test_id": test_id, "userId": user_id, "events_added": events_added, "num_events": num_events}
+        if score:
+            response.update(_score_live_session(test_id, *current))
+        return jsonify(response), 201 if created else 200
+
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /live events route: {e}", exc_info=True)
+        return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
+
+@app.route('/live/<test_id>/<user_id>', methods=['GET'])
+def live_score_route(test_id, user_id):
+    """Current features and prediction of a session in progress, from its incremental state."""
+    if model_registry.current is None:
+        return jsonify({"error": "ML service not ready. Model or scaler not loaded."}), 503
+
+    try:
+        parsed_session, questions_data_map = live_sessions.get(test_id, user_id)
+        if parsed_session is None:
+            return jsonify({"error": f"Unknown live session {test_id}/{user_id}"}), 404
+        return jsonify({"test_id": test_id, "userId": user_id, **_score_live_session(test_id, parsed_session, questions_data_map)})
+
+    except Exception as e:
+        app.logger.error(f"Unexpected error in /live score route: {e}", exc_info=True)
         return jsonify({"error": f"An unexpected error occurred on the server: {str(e)}"}), 500
 
+@app.route('/live/<test_id>/<user_id>', methods=['DELETE'])
+def live_delete_route(test_id, user_id):
+    """Drops a live session, e.g. once the test is submitted and scored by /predict_batch."""
+    if not live_sessions.remove(test_id, user_id):
+        return jsonify({"error": f"Unknown live session {test_id}/{user_id}"}), 404
+    return '', 204
+
+@app.route('/live_sessions/stats', methods=['GET'])
+def live_sessions_stats_route():
+    return jsonify(live_sessions.counters())
+
+# --- Model Versions ---
+# If set, GET /models and POST /models/activate require it in the X-Admin-Token header
+ADMIN_TOKEN = os.environ.get('PREDICTION_ADMIN_TOKEN', '')
+
+@app.before_request
+def _pin_model_version():
+    # Every request scores with the version current when it started, even if another one is activated meanwhile
+    g.model_version_token = model_registry.pin()
+
+@app.teardown_request
+def _unpin_model_version(exc):
+    token = g.pop('model_version_token', None)
+    if token is not None:
+        model_registry.unpin(token)
+
+def _admin_denied():
+    if ADMIN_TOKEN and request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({"error": "Missing or invalid X-Admin-Token"}), 403
+    return None
+
+@app.route('/models', methods=['GET'])
+def models_route():
+    """The current model version, replaced versions still serving in-flight requests, and the versions on disk."""
+    denied = _admin_denied()
+    if denied:
+        return denied
+    return jsonify(model_registry.to_dict())
+
+@app.route('/models/activate', methods=['POST'])
+def activate_model_route():
+    """
+    Switches to {"version": ...} once it has loaded and scored a warm-up batch. The version is also written to
+    the registry's CURRENT file, so the other worker processes of serve.py follow within their watch interval.
+    """
+    denied = _admin_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True)
+    version = data.get('version') if isinstance(data, dict) else None
+    if not isinstance(version, str) or not version:
+        return jsonify({"error": "Missing 'version' in request"}), 400
+    if version not in model_registry.available_versions():
+        return jsonify({"error": f"Unknown model version '{version}'"}), 404
+
+    try:
+        model_version = model_registry.activate(version)
+    except ModelLoadError as e:
+        app.logger.error(f"Could not activate model version '{version}': {e}")
+        return jsonify({"error": str(e)}), 422
+    model_registry.write_current(version)
+    app.logger.info(f"Model version '{version}' activated.")
+    return jsonify(model_version.to_dict())
+
+@app.route('/ready', methods=['GET'])
+def ready_route():
+    """200 once a warmed-up model version is serving, 503 while it is still loading or if loading failed."""
+    model_version = model_registry.current
+    if model_version is None:
+        state = 'loading' if model_registry.loading else 'failed'
+        return jsonify({"ready": False, "state": state, "error": model_registry.load_error}), 503
+    return jsonify({
+        "ready": True,
+        "model_version": model_version.version,
+        "inference_path": model_version.inference_path,
+        "startup_seconds": round(model_registry.loaded_at - STARTED_AT, 3),
+    })
+
+# --- Instrumentation ---
+@app.before_request
+def _start_request_timer():
+    g.request_timer = service_metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+def _finish_request_timer(response):
+    timer = g.pop('request_timer', None)
+    if timer:
+        if service_metrics.TIMING_HEADER_ALWAYS or request.headers.get(service_metrics.TIMING_REQUEST_HEADER):
+            response.headers[service_metrics.TIMING_RESPONSE_HEADER] = timer.server_timing()
+        service_metrics.finish_request(timer, response.status_code)
+    return response
+
+@app.teardown_request
+def _discard_request_timer(exc):
+    # Only still set when the view raised and after_request did not run
+    timer = g.pop('request_timer', None)
+    if timer:
+        service_metrics.finish_request(timer, 500)
+
+@app.after_request
+def _compress_response(response):
+    # Registered after the timer hooks, so it runs before them and is timed with the request
+    with service_metrics.stage('compress'):
+        return compress_response(response, request.accept_encodings)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    Prometheus text exposition of request counts and latencies, per-stage duration histograms, sessions and
+    events processed, NaN-filled feature values and per-user errors. Send X-Request-Timing: 1 with any request
+    to get its own stage breakdown back in a Server-Timing header.
+    """
+    return Response(service_metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    model_registry.start_watcher()
     app.run(host='0.0.0.0', port=5001, debug=True)
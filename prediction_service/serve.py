@@ -0,0 +1,202 @@
+"""
+Production entry point for the prediction service: a pre-fork, multi-process, multi-threaded WSGI server.
+
+    python serve.py
+
+The parent process imports prediction_service (loading the model and scaler once), binds the listening
+socket and forks the workers, which share the loaded artifacts copy-on-write. Each worker serves requests
+on a bounded pool of threads. SIGTERM / SIGINT stop accepting connections, let in-flight requests finish
+(up to PREDICTION_SERVE_GRACEFUL_TIMEOUT seconds) and exit; workers that die are replaced.
+
+Configuration (environment):
+    PREDICTION_SERVE_HOST / PREDICTION_SERVE_PORT: Listen address (0.0.0.0:5001).
+    PREDICTION_SERVE_WORKERS: Worker processes (0 = one per CPU core).
+    PREDICTION_SERVE_THREADS: Request threads per worker.
+    PREDICTION_XGB_NTHREAD: XGBoost threads per worker (0 = CPU cores / workers), so workers do not oversubscribe cores.
+    PREDICTION_FEATURE_WORKERS: Feature-extraction processes per worker (default: CPU cores / workers), likewise.
+    PREDICTION_METRICS_DIR: Where workers publish their metrics for /metrics (default: a temporary directory
+                            removed on exit), so a scrape answered by any worker covers all of them.
+"""
+import gc
+import os
+import signal
+import socket
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+HOST = os.environ.get('PREDICTION_SERVE_HOST', '0.0.0.0')
+PORT = int(os.environ.get('PREDICTION_SERVE_PORT', '5001'))
+WORKERS = int(os.environ.get('PREDICTION_SERVE_WORKERS', '0')) or (os.cpu_count() or 1)
+THREADS = int(os.environ.get('PREDICTION_SERVE_THREADS', '4'))
+XGB_NTHREAD = int(os.environ.get('PREDICTION_XGB_NTHREAD', '0')) or max(1, (os.cpu_count() or 1) // WORKERS)
+GRACEFUL_TIMEOUT = float(os.environ.get('PREDICTION_SERVE_GRACEFUL_TIMEOUT', '30'))
+BACKLOG = int(os.environ.get('PREDICTION_SERVE_BACKLOG', '128'))
+
+# OpenMP reads this once, when XGBoost is first loaded; it must be set before the import below
+os.environ.setdefault('OMP_NUM_THREADS', str(XGB_NTHREAD))
+# Read by parallel_features on import: each worker's feature pool gets its share of the cores, not all of them
+os.environ.setdefault('PREDICTION_FEATURE_WORKERS', str(max(1, (os.cpu_count() or 1) // WORKERS)))
+# Likewise read by service_metrics on import
+TEMPORARY_METRICS_DIR = None
+if not os.environ.get('PREDICTION_METRICS_DIR'):
+    TEMPORARY_METRICS_DIR = os.environ['PREDICTION_METRICS_DIR'] = tempfile.mkdtemp(prefix='prediction-metrics-')
+
+from werkzeug.serving import BaseWSGIServer
+
+import parallel_features
+import prediction_service
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that handles each connection on a fixed pool of threads. When every thread is busy,
+    the accept loop waits, so further connections queue in the listen backlog instead of piling up in memory.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, fd=fd)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+        self._free_threads = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._free_threads.acquire()
+        try:
+            self._executor.submit(self._process_request_thread, request, client_address)
+        except BaseException:
+            self._free_threads.release()
+            raise
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_threads.release()
+
+    def finish_requests(self):
+        """Waits for in-flight requests; call after serve_forever() has returned."""
+        self._executor.shutdown(wait=True)
+
+
+def _bind_socket(host, port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(sock):
+    """Body of a forked worker process; never returns."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent turns Ctrl+C into SIGTERM
+    gc.enable()
+    if parallel_features.FEATURE_WORKERS > 1:
+        # Forked now, before this worker starts any thread, so the pool processes share the loaded model
+        parallel_features.shared_pool(start_method='fork')
+    prediction_service.set_inference_threads(XGB_NTHREAD)
+    prediction_service.model_registry.start_watcher() # threads do not survive the fork
+
+    server = PooledWSGIServer(HOST, PORT, prediction_service.app, THREADS, fd=sock.fileno())
+    # shutdown() waits for serve_forever() to return, so it cannot be called from the handler's own thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start())
+
+    exit_code = 0
+    try:
+        server.serve_forever()
+    except Exception as e:
+        print(f"ERROR: Worker {os.getpid()} crashed: {e}", file=sys.stderr)
+        exit_code = 1
+    finally:
+        server.finish_requests()
+        server.server_close()
+        parallel_features.shutdown_pools() # os._exit skips atexit
+    os._exit(exit_code)
+
+
+def _spawn_worker(sock):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_worker(sock)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve():
+    # Workers are forked with the loaded model, so it has to finish loading first (PREDICTION_MODEL_LOAD_IN_BACKGROUND)
+    if prediction_service.model_registry.wait_loaded() is None:
+        print("ERROR: Model or scaler not loaded; refusing to start workers.", file=sys.stderr)
+        sys.exit(1)
+
+    sock = _bind_socket(HOST, PORT)
+    print(f"Serving on http://{HOST}:{PORT} with {WORKERS} workers x {THREADS} threads (XGBoost nthread={XGB_NTHREAD}).")
+
+    # Objects loaded so far (model, scaler, modules) are moved out of the collector's reach, so collections
+    # in the workers do not write to, and thereby un-share, the pages they live on
+    gc.disable()
+    gc.freeze()
+
+    workers = set()
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(WORKERS):
+        workers.add(_spawn_worker(sock))
+
+    stop_deadline = None
+    while workers:
+        if stopping.is_set() and stop_deadline is None:
+            stop_deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG if stopping.is_set() else 0)
+        except ChildProcessError:
+            break
+
+        if pid == 0: # stopping, and no worker has exited yet
+            if time.monotonic() > stop_deadline:
+                print(f"Workers still running after {GRACEFUL_TIMEOUT:.0f}s; killing them.", file=sys.stderr)
+                for worker_pid in workers:
+                    os.kill(worker_pid, signal.SIGKILL)
+                stop_deadline = float('inf')
+            time.sleep(0.1)
+            continue
+
+        workers.discard(pid)
+        if not stopping.is_set():
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}; starting a replacement.", file=sys.stderr)
+            time.sleep(1) # do not spin if workers die on start-up
+            workers.add(_spawn_worker(sock))
+
+    sock.close()
+    if TEMPORARY_METRICS_DIR:
+        shutil.rmtree(TEMPORARY_METRICS_DIR, ignore_errors=True)
+    print("Prediction service stopped.")
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,302 @@
+import bisect
+import contextlib
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+
+# --- Configuration ---
+# Set to 0 to turn instrumentation off; stage() and count() then do nothing
+METRICS_ENABLED = os.environ.get('PREDICTION_METRICS', '1') != '0'
+# Add the per-request stage breakdown to every response, not only to requests that ask for it
+TIMING_HEADER_ALWAYS = os.environ.get('PREDICTION_TIMING_HEADER', '0') == '1'
+# Directory where each server process publishes its metrics, so /metrics can report all workers (see serve.py)
+METRICS_DIR = os.environ.get('PREDICTION_METRICS_DIR', '')
+# Seconds between two snapshots of a process's metrics in METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(os.environ.get('PREDICTION_METRICS_FLUSH_INTERVAL', '1'))
+
+# Request header that asks for the breakdown, and the response header carrying it (Server-Timing syntax, in ms)
+TIMING_REQUEST_HEADER = 'X-Request-Timing'
+TIMING_RESPONSE_HEADER = 'Server-Timing'
+
+# Histogram buckets in seconds, from a single-session parse to a large batch
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# --- Metric Types ---
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # label values tuple -> [value]
+        self._lock = threading.Lock()
+
+    def _new_state(self):
+        return [0]
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = self._new_state()
+            state[0] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), list(state)] for label_values, state in self._values.items()]
+
+    def samples(self, states):
+        """Prometheus sample lines for {label values tuple: state}."""
+        for label_values, state in sorted(states.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, label_values)} {_format_value(state[0])}"
+
+
+class Histogram(Counter):
+    """Cumulative histogram (count per bucket, sum and count) with a fixed set of label names."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_state(self):
+        return [0] * (len(self.buckets) + 1) + [0.0, 0] # per-bucket counts (last one is +Inf), sum, count
+
+    def observe(self, label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = self._new_state()
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self, states):
+        bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        for label_values, state in sorted(states.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, state):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames + ('le',), label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(state[-2])}"
+            yield f"{self.name}_count{labels} {state[-1]}"
+
+
+def _format_labels(labelnames, label_values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, label_values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    The metrics of this process, rendered in the Prometheus text format by render().
+
+    With a `directory`, the process also writes a snapshot of its metrics to {directory}/{pid}.json (see
+    maybe_flush) and render() sums the snapshots of every process, so any worker of a pre-fork server can
+    answer a scrape for all of them. Snapshots of exited workers are kept, so counters never go backwards.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._metrics = {}
+        self._last_flush = 0.0
+        self._flush_scheduled = False
+        self._flush_lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def flush(self):
+        """Writes this process's snapshot to the metrics directory."""
+        self._last_flush = time.monotonic()
+        snapshot = {name: metric.snapshot() for name, metric in self._metrics.items()}
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not write metrics snapshot {path}: {e}")
+
+    def _scheduled_flush(self):
+        with self._flush_lock:
+            self._flush_scheduled = False
+        self.flush()
+
+    def maybe_flush(self):
+        """
+        Called after each request: schedules a flush() at most flush_interval after the previous one, on a timer
+        thread, so the snapshot catches up even if no further request arrives.
+        """
+        if not self.directory:
+            return
+        with self._flush_lock:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        delay = max(0.0, self._last_flush + self.flush_interval - time.monotonic())
+        timer = threading.Timer(delay, self._scheduled_flush)
+        timer.daemon = True
+        timer.start()
+
+    def _collect(self):
+        """{metric name: {label values tuple: state}} of this process, or summed over every snapshot in the directory."""
+        if not self.directory:
+            return {name: {tuple(labels): state for labels, state in metric.snapshot()} for name, metric in self._metrics.items()}
+
+        self.flush()
+        merged = {name: {} for name in self._metrics}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: Could not read metrics snapshot {path}: {e}")
+                continue
+            for name, entries in snapshot.items():
+                if name not in merged:
+                    continue
+                for labels, state in entries:
+                    current = merged[name].setdefault(tuple(labels), [0] * len(state))
+                    for i, value in enumerate(state):
+                        current[i] += value
+        return merged
+
+    def render(self):
+        lines = []
+        for name, states in self._collect().items():
+            metric = self._metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.samples(states))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUESTS = registry.counter('prediction_requests_total', "Requests handled, by route and HTTP status.", ('route', 'status'))
+REQUEST_DURATION = registry.histogram('prediction_request_duration_seconds', "Request latency, by route.", ('route',))
+STAGE_DURATION = registry.histogram('prediction_stage_duration_seconds', "Time spent in each pipeline stage, by route.", ('route', 'stage'))
+SESSIONS = registry.counter('prediction_sessions_total', "User sessions received, by route.", ('route',))
+EVENTS = registry.counter('prediction_events_total', "Session log events received, by route.", ('route',))
+NAN_FILLED = registry.counter('prediction_nan_filled_total', "Feature values that were NaN and filled with 0 before scaling, by route.", ('route',))
+USER_ERRORS = registry.counter('prediction_user_errors_total', "Users returned with an error instead of a prediction, by route.", ('route',))
+
+_COUNTERS = {
+    'sessions': SESSIONS,
+    'events': EVENTS,
+    'nan_filled': NAN_FILLED,
+    'user_errors': USER_ERRORS,
+}
+
+
+# --- Per-request Timing ---
+class RequestTimer:
+    """Stage durations of one request (or batch job); see start_request."""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.stages = {} # stage -> seconds, summed if a stage runs more than once
+        self.token = None # restores the previous timer of the context in finish_request
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_DURATION.observe((self.route, stage), seconds)
+
+    def server_timing(self):
+        """Value of the Server-Timing header: each stage and the total so far, in milliseconds."""
+        entries = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ', '.join(entries)
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.record(self.name, time.perf_counter() - self.started)
+        return False
+
+
+_NO_STAGE = contextlib.nullcontext()
+_current_timer = contextvars.ContextVar('prediction_request_timer', default=None)
+
+
+def start_request(route):
+    """
+    Starts timing a request on `route` in the current context (thread). Returns the RequestTimer, or None
+    when metrics are disabled; pass it to finish_request.
+    """
+    if not METRICS_ENABLED:
+        return None
+    timer = RequestTimer(route)
+    timer.token = _current_timer.set(timer)
+    return timer
+
+
+def finish_request(timer, status):
+    """Records the request's latency and status and detaches the timer from the current context."""
+    REQUESTS.inc((timer.route, str(status)))
+    REQUEST_DURATION.observe((timer.route,), time.perf_counter() - timer.started)
+    _current_timer.reset(timer.token)
+    registry.maybe_flush()
+
+
+def recording():
+    """Whether a request is being timed in the current context, i.e. whether stage() and count() record anything."""
+    return _current_timer.get() is not None
+
+
+def stage(name):
+    """
+    Context manager timing one pipeline stage of the current request:
+
+        with service_metrics.stage('scaling'):
+            ...
+
+    Does nothing outside a timed request or when metrics are disabled.
+    """
+    timer = _current_timer.get()
+    return _Stage(timer, name) if timer is not None else _NO_STAGE
+
+
+def count(counter, amount=1):
+    """Adds amount to one of the per-route counters ('sessions', 'events', 'nan_filled', 'user_errors') of the current request."""
+    timer = _current_timer.get()
+    if timer is not None and amount:
+        _COUNTERS[counter].inc((timer.route,), amount)
@@ -0,0 +1,221 @@
+from operator import attrgetter
+
+from event_decoding import (
+    decode_events, timestamp_key, US_PER_SECOND,
+    EVENT_TEST_STARTED, EVENT_SELECTED_QUESTION, EVENT_SELECTED_OPTION,
+    EVENT_CLEARED_OPTION, EVENT_TAB_SWITCHED, EVENT_SUBMITTED_TEST,
+)
+
+
+class ParsedSession:
+    """
+    Everything the global stats and the feature aggregator need from one session's logs.
+    Built once per user by parse_session, so the log events are parsed, sorted and run
+    through the question state machine a single time per batch.
+
+    Attributes:
+        start_time / end_time (int): First and last parseable event, in microseconds since the epoch.
+        first_answer_time / last_answer_time (int): First and last "Selected option" event, or None.
+        submit_time (int): Last "Submitted Test" event, or None.
+        question_metrics (dict): q_id -> QuestionMetrics, in the order questions were first visited.
+                                 Only questions present in questions_data_map are tracked.
+    """
+
+    def __init__(self):
+        self.num_events = 0
+        self.start_time = None
+        self.end_time = None
+        self.first_answer_time = None
+        self.last_answer_time = None
+        self.submit_time = None
+        self.question_metrics = {}
+
+    @property
+    def is_empty(self):
+        return self.num_events == 0
+
+    # Pool workers send parsed sessions back to the parent (see parallel_features): the metrics are pickled as
+    # plain tuples, which takes a third of the time of pickling the QuestionMetrics objects themselves
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['question_metrics'] = (list(self.question_metrics), [_metrics_values(metrics) for metrics in self.question_metrics.values()])
+        return state
+
+    def __setstate__(self, state):
+        q_ids, values = state['question_metrics']
+        state['question_metrics'] = dict(zip(q_ids, map(QuestionMetrics.from_values, values)))
+        self.__dict__.update(state)
+
+
+class QuestionMetrics:
+    """
+    One session's metrics for one question. A __slots__ record rather than a dict: a batch holds one per
+    (student, question), so this keeps them small and cheap to create.
+    """
+
+    __slots__ = ('time_spent', 'answered_correctly', 'answer_changes', 'tab_switches', 'is_attempted', 'is_revisit')
+
+    def __init__(self):
+        self.time_spent = 0.0
+        self.answered_correctly = None
+        self.answer_changes = 0
+        self.tab_switches = 0
+        self.is_attempted = False
+        self.is_revisit = False
+
+    @classmethod
+    def from_values(cls, values):
+        """Inverse of _metrics_values: a QuestionMetrics from its attribute values, in __slots__ order."""
+        metrics = cls.__new__(cls)
+        (metrics.time_spent, metrics.answered_correctly, metrics.answer_changes,
+         metrics.tab_switches, metrics.is_attempted, metrics.is_revisit) = values
+        return metrics
+
+    def copy(self):
+        metrics = QuestionMetrics.__new__(QuestionMetrics)
+        for name in self.__slots__:
+            setattr(metrics, name, getattr(self, name))
+        return metrics
+
+    def __eq__(self, other):
+        return isinstance(other, QuestionMetrics) and self.to_dict() == other.to_dict()
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"QuestionMetrics({self.to_dict()})"
+
+
+_metrics_values = attrgetter(*QuestionMetrics.__slots__)
+
+
+def parse_session(session_log_events, questions_data_map):
+    """
+    Decodes, sorts and walks one session's log events (see event_decoding.decode_events).
+    Args:
+        session_log_events (list): List of log event dictionaries for the session.
+        questions_data_map (dict): Map of question_id to question details for the current test.
+    Returns:
+        ParsedSession: Per-question metrics and session timing markers. Empty if no event
+                       had a parseable timestamp.
+    """
+    if not session_log_events: return ParsedSession()
+    return parse_records(decode_events(session_log_events), questions_data_map)
+
+
+def parse_records(records, questions_data_map):
+    """
+    parse_session for events that are already decoded, e.g. read back from a binary export (see score_offline).
+    Args:
+        records (list): (timestamp_us, event_code, option_index, location) tuples as built by
+                        event_decoding.decode_events, in log order. Sorted in place.
+        questions_data_map (dict): Map of question_id to question details for the current test.
+    Returns:
+        ParsedSession: Same as parse_session of the events the records were decoded from.
+    """
+    session = ParsedSession()
+    if not records: return session
+    records.sort(key=timestamp_key)
+
+    session.num_events = len(records)
+    session.start_time = records[0][0]
+    session.end_time = records[-1][0]
+
+    state = WalkState()
+    apply_records(session, state, records, True, questions_data_map)
+    score_answers(session, state, questions_data_map)
+    return session
+
+
+class WalkState:
+    """Where the question state machine stands between two events of one session (see apply_records)."""
+
+    __slots__ = ('current_q_id', 'last_q_selection_time', 'final_answer_for_q')
+
+    def __init__(self):
+        self.current_q_id = None
+        self.last_q_selection_time = None
+        self.final_answer_for_q = {} # q_id -> last selected option, None once cleared
+
+    def copy(self):
+        state = WalkState.__new__(WalkState)
+        state.current_q_id = self.current_q_id
+        state.last_q_selection_time = self.last_q_selection_time
+        state.final_answer_for_q = dict(self.final_answer_for_q)
+        return state
+
+
+def apply_records(session, state, records, ends_session, questions_data_map):
+    """
+    Runs decoded events through the question state machine. The loop shared by parse_records, which passes
+    all of a session's events at once, and live_sessions.LiveSession, which passes them as they arrive.
+    Args:
+        session (ParsedSession): Updated in place: answer/submit times and question_metrics.
+        state (WalkState): Where the previous call left off; updated in place.
+        records (list): (timestamp_us, event_code, option_index, location) tuples, sorted, none earlier than
+                        the events already applied.
+        ends_session (bool): Whether the last record is the session's final event, which closes the current
+                             question's timer.
+        questions_data_map (dict): Map of question_id to question details for the current test.
+    """
+    q_metrics = session.question_metrics
+    final_answer_for_q = state.final_answer_for_q
+    last_q_selection_time = state.last_q_selection_time
+    current_q_id = state.current_q_id
+    current = q_metrics.get(current_q_id) # QuestionMetrics of current_q_id, if it is one of questions_data_map
+    last_index = len(records) - 1 if ends_session else -1
+
+    for i, (timestamp, code, option, location) in enumerate(records):
+        is_q_selection = code == EVENT_SELECTED_QUESTION
+
+        if code == EVENT_SELECTED_OPTION:
+            if session.first_answer_time is None:
+                session.first_answer_time = timestamp
+            session.last_answer_time = timestamp
+        elif code == EVENT_SUBMITTED_TEST:
+            session.submit_time = timestamp
+
+        if is_q_selection or code == EVENT_TEST_STARTED:
+            if current is not None and last_q_selection_time is not None:
+                current.time_spent += max(0, (timestamp - last_q_selection_time) / US_PER_SECOND)
+
+            last_q_selection_time = timestamp
+            current_q_id = location
+            current = None
+
+            if current_q_id in questions_data_map:
+                current = q_metrics.get(current_q_id)
+                if current is None:
+                    current = q_metrics[current_q_id] = QuestionMetrics()
+                elif is_q_selection:
+                    current.is_revisit = True
+
+        elif code == EVENT_SUBMITTED_TEST or i == last_index:
+            if current is not None and last_q_selection_time is not None:
+                current.time_spent += max(0, (timestamp - last_q_selection_time) / US_PER_SECOND)
+            current_q_id = None
+            current = None
+            last_q_selection_time = None
+
+        if current is not None:
+            current.is_attempted = True
+            if code == EVENT_TAB_SWITCHED:
+                current.tab_switches += 1
+            elif code == EVENT_CLEARED_OPTION:
+                current.answer_changes += 1
+                final_answer_for_q[current_q_id] = None
+            elif code == EVENT_SELECTED_OPTION:
+                final_answer_for_q[current_q_id] = option
+
+    state.current_q_id = current_q_id
+    state.last_q_selection_time = last_q_selection_time
+
+
+def score_answers(session, state, questions_data_map):
+    """Sets answered_correctly from each question's final answer, once every event has gone through apply_records."""
+    q_metrics = session.question_metrics
+    for q_id, last_answer in state.final_answer_for_q.items():
+        correct_ref = questions_data_map[q_id].get("correct_answer")
+        if last_answer is not None and correct_ref is not None:
+            q_metrics[q_id].answered_correctly = 1 if last_answer == correct_ref else 0
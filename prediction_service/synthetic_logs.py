@@ -0,0 +1,127 @@
+"""
+Deterministic synthetic exam logs in the exact shape the backend sends to /predict_batch.
+
+Event texts and locations follow portal/src/components/TestWindow.jsx ("Test Started", "Selected question N",
+"Selected option K for question N", "Cleared option for question N", "Tab Switched" / "Returned to Test Tab",
+"Submitted Test"); timestamps are ISO-8601 UTC with milliseconds, as produced by Date.toISOString().
+The same parameters and seed always give the same batch, and each student only depends on (seed, index),
+so a smaller batch is a prefix of a larger one.
+"""
+import datetime
+import hashlib
+import random
+
+_TEST_START = datetime.datetime(2025, 1, 15, 9, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def _object_id(*parts):
+    """24 hex characters, like a MongoDB ObjectId."""
+    return hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24]
+
+
+def _iso(ts):
+    return ts.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def generate_questions(num_questions=20, num_options=4, seed=0):
+    """
+    Returns:
+        list: questions_data items, {"id", "text", "options", "correct_answer"} as built by evaluateTest.
+    """
+    rng = random.Random(f"{seed}:questions")
+    return [{
+        "id": _object_id(seed, 'question', i),
+        "text": f"Question {i + 1}",
+        "options": [f"Option {k + 1}" for k in range(num_options)],
+        "correct_answer": rng.randrange(num_options),
+    } for i in range(num_questions)]
+
+
+def generate_session(rng, questions_data, events_per_session=60, cheat=False):
+    """
+    Simulates one student's session.
+    Args:
+        rng (random.Random): Source of randomness for this student.
+        questions_data (list): As returned by generate_questions.
+        events_per_session (int): Approximate number of events; after one pass over the questions the
+                                  student revisits questions until the budget is used.
+        cheat (bool): Answer fast and mostly correctly, with frequent tab switches.
+    Returns:
+        list: session_log_events, [{"timestamp", "activity_text", "location"}, ...]
+    """
+    num_questions = len(questions_data)
+    num_options = len(questions_data[0]["options"]) if questions_data else 4
+    events = []
+    now = _TEST_START + datetime.timedelta(seconds=rng.uniform(0, 300))
+
+    def log(activity_text, location=None):
+        events.append({"timestamp": _iso(now), "activity_text": activity_text, "location": location})
+
+    def wait(mean, std_dev, low, high):
+        nonlocal now
+        now += datetime.timedelta(seconds=min(max(rng.gauss(mean, std_dev), low), high))
+
+    log("Test Started", questions_data[0]["id"] if questions_data else None)
+
+    # Visit order: one pass (mostly sequential, with jumps), then revisits while the event budget lasts
+    unvisited = list(range(num_questions))
+    budget = max(events_per_session - 4, 1) # leaves room for the closing events
+    while len(events) < budget and num_questions:
+        if unvisited:
+            index = unvisited.pop(0 if rng.random() < 0.8 else rng.randrange(len(unvisited)))
+        else:
+            index = rng.randrange(num_questions)
+        question = questions_data[index]
+
+        wait(2, 1, 0.5, 5)
+        log(f"Selected question {index}", question["id"])
+
+        if cheat:
+            wait(6, 3, 1, 15)
+        else:
+            wait(25, 8, 8, 60)
+        if rng.random() < (0.5 if cheat else 0.05):
+            log("Tab Switched")
+            wait(8 if cheat else 4, 3, 1, 30)
+            log("Returned to Test Tab")
+
+        if rng.random() < (0.15 if cheat else 0.2):
+            log(f"Selected option {rng.randrange(num_options)} for question {index}", question["id"])
+            wait(5, 2, 1, 15)
+            log(f"Cleared option for question {index}", question["id"])
+            wait(3, 1, 0.5, 10)
+
+        if rng.random() < 0.95:
+            correct = rng.random() < (0.9 if cheat else 0.6)
+            option = question["correct_answer"] if correct else rng.randrange(num_options)
+            log(f"Selected option {option} for question {index}", question["id"])
+
+    wait(10, 5, 1, 30)
+    log(f"Final Focused Time: {int((now - _TEST_START).total_seconds())} seconds")
+    log("Final Distraction Time: 0 seconds")
+    log("Submitted Test", questions_data[-1]["id"] if questions_data else None)
+    return events
+
+
+def generate_batch(num_students=200, num_questions=20, events_per_session=60, cheat_ratio=0.1, seed=0):
+    """
+    Builds a /predict_batch request body.
+    Args:
+        num_students (int): Number of sessions.
+        num_questions (int): Questions in the test.
+        events_per_session (int): Approximate events per session.
+        cheat_ratio (float): Fraction of students simulated as cheating.
+        seed (int): Batches with the same arguments and seed are identical.
+    Returns:
+        dict: {"all_user_logs": [{"userId", "session_log_events"}, ...], "questions_data": [...]}
+    """
+    questions_data = generate_questions(num_questions, seed=seed)
+    all_user_logs = []
+    for i in range(num_students):
+        rng = random.Random(f"{seed}:student:{i}")
+        cheat = rng.random() < cheat_ratio
+        all_user_logs.append({
+            "userId": _object_id(seed, 'student', i),
+            "session_log_events": generate_session(rng, questions_data, events_per_session, cheat),
+        })
+    return {"all_user_logs": all_user_logs, "questions_data": questions_data}
@@ -0,0 +1,353 @@
+"""
+Request and response encodings of the prediction service.
+
+Compression: request bodies sent with `Content-Encoding: gzip` (or `zstd`, when the optional `zstandard`
+package is installed) are decompressed by DecompressionMiddleware before Flask sees them, and responses
+are compressed by compress_response according to the request's Accept-Encoding.
+
+Columnar batches: /predict_batch also accepts a body of type COLUMNAR_CONTENT_TYPE, an .npz archive
+(numpy.savez, no pickled objects) with the batch as flat columns instead of one JSON object per event:
+
+    header         0-d str, JSON {"questions_data": [...], "test_id": optional, "feature_engine": optional}
+    user_ids       str (users,)
+    offsets        int64 (users + 1,); user i's events are [offsets[i], offsets[i + 1])
+    timestamps_us  int64 (events,), microseconds since the epoch
+    event_codes    int8 (events,), event_decoding.EVENT_* codes
+    options        int32 (events,), option index of "Selected option" events, NO_OPTION otherwise
+    locations      int32 (events,), index into location_ids, NO_LOCATION for none
+    location_ids   str (locations,), the distinct locations (question ids)
+    missing        bool (users,), optional: users sent without session_log_events
+
+The events are what event_decoding.decode_events builds from the JSON events, so they are scored exactly
+like the JSON body. EncodedBatch.from_user_logs builds the encoding from a JSON-shaped batch.
+"""
+import gzip
+import io
+import json
+import os
+import zlib
+
+import numpy as np
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import LimitedStream
+
+from columnar_features import ColumnarBatch
+from event_decoding import decode_events, columns_to_records, NO_OPTION, NO_LOCATION
+from session_parser import parse_records
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# --- Configuration ---
+# Set to 0 to never compress responses
+RESPONSE_COMPRESSION = os.environ.get('PREDICTION_RESPONSE_COMPRESSION', '1') != '0'
+# Responses smaller than this are sent uncompressed
+COMPRESS_MIN_BYTES = int(os.environ.get('PREDICTION_COMPRESS_MIN_BYTES', '1024'))
+# Compression levels of responses
+GZIP_LEVEL = int(os.environ.get('PREDICTION_GZIP_LEVEL', '5'))
+ZSTD_LEVEL = int(os.environ.get('PREDICTION_ZSTD_LEVEL', '3'))
+# Largest decompressed request body accepted, in bytes (0 = no limit)
+MAX_DECOMPRESSED_BYTES = int(os.environ.get('PREDICTION_MAX_DECOMPRESSED_BYTES', str(4 << 30)))
+
+COLUMNAR_CONTENT_TYPE = 'application/x-npz'
+
+# Request bodies decompressed as they are read instead of up front, so a streamed upload stays streamed
+STREAMING_CONTENT_TYPES = ('application/x-ndjson',)
+
+
+def supported_encodings():
+    """Content-Encodings accepted for requests and offered for responses, preferred first."""
+    return ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+# --- Request Decompression ---
+class BodyTooLarge(Exception):
+    pass
+
+
+class InvalidBody(ValueError):
+    """A compressed request body that is truncated or not valid for its Content-Encoding."""
+
+
+def decompress(body, encoding, limit=MAX_DECOMPRESSED_BYTES):
+    """
+    Decompresses a whole request body.
+    Raises:
+        BodyTooLarge: If the result would exceed limit bytes.
+        ValueError: If the body is not valid for its encoding.
+    """
+    max_length = limit + 1 if limit else 0
+    try:
+        if encoding == 'gzip':
+            # A body may hold several gzip members back to back (concatenated streams, pigz), as GzipFile reads them
+            chunks, size, remaining = [], 0, body
+            while remaining:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                chunk = decompressor.decompress(remaining, max_length - size) if max_length else decompressor.decompress(remaining)
+                chunks.append(chunk)
+                size += len(chunk)
+                if max_length and size >= max_length:
+                    break
+                if not decompressor.eof:
+                    raise ValueError("truncated gzip body")
+                remaining = decompressor.unused_data
+            data = b''.join(chunks)
+        else:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)) as reader:
+                data = reader.read(max_length) if max_length else reader.read()
+    except (zlib.error, EOFError) as e:
+        raise ValueError(f"invalid {encoding} body: {e}")
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise ValueError(f"invalid {encoding} body: {e}")
+        raise
+    if limit and len(data) > limit:
+        raise BodyTooLarge(f"Decompressed request body exceeds {limit} bytes")
+    return data
+
+
+def _stream_reader(stream, encoding):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    return zstandard.ZstdDecompressor().stream_reader(stream)
+
+
+class DecompressingStream(io.RawIOBase):
+    """
+    A compressed request body, decompressed as it is read (wrap it in io.BufferedReader to read lines).
+    The app consumes it, so its errors reach the route instead of the middleware: a truncated or invalid
+    body raises InvalidBody, and reading more than limit decompressed bytes raises BodyTooLarge.
+    """
+
+    def __init__(self, stream, encoding, limit=MAX_DECOMPRESSED_BYTES):
+        self.encoding = encoding
+        self.limit = limit
+        self.bytes_read = 0
+        self._reader = _stream_reader(stream, encoding)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            num_bytes = self._reader.readinto(buffer)
+        except (zlib.error, EOFError, gzip.BadGzipFile) as e:
+            raise InvalidBody(f"invalid {self.encoding} body: {e}")
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise InvalidBody(f"invalid {self.encoding} body: {e}")
+            raise
+        self.bytes_read += num_bytes
+        if self.limit and self.bytes_read > self.limit:
+            raise BodyTooLarge(f"Decompressed request body exceeds {self.limit} bytes")
+        return num_bytes
+
+
+class DecompressionMiddleware:
+    """
+    WSGI middleware replacing a compressed request body by its decompressed content. Malformed bodies get a
+    400, unsupported encodings a 415 and bodies over MAX_DECOMPRESSED_BYTES a 413, before the app runs.
+    STREAMING_CONTENT_TYPES bodies are instead decompressed by a DecompressingStream as the app reads them;
+    the app maps its InvalidBody and BodyTooLarge to the same 400 and 413.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return self.wsgi_app(environ, start_response)
+        if encoding not in supported_encodings():
+            return _error(f"Unsupported Content-Encoding '{encoding}'. Expected one of {list(supported_encodings())}", 415)(environ, start_response)
+
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        content_type = environ.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+        if content_type in STREAMING_CONTENT_TYPES:
+            stream = environ['wsgi.input']
+            if not environ.get('wsgi.input_terminated'):
+                # Not chunked: the server's input is the connection itself, so stop at the end of the body
+                stream = LimitedStream(stream, content_length)
+            environ['wsgi.input'] = io.BufferedReader(DecompressingStream(stream, encoding))
+            environ['wsgi.input_terminated'] = True # length unknown: read to the end of the decompressed stream
+            environ.pop('CONTENT_LENGTH', None)
+        else:
+            body = environ['wsgi.input'].read(content_length) if content_length else environ['wsgi.input'].read()
+            try:
+                body = decompress(body, encoding)
+            except BodyTooLarge as e:
+                return _error(str(e), 413)(environ, start_response)
+            except ValueError as e:
+                return _error(f"Could not decompress request body: {e}", 400)(environ, start_response)
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def _error(message, status):
+    return Response(json.dumps({"error": message}), status=status, mimetype='application/json')
+
+
+# --- Response Compression ---
+def compress_response(response, accept_encodings):
+    """
+    Compresses a response body with the best encoding the client accepts (after_request hook).
+    Streamed responses and small bodies are left as they are.
+    Args:
+        accept_encodings: The request's parsed Accept-Encoding header (request.accept_encodings).
+    """
+    if (not RESPONSE_COMPRESSION or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304) or 'Content-Encoding' in response.headers):
+        return response
+    encoding = accept_encodings.best_match(supported_encodings())
+    if encoding is None:
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    if encoding == 'gzip':
+        compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    else:
+        compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# --- Columnar Batches ---
+class EncodedBatch:
+    """A /predict_batch body in the columnar encoding (see the module docstring), validated."""
+
+    def __init__(self, header, user_ids, offsets, timestamps_us, event_codes, options, locations, location_ids, missing=None):
+        self.header = header
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.timestamps_us = timestamps_us
+        self.event_codes = event_codes
+        self.options = options
+        self.locations = locations
+        self.location_ids = location_ids
+        self.missing = np.diff(offsets) == 0 if missing is None else missing
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def num_users(self):
+        return len(self.user_ids)
+
+    @property
+    def num_events(self):
+        return len(self.timestamps_us)
+
+    @classmethod
+    def from_npz(cls, body):
+        """
+        Raises:
+            ValueError: If the body is not a valid columnar batch.
+        """
+        if not body.startswith(b'PK'): # zip local file header
+            raise ValueError("Body is not an .npz archive")
+        try:
+            archive = np.load(io.BytesIO(body), allow_pickle=False)
+        except Exception as e:
+            raise ValueError(f"Body is not an .npz archive: {e}")
+        with archive:
+            names = set(archive.files)
+            required = {'header', 'user_ids', 'offsets', 'timestamps_us', 'event_codes', 'options', 'locations', 'location_ids'}
+            if required - names:
+                raise ValueError(f"Missing arrays in columnar batch: {sorted(required - names)}")
+            try:
+                header = json.loads(str(archive['header']))
+            except ValueError as e:
+                raise ValueError(f"Invalid 'header' in columnar batch: {e}")
+            if not isinstance(header, dict):
+                raise ValueError("Invalid 'header' in columnar batch: expected a JSON object")
+            user_ids = archive['user_ids'].astype(str).tolist()
+            location_ids = archive['location_ids'].astype(str).tolist()
+            offsets = archive['offsets'].astype(np.int64, copy=False)
+            columns = [archive[name] for name in ('timestamps_us', 'event_codes', 'options', 'locations')]
+            missing = archive['missing'].astype(bool, copy=False) if 'missing' in names else None
+
+        timestamps_us, event_codes, options, locations = columns
+        num_events = len(timestamps_us)
+        if offsets.shape != (len(user_ids) + 1,) or offsets[0] != 0 or offsets[-1] != num_events or np.any(np.diff(offsets) < 0):
+            raise ValueError("'offsets' must hold users + 1 non-decreasing entries from 0 to the number of events")
+        if any(column.shape != (num_events,) for column in columns):
+            raise ValueError("Event columns must all have one entry per event")
+        if missing is not None and missing.shape != (len(user_ids),):
+            raise ValueError("'missing' must have one entry per user")
+        for name, column in zip(('timestamps_us', 'event_codes', 'options', 'locations'), columns):
+            if column.dtype.kind not in 'iu':
+                raise ValueError(f"'{name}' must be an integer array")
+        if num_events and (locations.min() < NO_LOCATION or locations.max() >= len(location_ids)):
+            raise ValueError("'locations' must index 'location_ids' (or be NO_LOCATION)")
+
+        return cls(header, user_ids, offsets, timestamps_us.astype(np.int64, copy=False), event_codes.astype(np.int8),
+                   options.astype(np.int32), locations.astype(np.int32), location_ids, missing)
+
+    @classmethod
+    def from_user_logs(cls, all_user_logs_with_ids, questions_data, test_id=None, feature_engine=None):
+        """Encodes a JSON-shaped batch (e.g. for clients and benchmarks)."""
+        location_index = {}
+        offsets, timestamps_us, event_codes, options, locations, missing = [0], [], [], [], [], []
+        for user_log_data in all_user_logs_with_ids:
+            session_log_events = user_log_data.get('session_log_events')
+            missing.append(not session_log_events)
+            for timestamp, code, option, location in decode_events(session_log_events or ()):
+                timestamps_us.append(timestamp)
+                event_codes.append(code)
+                options.append(NO_OPTION if option is None else option)
+                locations.append(NO_LOCATION if location is None else location_index.setdefault(str(location), len(location_index)))
+            offsets.append(len(timestamps_us))
+
+        header = {"questions_data": questions_data}
+        if test_id: header["test_id"] = test_id
+        if feature_engine: header["feature_engine"] = feature_engine
+        return cls(header, [str(user_log_data.get('userId', 'unknown_user')) for user_log_data in all_user_logs_with_ids],
+                   np.array(offsets, dtype=np.int64), np.array(timestamps_us, dtype=np.int64), np.array(event_codes, dtype=np.int8),
+                   np.array(options, dtype=np.int32), np.array(locations, dtype=np.int32), list(location_index), np.array(missing, dtype=bool))
+
+    def to_npz(self):
+        buffer = io.BytesIO()
+        np.savez(buffer, header=np.array(json.dumps(self.header)), user_ids=np.array(self.user_ids, dtype=str),
+                 offsets=self.offsets, timestamps_us=self.timestamps_us, event_codes=self.event_codes, options=self.options,
+                 locations=self.locations, location_ids=np.array(self.location_ids, dtype=str), missing=self.missing)
+        return buffer.getvalue()
+
+    def parsed_sessions(self, questions_data_map):
+        """ParsedSession per user (via parse_records), None for missing users; exceptions are returned in place."""
+        records = columns_to_records(self.timestamps_us, self.event_codes, self.options, self.locations, self.location_ids)
+        offsets = self.offsets.tolist()
+        parsed_sessions = []
+        for position, is_missing in enumerate(self.missing.tolist()):
+            if is_missing:
+                parsed_sessions.append(None)
+                continue
+            try:
+                parsed_sessions.append(parse_records(records[offsets[position]:offsets[position + 1]], questions_data_map))
+            except Exception as e:
+                parsed_sessions.append(e)
+        return parsed_sessions
+
+    def columnar_batch(self, questions_data_map):
+        """The ColumnarBatch of this batch, straight from the columns (missing users have no events)."""
+        question_ids = list(questions_data_map.keys())
+        question_position = {q_id: i for i, q_id in enumerate(question_ids)}
+        location_question = np.array([question_position.get(location, -1) for location in self.location_ids] + [-1], dtype=np.int32)
+        keep = np.repeat(~self.missing, np.diff(self.offsets))
+        # NO_LOCATION (-1) picks the trailing -1 of location_question
+        question_index = location_question[self.locations[keep]]
+        option_valid = self.options[keep] != NO_OPTION
+        return ColumnarBatch(
+            self.num_users, question_ids, [questions_data_map[q_id].get("correct_answer") for q_id in question_ids],
+            np.repeat(np.arange(self.num_users, dtype=np.int64), np.diff(self.offsets))[keep], self.timestamps_us[keep],
+            self.event_codes[keep], question_index, np.where(option_valid, self.options[keep], 0), option_valid)